@@ -0,0 +1,671 @@
+"""Offline benchmarks for the keybox generator, the bot handlers and the user store.
+
+Usage:
+    python benchmark.py keybox [--count N] [--backend cryptography|openssl|all] [--pool SIZE]
+    python benchmark.py store [--users 1000,100000,1000000] [--store sqlite|json|all]
+    python benchmark.py scaling [--workers 1,2,4] [--count N]
+    python benchmark.py handlers [--count N]  (fails unless each /generate sends one document)
+    python benchmark.py startup [--runs N] [--processes N]
+    python benchmark.py templates [--iterations N]
+    python benchmark.py verify [--keyboxes N]
+    python benchmark.py suite [--output results.json] [--baseline old.json] [--threshold 0.25]
+    python benchmark.py compare old.json new.json [--threshold 0.25]
+
+``suite`` runs a quick version of every benchmark, writes the results as JSON
+and, given a baseline from an earlier commit, exits with status 1 when a
+result got worse by more than the threshold.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.request import BaseRequest
+
+import keyboxGenerator
+import storage
+import workerPool
+
+HIGHER = "higher"
+LOWER = "lower"
+SAMPLE_MESSAGE = (
+    "✅ Keybox generated successfully!\n🔑 Keyboxes generated today: 3/5\n"
+    "Time remaining until your next keybox: 1 day, 2:03:04. What would you like to do next?"
+)
+
+
+def bench_backend(backend: str, count: int) -> dict:
+    """Generates ``count`` keyboxes with ``backend`` and returns the throughput."""
+    failures = 0
+    start = time.perf_counter()
+    for _ in range(count):
+        if keyboxGenerator.generate_keybox_isolated(backend).startswith("Error"):
+            failures += 1
+    elapsed = time.perf_counter() - start
+    return {
+        "backend": backend,
+        "count": count,
+        "failures": failures,
+        "seconds": elapsed,
+        "keyboxes_per_second": count / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def bench_store(backend: str, users: int, ops: int, budget: float) -> dict:
+    """Times the per-request pattern of /generate (read one user, write it back).
+
+    Runs ``ops`` requests or until ``budget`` seconds have passed, whichever
+    comes first, against a store pre-filled with ``users`` records.
+    """
+    now = int(time.time())
+    with tempfile.TemporaryDirectory() as scratch:
+        store = storage.open_store(
+            backend, os.path.join(scratch, "user_data.db"), os.path.join(scratch, "user_data.json")
+        )
+        store.save_all(
+            {str(user_id): {"count": 0, "last_reset": now, "vip": False} for user_id in range(users)}
+        )
+        latencies = []
+        deadline = time.perf_counter() + budget
+        for i in range(ops):
+            user_id = (i * 7919) % users
+            start = time.perf_counter()
+            record = store.get_user(user_id)
+            record["count"] += 1
+            store.save_user(user_id, record)
+            latencies.append(time.perf_counter() - start)
+            if time.perf_counter() > deadline:
+                break
+        store.close()
+    latencies.sort()
+    return {
+        "store": backend,
+        "users": users,
+        "ops": len(latencies),
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))] * 1000,
+    }
+
+
+def bench_scaling(workers: int, count: int, backend: str | None) -> dict:
+    """Generates ``count`` keyboxes on a pool of ``workers`` warmed-up processes."""
+    pool = workerPool.GenerationWorkerPool(workers)
+    pool.start()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as clients:
+            start = time.perf_counter()
+            results = list(
+                clients.map(
+                    lambda _: pool.submit(keyboxGenerator.generate_keybox_isolated, backend),
+                    range(count),
+                )
+            )
+            elapsed = time.perf_counter() - start
+    finally:
+        pool.shutdown()
+    return {
+        "workers": workers,
+        "count": count,
+        "failures": sum(1 for result in results if result.startswith("Error")),
+        "seconds": elapsed,
+        "keyboxes_per_second": count / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+class MockRequest(BaseRequest):
+    """Answers Bot API calls in memory, so the handlers run without the network."""
+
+    def __init__(self):
+        self.calls = 0
+        self.documents = 0
+        self._messageID = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs) -> tuple:
+        self.calls += 1
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.json_parameters if request_data is not None else {}
+        self.documents += endpoint == "sendDocument"
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif endpoint in ("sendMessage", "sendDocument", "editMessageText"):
+            self._messageID += 1
+            result = {
+                "message_id": self._messageID,
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id") or 0), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+
+def command_update(updateID: int, chat_id: int, command: str) -> dict:
+    return {
+        "update_id": updateID,
+        "message": {
+            "message_id": updateID,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+            "text": command,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command.split()[0])}],
+        },
+    }
+
+
+def percentiles(values: list) -> dict:
+    ordered = sorted(values)
+    pick = lambda fraction: ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+    return {"p50_ms": pick(0.5) * 1000, "p99_ms": pick(0.99) * 1000, "mean_ms": sum(values) / len(values) * 1000}
+
+
+async def _bench_handlers(commands: tuple, count: int) -> dict:
+    import main as bot
+    from telegram import Update
+    from telegram.ext import Application
+
+    request = MockRequest()
+    application = (
+        Application.builder()
+        .token("123456:BENCH")
+        .request(request)
+        .get_updates_request(MockRequest())
+        .build()
+    )
+    bot.register_handlers(application)
+    if bot.GENERATION_PROCESSES > 0:
+        await asyncio.to_thread(bot.get_worker_pool().start)
+    await application.initialize()
+    results = {}
+    try:
+        updateID = 0
+        for command in commands:
+            latencies = []
+            calls, documents = request.calls, request.documents
+            for i in range(count):
+                updateID += 1
+                # batches (/generate N) are for VIPs and the admin only
+                chat_id = bot.ADMIN_USER_ID if " " in command else 7_000_000 + updateID
+                update = Update.de_json(command_update(updateID, chat_id, command), application.bot)
+                start = time.perf_counter()
+                await application.process_update(update)
+                latencies.append(time.perf_counter() - start)
+            results[command] = percentiles(latencies)
+            results[command]["api_calls"] = (request.calls - calls) / count  # Bot API calls per update
+            results[command]["documents"] = (request.documents - documents) / count
+            if command.startswith("/generate") and results[command]["documents"] != 1:
+                raise RuntimeError(
+                    f"{command} sent {results[command]['documents']:g} documents per update instead of one"
+                )
+    finally:
+        await application.shutdown()
+        if bot.worker_pool is not None:
+            bot.worker_pool.shutdown()
+    return results
+
+
+def bench_handlers(commands: tuple = ("/start", "/help", "/generate", "/generate 3"), count: int = 20) -> dict:
+    """End-to-end latency of each command through the real handlers and a mocked Bot API.
+
+    Raises RuntimeError when a /generate update does not end in exactly one document.
+    """
+    import main as bot
+
+    with tempfile.TemporaryDirectory() as scratch:
+        bot.DATA_FILE = os.path.join(scratch, "user_data.json")
+        bot.DATABASE_FILE = os.path.join(scratch, "user_data.db")
+        bot.QUOTA_JOURNAL_FILE = os.path.join(scratch, "quota.journal")
+        bot.store = None
+        bot.quota_ledger = None
+        try:
+            return asyncio.run(_bench_handlers(commands, count))
+        finally:
+            if bot.quota_ledger is not None:
+                bot.quota_ledger.close()
+                bot.quota_ledger = None
+            if bot.store is not None:
+                bot.store.close()
+                bot.store = None
+
+
+# Runs the bot with its data files in a scratch directory (the first argument).
+STARTUP_SCRIPT = """
+import os, sys
+scratch = sys.argv[1]
+sys.argv = ["main.py"]
+import main
+main.DATA_FILE = os.path.join(scratch, "user_data.json")
+main.DATABASE_FILE = os.path.join(scratch, "user_data.db")
+main.QUOTA_JOURNAL_FILE = os.path.join(scratch, "quota.journal")
+main.main()
+"""
+
+
+def bench_startup(runs: int, processes: int) -> dict:
+    """Cold start: time from launching the bot process to its reply to a queued /start.
+
+    The bot polls the fake Bot API from ``loadtest.py``; the /start update is
+    waiting before the process starts, so the reply marks the first handled update.
+    """
+    from loadtest import FAKE_TOKEN, FakeTelegramAPI, command_update
+
+    coldStarts = []
+    for run in range(runs):
+        api = FakeTelegramAPI()
+        api.start()
+        chatID = 9_000_000 + run
+        api.push_update(command_update(chatID, "/start"))
+        with tempfile.TemporaryDirectory() as scratch:
+            env = dict(
+                os.environ,
+                TELEGRAM_BOT_TOKEN=FAKE_TOKEN,
+                TELEGRAM_API_URL=api.base_url,
+                GENERATION_PROCESSES=str(processes),
+                STORE_BACKEND=storage.STORE_SQLITE,
+                REDIS_URL="",
+                METRICS_PORT="0",
+                CA_DIRECTORY=os.path.join(scratch, "ca"),
+            )
+            start = time.monotonic()
+            process = subprocess.Popen(
+                [sys.executable, "-c", STARTUP_SCRIPT, scratch],
+                cwd=keyboxGenerator.SCRIPT_DIR,
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            try:
+                replied = api.wait_for_reply(chatID, "sendMessage", 60)
+            finally:
+                process.terminate()
+                try:
+                    process.wait(10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+                api.stop()
+        if replied is None:
+            raise RuntimeError("the bot did not answer /start within 60 seconds")
+        coldStarts.append(replied - start)
+    result = percentiles(coldStarts)
+    return {"runs": runs, "processes": processes, "cold_start_ms": result["p50_ms"], "max_ms": max(coldStarts) * 1000}
+
+
+def bench_escape(iterations: int) -> dict:
+    import main as bot
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        bot.escape_markdown_v2(SAMPLE_MESSAGE)
+    elapsed = time.perf_counter() - start
+    return {"iterations": iterations, "calls_per_second": iterations / elapsed if elapsed > 0 else 0.0}
+
+
+def legacy_escape_markdown_v2(text: str) -> str:
+    """The per-character escaper the templates replaced, kept as the baseline."""
+    escape_chars = r"_*[]()~`>#+-=|{}.!"
+    return "".join(("\\" + char if char in escape_chars else char) for char in text)
+
+
+def bench_templates(iterations: int) -> dict:
+    """Calls per second of reply rendering: templates against escaping the whole text each time."""
+    import main as bot
+
+    start_text = (
+        "Hi {0}! 👋\n\n"
+        "Welcome to the Keybox Generator Bot! I can create `keybox.xml` files "
+        "used for Android device attestation.\n\n"
+        "Click the button below to get started, or use /help for more information."
+    )
+    limit_message = "👑 🔑 Keyboxes generated today: 3/5"
+    cases = {
+        "escape.legacy": lambda: legacy_escape_markdown_v2(SAMPLE_MESSAGE),
+        "escape.translate": lambda: bot.escape_markdown_v2(SAMPLE_MESSAGE),
+        "start.legacy": lambda: legacy_escape_markdown_v2(start_text.format("Bench_User")),
+        "start.template": lambda: bot.replies.render("start", first_name="Bench_User"),
+        "success.legacy": lambda: legacy_escape_markdown_v2(
+            f"✅ Keybox generated successfully!\n{limit_message}\nWhat would you like to do next?"
+        ),
+        "success.template": lambda: bot.replies.render("success", limit_message=limit_message),
+        "help.template": lambda: bot.replies.render("help"),
+    }
+    results = {}
+    for name, case in cases.items():
+        start = time.perf_counter()
+        for _ in range(iterations):
+            case()
+        elapsed = time.perf_counter() - start
+        results[name] = iterations / elapsed if elapsed > 0 else 0.0
+    return results
+
+
+def bench_verify(keyboxes: int) -> dict:
+    """Validates a ``keyboxes``-keybox document: keyboxes per second, peak heap and a cached repeat."""
+    import io
+
+    materials = [keyboxGenerator.generate_keybox_material() for _ in range(min(keyboxes, 10))]
+    materials = [material for material in materials if not isinstance(material, str)]
+    buffer = io.BytesIO()
+    with keyboxGenerator.KeyboxXmlWriter(buffer, keyboxes) as writer:
+        for index in range(keyboxes):
+            writer.add(*materials[index % len(materials)])
+    data = buffer.getvalue()
+    cache = keyboxGenerator.ValidationCache()
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        result = keyboxGenerator.validate_keybox(data)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    digest = keyboxGenerator.keybox_digest(data)
+    cache.put(digest, result)
+    start = time.perf_counter()
+    cache.get(keyboxGenerator.keybox_digest(data))
+    cachedElapsed = time.perf_counter() - start
+    return {
+        "keyboxes": keyboxes,
+        "document_kib": len(data) / 1024,
+        "valid": result["valid"],
+        "keyboxes_per_second": keyboxes / elapsed if elapsed > 0 else 0.0,
+        "peak_heap_kib": peak / 1024,
+        "cached_ms": cachedElapsed * 1000,
+    }
+
+
+def bench_memory(count: int, backend: str | None) -> dict:
+    """Peak Python heap while generating ``count`` keyboxes, and the process peak RSS."""
+    tracemalloc.start()
+    try:
+        for _ in range(count):
+            keyboxGenerator.generate_keybox_isolated(backend)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KiB on Linux, bytes on macOS
+    if sys.platform == "darwin":
+        maxRSS //= 1024
+    return {"count": count, "peak_heap_kib": peak / 1024, "max_rss_kib": maxRSS}
+
+
+def run_suite_benchmarks(args) -> dict:
+    """Runs a quick version of every benchmark; returns ``{name: {value, unit, better}}``."""
+    results = {}
+
+    def record(name: str, value: float, unit: str, better: str) -> None:
+        results[name] = {"value": value, "unit": unit, "better": better}
+        print(f"{name}: {value:.3f} {unit}")
+
+    for backend in keyboxGenerator.BACKENDS:
+        if keyboxGenerator.resolve_backend(backend) == backend:
+            result = bench_backend(backend, args.count)
+            record(f"keybox.{backend}.keyboxes_per_second", result["keyboxes_per_second"], "keyboxes/s", HIGHER)
+    if args.startup_runs > 0:
+        record("startup.cold_start_ms", bench_startup(args.startup_runs, 1)["cold_start_ms"], "ms", LOWER)
+    record("escape_markdown_v2.calls_per_second", bench_escape(args.escape_iterations)["calls_per_second"], "calls/s", HIGHER)
+    for name, callsPerSecond in bench_templates(args.escape_iterations).items():
+        if not name.endswith(".legacy"):
+            record(f"templates.{name}.calls_per_second", callsPerSecond, "calls/s", HIGHER)
+    verify = bench_verify(args.verify_keyboxes)
+    record("verify.keyboxes_per_second", verify["keyboxes_per_second"], "keyboxes/s", HIGHER)
+    record("verify.peak_heap_kib", verify["peak_heap_kib"], "KiB", LOWER)
+    for command, result in bench_handlers(count=args.handler_count).items():
+        name = command.lstrip("/").replace(" ", "_")
+        record(f"handler.{name}.p50_ms", result["p50_ms"], "ms", LOWER)
+        record(f"handler.{name}.p99_ms", result["p99_ms"], "ms", LOWER)
+        record(f"handler.{name}.api_calls", result["api_calls"], "calls", LOWER)
+    for users in (int(n) for n in args.users.split(",")):
+        for backend in (storage.STORE_SQLITE, storage.STORE_JSON_CACHED):
+            result = bench_store(backend, users, args.store_ops, args.budget)
+            record(f"store.{backend}.{users}.mean_ms", result["mean_ms"], "ms", LOWER)
+    memory = bench_memory(args.count, None)
+    record("memory.peak_heap_kib", memory["peak_heap_kib"], "KiB", LOWER)
+    record("memory.max_rss_kib", memory["max_rss_kib"], "KiB", LOWER)
+    return results
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=keyboxGenerator.SCRIPT_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(baseline: dict, current: dict, threshold: float) -> list:
+    """Returns one message per result that got worse than ``baseline`` by more than ``threshold``."""
+    regressions = []
+    for name, result in current["results"].items():
+        old = baseline["results"].get(name)
+        if not old or not old["value"]:
+            continue
+        change = (result["value"] - old["value"]) / old["value"]
+        worse = -change if result["better"] == HIGHER else change
+        if worse > threshold:
+            regressions.append(
+                f"{name}: {old['value']:.3f} -> {result['value']:.3f} {result['unit']} ({worse:+.0%} worse)"
+            )
+    return regressions
+
+
+def run_keybox(args) -> None:
+    if args.pool > 0 and keyboxGenerator.enable_key_pools(args.pool, args.pool):
+        time.sleep(1)  # let the refill workers make a head start
+
+    backends = keyboxGenerator.BACKENDS if args.backend == "all" else (args.backend,)
+    for backend in backends:
+        if keyboxGenerator.resolve_backend(backend) != backend:
+            print(f"{backend}: unavailable, skipped")
+            continue
+        result = bench_backend(backend, args.count)
+        print(
+            f"{backend}: {result['keyboxes_per_second']:.2f} keyboxes/s "
+            f"({result['count']} in {result['seconds']:.2f}s, {result['failures']} failures)"
+        )
+    for stats in keyboxGenerator.key_pool_stats():
+        print(
+            f"{stats['name']} pool: {stats['hits']} hits, {stats['misses']} misses "
+            f"({stats['hit_rate']:.0%} hit rate)"
+        )
+    keyboxGenerator.disable_key_pools()
+
+
+def run_store(args) -> None:
+    backends = storage.STORES if args.store == "all" else (args.store,)
+    for users in (int(n) for n in args.users.split(",")):
+        for backend in backends:
+            result = bench_store(backend, users, args.ops, args.budget)
+            print(
+                f"{backend} @ {users} users: {result['mean_ms']:.3f} ms mean, "
+                f"{result['p99_ms']:.3f} ms p99 ({result['ops']} requests)"
+            )
+
+
+def run_scaling(args) -> None:
+    baseline = None
+    for workers in (int(n) for n in args.workers.split(",")):
+        result = bench_scaling(workers, args.count, args.backend)
+        baseline = baseline or result["keyboxes_per_second"]
+        print(
+            f"{workers} worker(s): {result['keyboxes_per_second']:.2f} keyboxes/s "
+            f"({result['keyboxes_per_second'] / baseline:.2f}x, {result['failures']} failures)"
+        )
+
+
+def run_handlers(args) -> None:
+    for command, result in bench_handlers(count=args.count).items():
+        print(
+            f"{command}: p50 {result['p50_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms, "
+            f"mean {result['mean_ms']:.2f} ms, {result['api_calls']:.1f} Bot API calls"
+        )
+
+
+def run_startup(args) -> None:
+    result = bench_startup(args.runs, args.processes)
+    print(
+        f"cold start to first handled update: {result['cold_start_ms']:.0f} ms median, "
+        f"{result['max_ms']:.0f} ms max ({result['runs']} runs, {result['processes']} generation processes)"
+    )
+
+
+def run_templates(args) -> None:
+    results = bench_templates(args.iterations)
+    for name, callsPerSecond in results.items():
+        line = f"{name}: {callsPerSecond:,.0f} calls/s"
+        legacy = results.get(name.rsplit(".", 1)[0] + ".legacy")
+        if legacy and not name.endswith(".legacy"):
+            line += f" ({callsPerSecond / legacy:.1f}x legacy)"
+        print(line)
+
+
+def run_verify(args) -> None:
+    result = bench_verify(args.keyboxes)
+    print(
+        f"validated {result['keyboxes']} keyboxes ({result['document_kib']:.0f} KiB, "
+        f"{'valid' if result['valid'] else 'invalid'}): {result['keyboxes_per_second']:.0f} keyboxes/s, "
+        f"peak heap {result['peak_heap_kib']:.0f} KiB, cached repeat {result['cached_ms']:.2f} ms"
+    )
+
+
+def report_regressions(baseline: dict, current: dict, threshold: float) -> int:
+    regressions = compare_results(baseline, current, threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions:
+        print(f"No regressions beyond {threshold:.0%} against {baseline.get('revision') or 'the baseline'}.")
+    return 1 if regressions else 0
+
+
+def run_suite(args) -> None:
+    current = {
+        "revision": git_revision(),
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "results": run_suite_benchmarks(args),
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2)
+        print(f"Wrote {args.output}")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            sys.exit(report_regressions(json.load(f), current, args.threshold))
+
+
+def run_compare(args) -> None:
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.current, "r", encoding="utf-8") as f:
+        current = json.load(f)
+    sys.exit(report_regressions(baseline, current, args.threshold))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command")
+
+    keybox = commands.add_parser("keybox", help="keyboxes per second per backend")
+    keybox.add_argument("--count", type=int, default=20, help="keyboxes per backend")
+    keybox.add_argument(
+        "--backend",
+        choices=keyboxGenerator.BACKENDS + ("all",),
+        default="all",
+        help="backend to benchmark",
+    )
+    keybox.add_argument(
+        "--pool", type=int, default=0, help="pre-generated key pool size (0 disables the pools)"
+    )
+    keybox.set_defaults(func=run_keybox)
+
+    store = commands.add_parser("store", help="per-request user store latency")
+    store.add_argument("--users", default="1000,100000,1000000", help="comma-separated user counts")
+    store.add_argument("--store", choices=storage.STORES + ("all",), default="all")
+    store.add_argument("--ops", type=int, default=1000, help="requests per measurement")
+    store.add_argument("--budget", type=float, default=10.0, help="seconds per measurement")
+    store.set_defaults(func=run_store)
+
+    scaling = commands.add_parser("scaling", help="keyboxes per second from 1 to N processes")
+    scaling.add_argument(
+        "--workers",
+        default=",".join(str(n) for n in sorted({1, 2, os.cpu_count() or 1})),
+        help="comma-separated worker counts",
+    )
+    scaling.add_argument("--count", type=int, default=100, help="keyboxes per measurement")
+    scaling.add_argument("--backend", choices=keyboxGenerator.BACKENDS, default=None)
+    scaling.set_defaults(func=run_scaling)
+
+    handlers = commands.add_parser("handlers", help="end-to-end handler latency with a mocked Bot API")
+    handlers.add_argument("--count", type=int, default=20, help="updates per command")
+    handlers.set_defaults(func=run_handlers)
+
+    startup = commands.add_parser("startup", help="cold start to the first handled update")
+    startup.add_argument("--runs", type=int, default=5)
+    startup.add_argument(
+        "--processes", type=int, default=os.cpu_count() or 1, help="GENERATION_PROCESSES for the bot"
+    )
+    startup.set_defaults(func=run_startup)
+
+    templates = commands.add_parser("templates", help="reply rendering and MarkdownV2 escaping")
+    templates.add_argument("--iterations", type=int, default=100000)
+    templates.set_defaults(func=run_templates)
+
+    verify = commands.add_parser("verify", help="keybox.xml validation throughput and memory")
+    verify.add_argument("--keyboxes", type=int, default=1000, help="keyboxes in the validated document")
+    verify.set_defaults(func=run_verify)
+
+    suite = commands.add_parser("suite", help="quick run of every benchmark, written as JSON")
+    suite.add_argument("--output", help="write the results to this JSON file")
+    suite.add_argument("--baseline", help="JSON results to check for regressions against")
+    suite.add_argument("--threshold", type=float, default=0.25, help="allowed relative slowdown")
+    suite.add_argument("--count", type=int, default=20, help="keyboxes per backend")
+    suite.add_argument("--handler-count", type=int, default=20, help="updates per command")
+    suite.add_argument("--escape-iterations", type=int, default=100000)
+    suite.add_argument("--users", default="1000,100000", help="comma-separated user counts")
+    suite.add_argument("--store-ops", type=int, default=500, help="requests per store measurement")
+    suite.add_argument("--budget", type=float, default=5.0, help="seconds per store measurement")
+    suite.add_argument("--verify-keyboxes", type=int, default=200, help="keyboxes in the validated document")
+    suite.add_argument("--startup-runs", type=int, default=3, help="cold starts to measure (0 skips them)")
+    suite.set_defaults(func=run_suite)
+
+    compare = commands.add_parser("compare", help="check two suite results for regressions")
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+    compare.add_argument("--threshold", type=float, default=0.25, help="allowed relative slowdown")
+    compare.set_defaults(func=run_compare)
+
+    args = parser.parse_args()
+    if args.command is None:
+        args = parser.parse_args(["keybox"])
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""Local root and intermediate CA that signs keybox leaf certificates.
+
+The CA material is created once (or loaded from ``directory``) and kept in
+memory, so signing a leaf certificate costs one ECDSA signature instead of a
+new key hierarchy. ``rotate`` replaces the intermediate; other processes that
+share ``directory`` pick the new one up on their next reload check.
+``rotate_if_expiring`` does so ahead of the intermediate's expiry, since a leaf
+never outlives it and an expired intermediate cannot sign at all.
+"""
+
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+ROOT_KEY_FILE = "root.key.pem"
+ROOT_CERTIFICATE_FILE = "root.cert.pem"
+INTERMEDIATE_KEY_FILE = "intermediate.key.pem"
+INTERMEDIATE_CERTIFICATE_FILE = "intermediate.cert.pem"
+RELOAD_CHECK_SECONDS = 30
+
+
+class CertificateAuthorityExpired(Exception):
+    """The intermediate CA has expired, so it cannot sign leaf certificates."""
+
+
+def _name(commonName: str) -> x509.Name:
+    return x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, commonName)])
+
+
+def _pem(certificate: x509.Certificate) -> str:
+    return certificate.public_bytes(serialization.Encoding.PEM).decode("utf-8")
+
+
+def _write_private(path: str, data: bytes, mode: int) -> None:
+    """Writes ``data`` atomically with the given permissions."""
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".ca-", suffix=".tmp")
+    try:
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, path)
+    except BaseException:
+        try:
+            os.unlink(tmpPath)
+        except OSError:
+            pass
+        raise
+
+
+class CertificateAuthority:
+    def __init__(
+        self,
+        directory: str | None = None,
+        rootValidityDays: int = 7300,
+        intermediateValidityDays: int = 3650,
+        subject: str = "Keybox",
+    ):
+        self.directory = directory
+        self.rootValidityDays = rootValidityDays
+        self.intermediateValidityDays = intermediateValidityDays
+        self.subject = subject
+        self.rotations = 0
+        self._lock = threading.Lock()
+        self._root = None  # (key, certificate)
+        self._intermediate = None
+        self._chainPems = []
+        self._loadedMtime = None
+        self._nextReloadCheck = 0.0
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _build(self, subject: str, issuerName, signingKey, publicKey, days: int, pathLength, issuerPublicKey):
+        now = datetime.now(timezone.utc)
+        builder = (
+            x509.CertificateBuilder()
+            .subject_name(_name(subject))
+            .issuer_name(issuerName)
+            .public_key(publicKey)
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - timedelta(minutes=5))
+            .not_valid_after(now + timedelta(days=days))
+            .add_extension(x509.SubjectKeyIdentifier.from_public_key(publicKey), critical=False)
+            .add_extension(
+                x509.AuthorityKeyIdentifier.from_issuer_public_key(issuerPublicKey), critical=False
+            )
+            .add_extension(x509.BasicConstraints(ca=True, path_length=pathLength), critical=True)
+            .add_extension(
+                x509.KeyUsage(
+                    digital_signature=False,
+                    content_commitment=False,
+                    key_encipherment=False,
+                    data_encipherment=False,
+                    key_agreement=False,
+                    key_cert_sign=True,
+                    crl_sign=True,
+                    encipher_only=False,
+                    decipher_only=False,
+                ),
+                critical=True,
+            )
+        )
+        return builder.sign(signingKey, hashes.SHA256())
+
+    def _new_root(self) -> tuple:
+        key = ec.generate_private_key(ec.SECP256R1())
+        name = _name(f"{self.subject} Root CA")
+        certificate = self._build(
+            f"{self.subject} Root CA", name, key, key.public_key(), self.rootValidityDays, 1, key.public_key()
+        )
+        return key, certificate
+
+    def _new_intermediate(self, root: tuple) -> tuple:
+        rootKey, rootCertificate = root
+        key = ec.generate_private_key(ec.SECP256R1())
+        certificate = self._build(
+            f"{self.subject} Intermediate CA",
+            rootCertificate.subject,
+            rootKey,
+            key.public_key(),
+            self.intermediateValidityDays,
+            0,
+            rootKey.public_key(),
+        )
+        return key, certificate
+
+    def _save(self, keyFile: str, certificateFile: str, pair: tuple) -> None:
+        key, certificate = pair
+        _write_private(
+            self._path(keyFile),
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            ),
+            0o600,
+        )
+        _write_private(self._path(certificateFile), _pem(certificate).encode("utf-8"), 0o644)
+
+    def _load(self, keyFile: str, certificateFile: str) -> tuple | None:
+        try:
+            with open(self._path(keyFile), "rb") as f:
+                key = serialization.load_pem_private_key(f.read(), password=None)
+            with open(self._path(certificateFile), "rb") as f:
+                certificate = x509.load_pem_x509_certificate(f.read())
+        except FileNotFoundError:
+            return None
+        return key, certificate
+
+    def _intermediate_mtime(self) -> float | None:
+        try:
+            return os.stat(self._path(INTERMEDIATE_CERTIFICATE_FILE)).st_mtime
+        except OSError:
+            return None
+
+    def _activate(self, root: tuple, intermediate: tuple) -> None:
+        self._root = root
+        self._intermediate = intermediate
+        self._chainPems = [_pem(intermediate[1]), _pem(root[1])]
+
+    def load_or_create(self) -> None:
+        """Loads the CA from ``directory``, creating (and saving) whatever is missing."""
+        with self._lock:
+            root = intermediate = None
+            if self.directory:
+                os.makedirs(self.directory, mode=0o700, exist_ok=True)
+                root = self._load(ROOT_KEY_FILE, ROOT_CERTIFICATE_FILE)
+                if root is not None:
+                    intermediate = self._load(INTERMEDIATE_KEY_FILE, INTERMEDIATE_CERTIFICATE_FILE)
+            if root is None:
+                root = self._new_root()
+                if self.directory:
+                    self._save(ROOT_KEY_FILE, ROOT_CERTIFICATE_FILE, root)
+            if intermediate is None:
+                intermediate = self._new_intermediate(root)
+                if self.directory:
+                    self._save(INTERMEDIATE_KEY_FILE, INTERMEDIATE_CERTIFICATE_FILE, intermediate)
+            self._activate(root, intermediate)
+            self._loadedMtime = self._intermediate_mtime() if self.directory else None
+            self._nextReloadCheck = time.monotonic() + RELOAD_CHECK_SECONDS
+
+    def rotate(self, rotateRoot: bool = False) -> None:
+        """Replaces the intermediate (and optionally the root) CA."""
+        with self._lock:
+            root = self._new_root() if rotateRoot or self._root is None else self._root
+            intermediate = self._new_intermediate(root)
+            if self.directory:
+                if root is not self._root:
+                    self._save(ROOT_KEY_FILE, ROOT_CERTIFICATE_FILE, root)
+                self._save(INTERMEDIATE_KEY_FILE, INTERMEDIATE_CERTIFICATE_FILE, intermediate)
+                self._loadedMtime = self._intermediate_mtime()
+            self._activate(root, intermediate)
+            self.rotations += 1
+
+    def rotate_if_expiring(self, days: int) -> bool:
+        """Rotates the intermediate if it expires within ``days`` days."""
+        self._reload_if_rotated()  # another process may have rotated it already
+        with self._lock:
+            expires = self._intermediate[1].not_valid_after_utc if self._intermediate else None
+        if expires is None or expires - datetime.now(timezone.utc) < timedelta(days=days):
+            self.rotate()
+            return True
+        return False
+
+    def _reload_if_rotated(self) -> None:
+        if not self.directory or time.monotonic() < self._nextReloadCheck:
+            return
+        self._nextReloadCheck = time.monotonic() + RELOAD_CHECK_SECONDS
+        if self._intermediate_mtime() != self._loadedMtime:
+            self.load_or_create()
+
+    def sign_leaf(self, publicKey, validityDays: int, subject: str | None = None) -> tuple:
+        """Signs a leaf certificate for ``publicKey``.
+
+        Returns ``(leafPem, chainPems)`` where ``chainPems`` is the intermediate
+        followed by the root.
+        """
+        if self._intermediate is None:
+            self.load_or_create()
+        self._reload_if_rotated()
+        with self._lock:
+            intermediateKey, intermediateCertificate = self._intermediate
+            chainPems = list(self._chainPems)
+        now = datetime.now(timezone.utc)
+        if now >= intermediateCertificate.not_valid_after_utc:
+            raise CertificateAuthorityExpired(
+                f"the intermediate CA expired on {intermediateCertificate.not_valid_after_utc.isoformat()}"
+            )
+        # A leaf must not outlive the certificate that signed it.
+        notAfter = min(now + timedelta(days=validityDays), intermediateCertificate.not_valid_after_utc)
+        certificate = (
+            x509.CertificateBuilder()
+            .subject_name(_name(subject or self.subject))
+            .issuer_name(intermediateCertificate.subject)
+            .public_key(publicKey)
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now)
+            .not_valid_after(notAfter)
+            .add_extension(x509.SubjectKeyIdentifier.from_public_key(publicKey), critical=False)
+            .add_extension(
+                x509.AuthorityKeyIdentifier.from_issuer_public_key(intermediateKey.public_key()),
+                critical=False,
+            )
+            .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+            .sign(intermediateKey, hashes.SHA256())
+        )
+        return _pem(certificate), chainPems
+
+    def stats(self) -> dict:
+        with self._lock:
+            intermediate = self._intermediate[1] if self._intermediate else None
+        return {
+            "rotations": self.rotations,
+            "intermediate_serial": intermediate.serial_number if intermediate else None,
+            "intermediate_expires": intermediate.not_valid_after_utc.isoformat() if intermediate else None,
+        }
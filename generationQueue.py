@@ -0,0 +1,137 @@
+"""Bounded, fair job queue in front of the keybox generator.
+
+Waiting jobs are served round-robin across users, so one user with many
+requests cannot starve the others, and VIP jobs are always served before
+regular ones. Once ``maxDepth`` jobs are waiting, new jobs are rejected.
+"""
+
+import asyncio
+import contextvars
+import itertools
+from collections import OrderedDict, deque
+
+PRIORITY_VIP = 0
+PRIORITY_REGULAR = 1
+
+
+class Job:
+    def __init__(self, user_id, priority: int, func, args: tuple):
+        self.user_id = user_id
+        self.priority = priority
+        self.func = func
+        self.args = args
+        self.position = None  # place in line (1 = next); 0 when it is (about to be) running
+        self.positionChanged = asyncio.Event()
+        self.future = asyncio.get_running_loop().create_future()
+        self.context = contextvars.copy_context()  # the submitter's, e.g. its log trace ID
+
+
+class GenerationQueue:
+    """Runs jobs on ``workers`` worker tasks; ``run(func, *args)`` executes one job."""
+
+    def __init__(self, run, workers: int = 1, maxDepth: int = 100):
+        self.run = run
+        self.workers = max(1, int(workers))
+        self.maxDepth = max(1, int(maxDepth))
+        # one round-robin ring of per-user job deques per priority
+        self._rings = {PRIORITY_VIP: OrderedDict(), PRIORITY_REGULAR: OrderedDict()}
+        self._waiting = 0
+        self._running = 0
+        self._rejected = 0
+        self._idle = 0  # workers waiting for a job
+        self._available = None
+        self._tasks = []
+
+    def _ensure_started(self) -> None:
+        if self._tasks:
+            return
+        self._available = asyncio.Condition()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    def depth(self) -> int:
+        return self._waiting
+
+    def stats(self) -> dict:
+        return {
+            "waiting": self._waiting,
+            "running": self._running,
+            "rejected": self._rejected,
+            "max_depth": self.maxDepth,
+            "workers": self.workers,
+        }
+
+    async def submit(self, user_id, priority: int, func, *args) -> Job | None:
+        """Queues a job, or returns None when the queue is full."""
+        self._ensure_started()
+        if self._waiting >= self.maxDepth:
+            self._rejected += 1
+            return None
+        job = Job(user_id, priority, func, args)
+        ring = self._rings[priority]
+        ring.setdefault(user_id, deque()).append(job)
+        self._waiting += 1
+        self._update_positions()
+        async with self._available:
+            self._available.notify()
+        return job
+
+    def _pop(self) -> Job | None:
+        for priority in (PRIORITY_VIP, PRIORITY_REGULAR):
+            ring = self._rings[priority]
+            if ring:
+                user_id, jobs = next(iter(ring.items()))
+                job = jobs.popleft()
+                del ring[user_id]
+                if jobs:
+                    ring[user_id] = jobs  # back of the ring: the next user goes first
+                self._waiting -= 1
+                return job
+        return None
+
+    def _order(self):
+        """Yields waiting jobs in the order the workers will pick them up."""
+        for priority in (PRIORITY_VIP, PRIORITY_REGULAR):
+            queues = [list(jobs) for jobs in self._rings[priority].values()]
+            for round_ in itertools.zip_longest(*queues):
+                for job in round_:
+                    if job is not None:
+                        yield job
+
+    def _update_positions(self) -> None:
+        # the first ``_idle`` waiting jobs are about to be picked up by idle workers
+        for index, job in enumerate(self._order()):
+            position = max(0, index + 1 - self._idle)
+            if job.position != position:
+                job.position = position
+                job.positionChanged.set()
+
+    async def _work(self) -> None:
+        while True:
+            async with self._available:
+                self._idle += 1
+                try:
+                    await self._available.wait_for(lambda: self._waiting > 0)
+                finally:
+                    self._idle -= 1
+                job = self._pop()
+            job.position = 0
+            job.positionChanged.set()
+            self._update_positions()
+            self._running += 1
+            try:
+                # run in the submitter's context, not the long-lived worker task's
+                result = await job.context.run(asyncio.ensure_future, self.run(job.func, *job.args))
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self._running -= 1
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -0,0 +1,124 @@
+"""Bounded pools of pre-generated private keys with background refill.
+
+Keys only ever live in memory and every key is handed out exactly once.
+Hits, misses and generated keys are also counted in the metrics registry, so
+pools in worker processes show up at ``/metrics`` too.
+"""
+
+import threading
+import time
+from collections import deque
+
+import metrics
+
+poolRequests = metrics.counter(
+    "key_pool_requests_total", "Keys taken from a key pool, by whether one was ready.", ("pool", "result")
+)
+poolGenerated = metrics.counter("key_pool_generated_total", "Keys generated for a key pool.", ("pool",))
+
+
+class KeyPool:
+    """Keeps up to ``size`` keys ready and refills once only ``lowWater`` or fewer remain."""
+
+    def __init__(self, name: str, factory, size: int = 8, lowWater: int | None = None, refillWorkers: int = 1):
+        self.name = name
+        self.factory = factory
+        self.size = max(1, int(size))
+        self.lowWater = self.size // 2 if lowWater is None else min(max(0, int(lowWater)), self.size)
+        self.refillWorkers = max(1, int(refillWorkers))
+        self._keys = deque()
+        self._pending = 0  # keys being generated by the refill workers
+        self._condition = threading.Condition()
+        self._refilling = False
+        self._running = False
+        self._threads = []
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+
+    def start(self) -> None:
+        """Starts the refill workers."""
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+            self._refilling = True
+        self._threads = [
+            threading.Thread(target=self._refill, name=f"{self.name}-refill-{i}", daemon=True)
+            for i in range(self.refillWorkers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout: float | None = None) -> None:
+        """Stops the refill workers and discards the pooled keys."""
+        with self._condition:
+            self._running = False
+            self._keys.clear()
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def acquire(self):
+        """Pops a ready key, or generates one inline when the pool is empty."""
+        with self._condition:
+            if self._keys:
+                key = self._keys.popleft()
+                self.hits += 1
+            else:
+                key = None
+                self.misses += 1
+            if self._running and len(self._keys) <= self.lowWater and not self._refilling:
+                self._refilling = True
+                self._condition.notify_all()
+        poolRequests.inc(1, self.name, "miss" if key is None else "hit")
+        if key is None:
+            key = self.factory()
+            with self._condition:
+                self.generated += 1
+            poolGenerated.inc(1, self.name)
+        return key
+
+    def _refill(self) -> None:
+        while True:
+            with self._condition:
+                while self._running and not (
+                    self._refilling and len(self._keys) + self._pending < self.size
+                ):
+                    if self._refilling and self._pending == 0 and len(self._keys) >= self.size:
+                        self._refilling = False
+                    self._condition.wait()
+                if not self._running:
+                    return
+                self._pending += 1
+            try:
+                key = self.factory()
+            except Exception:
+                key = None
+                time.sleep(1)  # do not spin on a broken backend
+            with self._condition:
+                self._pending -= 1
+                stored = key is not None and self._running
+                if stored:
+                    self._keys.append(key)
+                    self.generated += 1
+                self._condition.notify_all()
+            if stored:
+                poolGenerated.inc(1, self.name)
+
+    def stats(self) -> dict:
+        """Returns the pool size and hit/miss counters."""
+        with self._condition:
+            requests = self.hits + self.misses
+            return {
+                "name": self.name,
+                "available": len(self._keys),
+                "size": self.size,
+                "low_water": self.lowWater,
+                "refill_workers": self.refillWorkers,
+                "hits": self.hits,
+                "misses": self.misses,
+                "generated": self.generated,
+                "hit_rate": self.hits / requests if requests else 0.0,
+            }
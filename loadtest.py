@@ -0,0 +1,258 @@
+"""Load test for the bot handlers against a local fake Telegram Bot API.
+
+Starts N keybox generations and, while they run, sends /help updates and
+reports the p50/p99 reply latency of those unrelated commands.
+
+Usage:
+    python loadtest.py [--generations N] [--probes M] [--interval SECONDS]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from telegram.ext import Application
+
+import main as bot
+
+FAKE_TOKEN = "123456:FAKE"
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256  # the default backlog of 5 stalls bursts of connections for 1s
+
+
+class FakeTelegramAPI:
+    """A minimal in-process Bot API: queues updates and records replies per chat."""
+
+    def __init__(self):
+        self.updates = []
+        self.replies = {}  # chat_id -> [(method, timestamp)]
+        self.condition = threading.Condition()
+        self.nextMessageID = 1
+        self.server = FakeServer(("127.0.0.1", 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return "http://127.0.0.1:{0}/bot".format(self.server.server_address[1])
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.condition.notify_all()
+        self.server.shutdown()
+
+    def push_update(self, update: dict) -> None:
+        with self.condition:
+            update["update_id"] = len(self.updates) + 1
+            self.updates.append(update)
+            self.condition.notify_all()
+
+    def wait_for_reply(self, chat_id: int, method: str, timeout: float) -> float | None:
+        """Returns the time of the first ``method`` reply to ``chat_id``."""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                for replyMethod, timestamp in self.replies.get(chat_id, []):
+                    if replyMethod == method:
+                        return timestamp
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def _get_updates(self, params: dict) -> list:
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                pending = [u for u in self.updates if u["update_id"] >= offset]
+                remaining = deadline - time.monotonic()
+                if pending or remaining <= 0:
+                    return pending
+                self.condition.wait(min(remaining, 0.5))
+
+    def _message(self, chat_id: int, params: dict) -> dict:
+        with self.condition:
+            self.nextMessageID += 1
+            messageID = self.nextMessageID
+        return {
+            "message_id": messageID,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": params.get("text", ""),
+        }
+
+    def call(self, method: str, params: dict):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        if method == "getUpdates":
+            return self._get_updates(params)
+        if method in ("deleteWebhook", "setWebhook", "answerCallbackQuery", "setMyCommands"):
+            return True
+        chat_id = int(params.get("chat_id") or 0)
+        with self.condition:
+            self.replies.setdefault(chat_id, []).append((method, time.monotonic()))
+            self.condition.notify_all()
+        return self._message(chat_id, params)
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                method = self.path.rsplit("/", 1)[-1]
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                result = api.call(method, parse_params(self.headers.get("Content-Type", ""), body))
+                payload = json.dumps({"ok": True, "result": result}).encode("utf-8")
+                try:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the bot dropped a long poll while shutting down
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def parse_params(contentType: str, body: bytes) -> dict:
+    """Decodes the JSON, form-encoded or multipart parameters of a Bot API call."""
+    if not body:
+        return {}
+    if contentType.startswith("application/json"):
+        return json.loads(body)
+    if contentType.startswith("multipart/form-data"):
+        return {
+            name.decode(): value.decode(errors="replace")
+            for name, value in re.findall(rb'name="([^"]+)"\r\n\r\n([^\r]*)\r\n', body)
+        }
+    return {
+        key: (values[0].strip('"') if values else "")
+        for key, values in parse_qs(body.decode("utf-8")).items()
+    }
+
+
+def command_update(chat_id: int, command: str) -> dict:
+    return {
+        "message": {
+            "message_id": chat_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Load"},
+            "text": command,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        }
+    }
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+async def probe_help(api: FakeTelegramAPI, firstChat: int, probes: int, interval: float) -> list:
+    """Sends /help ``probes`` times and returns the reply latencies in milliseconds."""
+    latencies = []
+    for i in range(probes):
+        chat_id = firstChat + i
+        sent = time.monotonic()
+        api.push_update(command_update(chat_id, "/help"))
+        replied = await asyncio.to_thread(api.wait_for_reply, chat_id, "sendMessage", 30)
+        if replied is not None:
+            latencies.append((replied - sent) * 1000)
+        await asyncio.sleep(interval)
+    return latencies
+
+
+async def run(generations: int, probes: int, interval: float) -> dict:
+    api = FakeTelegramAPI()
+    api.start()
+    application = (
+        Application.builder()
+        .token(FAKE_TOKEN)
+        .base_url(api.base_url)
+        .concurrent_updates(bot.CONCURRENT_UPDATES)
+        .build()
+    )
+    bot.register_handlers(application)
+    if bot.GENERATION_PROCESSES > 0:
+        await asyncio.to_thread(bot.get_worker_pool().start)
+    await application.initialize()
+    await application.start()
+    await application.updater.start_polling(poll_interval=0, timeout=1)
+    try:
+        idle = await probe_help(api, 1_000_000, probes, interval)
+
+        generationStart = time.monotonic()
+        for i in range(generations):
+            api.push_update(command_update(2_000_000 + i, "/generate"))
+        busy = await probe_help(api, 3_000_000, probes, interval)
+        done = [
+            await asyncio.to_thread(api.wait_for_reply, 2_000_000 + i, "sendDocument", 120)
+            for i in range(generations)
+        ]
+        completed = [t for t in done if t is not None]
+        generationSeconds = (max(completed) - generationStart) if completed else float("nan")
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        api.stop()
+        if bot.worker_pool is not None:
+            bot.worker_pool.shutdown()
+    return {
+        "generations": generations,
+        "generations_completed": len(completed),
+        "generation_seconds": generationSeconds,
+        "idle_p50_ms": percentile(idle, 0.5),
+        "idle_p99_ms": percentile(idle, 0.99),
+        "busy_p50_ms": percentile(busy, 0.5),
+        "busy_p99_ms": percentile(busy, 0.99),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--generations", type=int, default=8, help="concurrent /generate updates")
+    parser.add_argument("--probes", type=int, default=20, help="/help updates per phase")
+    parser.add_argument("--interval", type=float, default=0.05, help="seconds between probes")
+    args = parser.parse_args()
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as scratch:
+        bot.DATA_FILE = os.path.join(scratch, "user_data.json")
+        bot.DATABASE_FILE = os.path.join(scratch, "user_data.db")
+        bot.QUOTA_JOURNAL_FILE = os.path.join(scratch, "quota.journal")
+        result = asyncio.run(run(args.generations, args.probes, args.interval))
+    print(
+        "/help latency while idle: p50 {idle_p50_ms:.1f} ms, p99 {idle_p99_ms:.1f} ms\n"
+        "/help latency during {generations} generations: p50 {busy_p50_ms:.1f} ms, "
+        "p99 {busy_p99_ms:.1f} ms\n"
+        "{generations_completed}/{generations} keyboxes delivered in {generation_seconds:.2f}s".format(
+            **result
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Logging for the bot and its workers: queued JSON lines, trace IDs, sampling, redaction.
+
+``configure`` puts a ``QueueHandler`` on the root logger, so logging a record
+only filters it and appends it to a queue; a ``QueueListener`` thread formats
+and writes it to stderr, off the event loop. Each record carries the
+``traceID`` of the update being handled. Generation jobs carry it into the
+worker processes, so one update's lines can be found across processes.
+
+``sampleRate`` keeps that share of the records below WARNING. The decision is
+made per trace, so a sampled update is logged completely. Private keys (PEM
+blocks) and bot tokens are replaced before a line is written.
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import sys
+import uuid
+import zlib
+
+FORMAT_JSON = "json"
+FORMAT_TEXT = "text"
+FORMATS = (FORMAT_JSON, FORMAT_TEXT)
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(trace_id)s - %(message)s"
+NOISY_LOGGERS = ("httpx", "httpcore")  # a line per Bot API call at INFO
+SAMPLE_BUCKETS = 10000
+
+traceID = contextvars.ContextVar("traceID", default=None)
+_listener = None
+
+_PRIVATE_KEY = re.compile(r"-----BEGIN ([A-Z0-9 ]*)PRIVATE KEY-----.*?(?:-----END \1PRIVATE KEY-----|\Z)", re.S)
+_BOT_TOKEN = re.compile(r"(?<!\d)(\d{5,}):[A-Za-z0-9_-]{30,}")  # also inside .../bot<token>/...
+# attributes every LogRecord has; anything else came in through ``extra``
+_RECORD_ATTRIBUTES = frozenset(logging.makeLogRecord({}).__dict__) | {"message", "asctime", "trace_id"}
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def redact(text: str) -> str:
+    """Replaces PEM private keys and bot tokens in ``text``."""
+    if "PRIVATE KEY" in text:
+        text = _PRIVATE_KEY.sub("[private key redacted]", text)
+    if ":" in text:
+        text = _BOT_TOKEN.sub(r"\1:[token redacted]", text)
+    return text
+
+
+class ContextFilter(logging.Filter):
+    """Runs where the record is logged: stamps the trace ID and applies sampling."""
+
+    def __init__(self, sampleRate: float = 1.0):
+        super().__init__()
+        self.sampleRate = sampleRate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        trace = traceID.get()
+        record.trace_id = trace
+        if self.sampleRate >= 1.0 or record.levelno >= logging.WARNING:
+            return True
+        if trace is None:
+            return random.random() < self.sampleRate
+        return zlib.crc32(trace.encode("ascii")) % SAMPLE_BUCKETS < self.sampleRate * SAMPLE_BUCKETS
+
+
+class RedactingFilter(logging.Filter):
+    """Runs on the listener thread: merges the message and redacts it and the traceback."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.msg = redact(record.getMessage())
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        if record.exc_text:
+            record.exc_text = redact(record.exc_text)
+        if not hasattr(record, "trace_id"):
+            record.trace_id = None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg, trace_id, exc and any ``extra`` fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.trace_id:
+            entry["trace_id"] = record.trace_id
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        for name, value in record.__dict__.items():
+            if name not in _RECORD_ATTRIBUTES:
+                entry[name] = redact(value) if isinstance(value, str) else value
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record  # formatting is the listener's job, not the caller's
+
+
+def _stop_listener() -> None:
+    global _listener
+    if _listener is not None:
+        _listener.stop()  # writes out whatever is still queued
+        _listener = None
+
+
+def configure(logFormat: str = FORMAT_JSON, level: str = "INFO", sampleRate: float = 1.0, stream=None) -> None:
+    """Routes all logging through the queue; safe to call again (e.g. in a worker)."""
+    global _listener
+    _stop_listener()
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.addFilter(RedactingFilter())
+    output.setFormatter(JsonFormatter() if logFormat == FORMAT_JSON else logging.Formatter(TEXT_FORMAT))
+    records = queue.SimpleQueue()
+    handler = _QueueHandler(records)
+    handler.addFilter(ContextFilter(sampleRate))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper())
+    for name in NOISY_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+
+
+atexit.register(_stop_listener)
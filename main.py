@@ -1,10 +1,24 @@
+import time
+
+STARTED = time.perf_counter()  # the startup profile is measured from here
+
+import argparse
+import asyncio
+import contextvars
+import functools
 import logging
+import math
 import os
-import json
-import time
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
+from io import BytesIO
 
-from telegram import Update, ForceReply, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram import Bot, Update, ForceReply, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.error import TelegramError
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -14,49 +28,345 @@ from telegram.ext import (
     CallbackQueryHandler,
 )
 from dotenv import load_dotenv
-import keyboxGenerator
+import generationQueue
+import logConfig
+import metrics
+import quotaLedger
+import rateLimiter
+import telegramRequest
+import templates
+
+# keyboxGenerator (cryptography, the CA, the archive writers), storage,
+# sharedState and workerPool are imported by the functions that use them, so
+# that --check and the path to polling do not pay for them up front
+
+# Load environment variables
+load_dotenv()
 
 # Enable logging
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
+LOG_FORMAT = os.getenv("LOG_FORMAT", logConfig.FORMAT_JSON).lower()  # json or text
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1"))  # share of updates logged below WARNING
+logConfig.configure(LOG_FORMAT, LOG_LEVEL, LOG_SAMPLE_RATE)
 logger = logging.getLogger(__name__)
 
 # --- Constants and Configuration ---
 ADMIN_USER_ID = 5685799208  # Replace with your actual user ID
-DAILY_LIMIT = 5
-LIMIT_DURATION_HOURS = 24
-DATA_FILE = "user_data.json"
+DATA_FILE = os.path.join(os.path.abspath(os.path.dirname(__file__)), "user_data.json")
+DATABASE_FILE = os.path.join(os.path.abspath(os.path.dirname(__file__)), "user_data.db")
+QUOTA_JOURNAL_FILE = os.path.join(
+    os.path.abspath(os.path.dirname(__file__)), os.getenv("QUOTA_JOURNAL", "quota.journal")
+)  # one per instance
 
-# Load environment variables
-load_dotenv()
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # e.g. a local Bot API server, http://127.0.0.1:8081/bot
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "64"))  # pooled Bot API connections
+TELEGRAM_TIMEOUT = float(os.getenv("TELEGRAM_TIMEOUT", "10"))  # connect/read/write, per Bot API call
+TELEGRAM_POOL_TIMEOUT = float(os.getenv("TELEGRAM_POOL_TIMEOUT", "5"))  # waiting for a free connection
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))  # retries after a 429 reply
+TELEGRAM_MAX_RETRY_AFTER = float(os.getenv("TELEGRAM_MAX_RETRY_AFTER", "30"))  # longer waits are not retried
+DAILY_LIMIT = int(os.getenv("DAILY_LIMIT", "5"))
+VIP_DAILY_LIMIT = int(os.getenv("VIP_DAILY_LIMIT", "0"))  # 0 means unlimited
+LIMIT_DURATION_HOURS = int(os.getenv("LIMIT_DURATION_HOURS", "24"))
+RATE_LIMIT_STRATEGY = os.getenv("RATE_LIMIT_STRATEGY", rateLimiter.STRATEGY_SLIDING_WINDOW)
+GLOBAL_LIMIT_PER_MINUTE = int(os.getenv("GLOBAL_LIMIT_PER_MINUTE", "0"))  # 0 disables it
+RATE_LIMIT_SWEEP_SECONDS = 600  # how often users with no usage left are dropped from the limiter
+QUEUE_MAX_DEPTH = int(os.getenv("QUEUE_MAX_DEPTH", "100"))
+BATCH_MAX_KEYBOXES = int(os.getenv("BATCH_MAX_KEYBOXES", "50"))
+BATCH_XML = "xml"
+BATCH_SPOOL_BYTES = 1024 * 1024  # larger batch documents are spooled to a temporary file
+BATCH_FORMATS = ("zip", "tar.gz", BATCH_XML)  # keyboxGenerator.ARCHIVE_FORMATS, plus xml
+QUEUE_UPDATE_INTERVAL = float(os.getenv("QUEUE_UPDATE_INTERVAL", "2"))  # seconds between position edits
+KEY_POOL_RSA_SIZE = int(os.getenv("KEY_POOL_RSA_SIZE", "8"))
+KEY_POOL_EC_SIZE = int(os.getenv("KEY_POOL_EC_SIZE", "8"))
+KEY_POOL_LOW_WATER_RATIO = float(os.getenv("KEY_POOL_LOW_WATER_RATIO", "0.5"))
+KEY_POOL_REFILL_WORKERS = int(os.getenv("KEY_POOL_REFILL_WORKERS", "1"))
+GENERATION_PROCESSES = int(os.getenv("GENERATION_PROCESSES", str(os.cpu_count() or 1)))  # 0 uses threads
+GENERATION_CONCURRENCY = int(
+    os.getenv("GENERATION_CONCURRENCY", str(GENERATION_PROCESSES or os.cpu_count() or 1))
+)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+MODE_POLLING = "polling"
+MODE_WEBHOOK = "webhook"
+BOT_MODE = os.getenv("BOT_MODE", MODE_POLLING).lower()
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public base URL Telegram posts to, e.g. https://bot.example.com
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN") or None
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))  # 0 disables the /metrics endpoint
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+REDIS_URL = os.getenv("REDIS_URL")  # shares records, quotas and admin state between instances
+STORE_BACKEND = os.getenv(
+    "STORE_BACKEND", "redis" if REDIS_URL else "sqlite"  # storage.STORE_REDIS / STORE_SQLITE
+)
+STORE_FLUSH_INTERVAL = float(os.getenv("STORE_FLUSH_INTERVAL", "5"))
+STORE_FLUSH_THRESHOLD = int(os.getenv("STORE_FLUSH_THRESHOLD", "100"))
+CERTIFICATE_AUTHORITY = os.getenv("CERTIFICATE_AUTHORITY", "1") == "1"  # 0 self-signs certificates
+CA_DIRECTORY = os.path.join(
+    os.path.abspath(os.path.dirname(__file__)), os.getenv("CA_DIRECTORY", "ca")
+)
+CA_ROOT_VALIDITY_DAYS = int(os.getenv("CA_ROOT_VALIDITY_DAYS", "7300"))
+CA_INTERMEDIATE_VALIDITY_DAYS = int(os.getenv("CA_INTERMEDIATE_VALIDITY_DAYS", "3650"))
+CA_ROTATE_BEFORE_DAYS = int(os.getenv("CA_ROTATE_BEFORE_DAYS", "365"))  # 0 leaves rotation to the admin
+CA_ROTATION_CHECK_SECONDS = 24 * 3600
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", "20"))
+ADMIN_ACTIVE_HOURS = int(os.getenv("ADMIN_ACTIVE_HOURS", "24"))  # window of the "Active" user filter
+QUOTA_JOURNAL_SYNC = os.getenv("QUOTA_JOURNAL_SYNC", "1") == "1"  # 0 skips the fsync per commit
+STORE_RETENTION_HOURS = float(os.getenv("STORE_RETENTION_HOURS", "24"))  # between compactions, 0 disables them
+STORE_ARCHIVE = os.getenv("STORE_ARCHIVE", "1") == "1"  # 0 deletes expired users without a copy
+STORE_ARCHIVE_DIRECTORY = os.path.join(
+    os.path.abspath(os.path.dirname(__file__)), os.getenv("STORE_ARCHIVE_DIRECTORY", "archive")
+)
+STORE_RETENTION_FIRST_RUN = 300  # seconds after startup, so the first run never slows startup down
+BULK_MAX_BYTES = 20 * 1024 * 1024  # the largest file the Bot API lets bots download
+VERIFY_MAX_BYTES = int(os.getenv("VERIFY_MAX_BYTES", str(5 * 1024 * 1024)))
+VERIFY_LIMIT = int(os.getenv("VERIFY_LIMIT", "20"))  # uncached checks per user and hour, 0 means unlimited
+VERIFY_LISTED_PROBLEMS = 10  # errors and warnings listed in a /verify reply
+
+TIER_REGULAR = "regular"
+TIER_VIP = "vip"
+TIER_VERIFY = "verify"  # charged to a separate key, see verify_quota_key
+TIER_LIMITS = {
+    TIER_REGULAR: (DAILY_LIMIT, LIMIT_DURATION_HOURS * 3600),
+    TIER_VIP: (VIP_DAILY_LIMIT, LIMIT_DURATION_HOURS * 3600),
+    TIER_VERIFY: (VERIFY_LIMIT, 3600),
+}
+
+generation_executor = None
+blocking_executor = None
+worker_pool = None
+if REDIS_URL:
+    import sharedState
+
+    shared_state = sharedState.RespClient.from_url(REDIS_URL)
+    rate_limiter = rateLimiter.SharedRateLimiter(
+        shared_state, TIER_LIMITS, GLOBAL_LIMIT_PER_MINUTE, 60
+    )
+else:
+    shared_state = None
+    rate_limiter = rateLimiter.RateLimiter(
+        RATE_LIMIT_STRATEGY, TIER_LIMITS, GLOBAL_LIMIT_PER_MINUTE, 60
+    )
+conversation_state = None
+generation_queue = None
+
+# --- Metrics ---
+
+STAGE_UPLOAD = "upload"
+handler_seconds = metrics.histogram(
+    "handler_seconds", "Time to handle an update, per handler.", ("handler",)
+)
+handler_errors = metrics.counter(
+    "handler_errors_total", "Handlers that raised an exception.", ("handler",)
+)
+quota_rejections = metrics.counter(
+    "quota_rejections_total", "Generation requests denied by a rate limit.", ("scope",)
+)
+queue_rejections = metrics.counter(
+    "queue_rejections_total", "Generation requests rejected because the queue was full."
+)
+keyboxes_sent = metrics.counter("keyboxes_sent_total", "Keyboxes delivered to users.")
+keyboxes_verified = metrics.counter(
+    "keyboxes_verified_total", "Uploaded keybox.xml files checked with /verify.", ("result",)
+)
+users_purged = metrics.counter("store_users_purged_total", "Expired users removed by store compaction.")
+startup_seconds = metrics.gauge(
+    "bot_startup_seconds", "Seconds spent in each startup phase, and until ready and the first update.", ("phase",)
+)
+startup_phases = []  # [(phase, seconds)] in order
+first_update_seconds = None
+metrics.gauge("generation_queue_depth", "Jobs waiting in the generation queue.").set_function(
+    lambda: generation_queue.depth() if generation_queue is not None else 0
+)
+metrics.gauge("generation_jobs_running", "Jobs being generated right now.").set_function(
+    lambda: generation_queue.stats()["running"] if generation_queue is not None else 0
+)
+
+
+def instrumented(name, callback):
+    """Wraps a handler callback to record its latency and errors."""
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        global first_update_seconds
+        start = time.perf_counter()
+        # each update runs in its own task, so this stays with it (and PTB's error log)
+        logConfig.traceID.set(logConfig.new_trace_id())
+        logger.debug("Handling %s", name, extra={"update_id": getattr(update, "update_id", None)})
+        try:
+            return await callback(update, context)
+        except Exception:
+            handler_errors.inc(1, name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - start, name)
+            if first_update_seconds is None:
+                first_update_seconds = time.perf_counter() - STARTED
+                startup_seconds.set(first_update_seconds, "first_update")
+                logger.info("First update handled %.2fs after start", first_update_seconds)
+
+    return wrapper
+
+
+@contextmanager
+def startup_phase(name):
+    """Times one step of ``main()`` for the startup profile."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        startup_phases.append((name, seconds))
+        startup_seconds.set(seconds, name)
+
+
+async def log_startup_profile(application: Application) -> None:
+    """post_init hook: logs where the time between start and ready went."""
+    ready = time.perf_counter() - STARTED
+    startup_seconds.set(ready, "ready")
+    logger.info(
+        "Startup profile: %s; ready after %.2fs",
+        ", ".join(f"{name} {seconds:.3f}s" for name, seconds in startup_phases),
+        ready,
+    )
+
+
+def log_capabilities() -> None:
+    """Probes the generation backends off the startup path and warns about missing ones."""
+    import keyboxGenerator
+    capabilities = keyboxGenerator.probe_capabilities()
+    backend = keyboxGenerator.resolve_backend()
+    logger.info(
+        "Generation backend: %s (cryptography: %s, openssl: %s)",
+        backend,
+        "yes" if capabilities["cryptography"] else "no",
+        capabilities["openssl"] or "not found",
+    )
+    if backend == keyboxGenerator.BACKEND_OPENSSL and not capabilities["openssl"]:
+        logger.warning("Neither the cryptography package nor the openssl command is available; generation will fail.")
 
 # --- Data Management Functions ---
 
+store = None
+
+
+def get_conversation_state():
+    """Creates the admin conversation state on first use (shared through Redis when configured)."""
+    global conversation_state
+    if conversation_state is None:
+        import sharedState
+
+        conversation_state = (
+            sharedState.SharedConversationState(shared_state)
+            if shared_state is not None
+            else sharedState.LocalConversationState()
+        )
+    return conversation_state
+
+
+def get_store():
+    """Opens the user store on first use."""
+    global store
+    import storage
+    if store is None:
+        store = storage.open_store(
+            STORE_BACKEND,
+            DATABASE_FILE,
+            DATA_FILE,
+            STORE_FLUSH_INTERVAL,
+            STORE_FLUSH_THRESHOLD,
+            REDIS_URL,
+        )
+    return store
+
+quota_ledger = None
+
+
+def get_quota_ledger():
+    """Opens the quota journal on first use, settling what the last run left open."""
+    global quota_ledger
+    if quota_ledger is None:
+        ledger = quotaLedger.QuotaLedger(rate_limiter, get_store(), QUOTA_JOURNAL_FILE, QUOTA_JOURNAL_SYNC)
+        ledger.replay()
+        quota_ledger = ledger
+    return quota_ledger
+
+last_compaction = None  # the report of the last store compaction
+compaction_lock = asyncio.Lock()
+
+
+async def compact_user_store(context: CallbackContext | None = None) -> dict | None:
+    """Drops expired non-VIP users and compacts the store; returns the report, or None if one is running.
+
+    Runs on the job queue every STORE_RETENTION_HOURS. A user expires once
+    both their quota window and the admin "Active" window are over, so the
+    user list never loses someone it would still show.
+    """
+    global last_compaction
+    import storage
+    if compaction_lock.locked():
+        return None
+    async with compaction_lock:
+        expired_before = int(time.time()) - max(LIMIT_DURATION_HOURS, ADMIN_ACTIVE_HOURS) * 3600
+        loop = asyncio.get_running_loop()
+        report = await loop.run_in_executor(
+            None,
+            storage.compact_store,
+            get_store(),
+            expired_before,
+            STORE_ARCHIVE_DIRECTORY if STORE_ARCHIVE else None,
+        )
+    users_purged.inc(report["removed"])
+    last_compaction = report
+    logger.info(
+        "Store compaction: removed %d users, %s -> %s bytes, load %.1f -> %.1f ms",
+        report["removed"],
+        report["bytes_before"],
+        report["bytes_after"],
+        report["load_seconds_before"] * 1000,
+        report["load_seconds_after"] * 1000,
+    )
+    return report
+
+
+async def sweep_rate_limiter(context: CallbackContext) -> None:
+    """Drops the limiter state of users whose window has expired (job queue)."""
+    removed = await run_blocking(rate_limiter.sweep)
+    if removed:
+        logger.debug("Rate limiter sweep dropped %d entries", removed)
+
+
 def load_data():
-    """Loads user data from the JSON file."""
-    try:
-        with open(DATA_FILE, "r") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
+    """Loads all user records."""
+    return get_store().load_all()
 
 def save_data(data):
-    """Saves user data to the JSON file."""
-    with open(DATA_FILE, "w") as f:
-        json.dump(data, f, indent=4)
-
-def get_user_data(user_id, data):
-    """Gets user data, creating a default entry if needed."""
-    user_id_str = str(user_id)  # Ensure string for JSON keys
-    if user_id_str not in data:
-        data[user_id_str] = {
-            "count": 0,
-            "last_reset": int(time.time()),  # Unix timestamp
-            "vip": False
-        }
-    return data[user_id_str]
+    """Saves several user records in one transaction."""
+    get_store().save_all(data)
+
+def get_user_data(user_id):
+    """Gets a user's record, or a default record for a new user."""
+    return get_store().get_user(user_id)
+
+def save_user_data(user_id, user_data):
+    """Saves a single user's record."""
+    get_store().save_user(user_id, user_data)
+
+def record_generations(user_id, user_data, reset_from, reservation, amount=None):
+    """Commits ``amount`` generated keyboxes (default: the whole reservation) to the user's count.
+
+    ``reset_from`` is the ``last_reset`` of the expired window that
+    ``check_and_reset_limit`` replaced, or None. The store starts the new
+    window only if nobody else has since, and the increment is atomic, so
+    concurrent requests (possibly on other instances) never overwrite each
+    other's counts or admin changes. The commit is journaled before the
+    store is updated, so a crash cannot lose one.
+    """
+    if reset_from is not None:
+        get_store().reset_window(user_id, reset_from, user_data["last_reset"])
+    user_data["count"] = get_quota_ledger().commit(reservation, amount)
 
 
 def check_and_reset_limit(user_data):
@@ -72,169 +382,372 @@ def check_and_reset_limit(user_data):
     return False
 
 
-def escape_markdown_v2(text: str) -> str:
-    """Escapes special characters for MarkdownV2."""
-    escape_chars = r"_*[]()~`>#+-=|{}.!"
-    return "".join(("\\" + char if char in escape_chars else char) for char in text)
+def get_worker_pool():
+    """Creates the generation process pool on first use (GENERATION_PROCESSES workers)."""
+    global worker_pool
+    import workerPool
+    if worker_pool is None:
+        worker_pool = workerPool.GenerationWorkerPool(
+            GENERATION_PROCESSES,
+            (KEY_POOL_RSA_SIZE, KEY_POOL_EC_SIZE, KEY_POOL_LOW_WATER_RATIO, KEY_POOL_REFILL_WORKERS),
+            (
+                (CA_DIRECTORY, CA_ROOT_VALIDITY_DAYS, CA_INTERMEDIATE_VALIDITY_DAYS)
+                if CERTIFICATE_AUTHORITY
+                else None
+            ),
+            (LOG_FORMAT, LOG_LEVEL, LOG_SAMPLE_RATE),
+        )
+    return worker_pool
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Runs a store, quota or shared-state call off the event loop.
+
+    With REDIS_URL each of these is a network round trip, and SQLite and the
+    quota journal can wait on locks and the disk; meanwhile the loop keeps
+    serving other updates.
+    """
+    global blocking_executor
+    if blocking_executor is None:
+        blocking_executor = ThreadPoolExecutor(
+            max_workers=min(32, CONCURRENT_UPDATES), thread_name_prefix="blocking"
+        )
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()  # keeps the trace ID on the thread
+    return await loop.run_in_executor(
+        blocking_executor, functools.partial(context.run, func, *args, **kwargs)
+    )
+
+
+async def run_generation(func, *args):
+    """Runs a blocking keybox generation call off the event loop.
+
+    Generation runs in the worker processes, or on a thread pool in this
+    process when GENERATION_PROCESSES is 0. The generation queue runs at most
+    GENERATION_CONCURRENCY jobs at once, so extra requests wait their turn
+    instead of piling up openssl processes.
+    """
+    if GENERATION_PROCESSES > 0:
+        return await get_worker_pool().run(func, *args)
+    global generation_executor
+    if generation_executor is None:
+        generation_executor = ThreadPoolExecutor(
+            max_workers=GENERATION_CONCURRENCY, thread_name_prefix="keybox"
+        )
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()  # keeps the trace ID on the thread
+    return await loop.run_in_executor(generation_executor, functools.partial(context.run, func, *args))
+
+
+def get_generation_queue():
+    """Creates the generation queue on first use (GENERATION_CONCURRENCY workers)."""
+    global generation_queue
+    if generation_queue is None:
+        generation_queue = generationQueue.GenerationQueue(
+            run_generation, GENERATION_CONCURRENCY, QUEUE_MAX_DEPTH
+        )
+    return generation_queue
+
+
+async def wait_for_job(job, status_message, limit_message: str):
+    """Waits for a queued generation and keeps the user's queue position up to date."""
+    shown = 0  # the status message already says "Generating"
+    while not job.future.done():
+        job.positionChanged.clear()
+        if job.position != shown and hasattr(status_message, "edit_text"):
+            shown = job.position
+            text = (
+                "Generating keybox.xml..."
+                if shown == 0
+                else f"⏳ Waiting in queue, position {shown}..."
+            )
+            try:
+                await status_message.edit_text(f"{text}\n{limit_message}")
+            except TelegramError:
+                pass  # e.g. the message was deleted; the result is still sent
+            # edit at most once per QUEUE_UPDATE_INTERVAL
+            await asyncio.wait({job.future}, timeout=QUEUE_UPDATE_INTERVAL)
+            continue
+        changed = asyncio.ensure_future(job.positionChanged.wait())
+        await asyncio.wait({job.future, changed}, return_when=asyncio.FIRST_COMPLETED)
+        changed.cancel()
+    return job.future.result()
+
+
+escape_markdown_v2 = templates.escape_markdown_v2
+
+# --- Reply Templates ---
+# Registered once at startup: the literal text is escaped here, so a reply
+# only escapes the per-user fields, and the keyboards are shared.
+
+replies = templates.TemplateRegistry()
+replies.add_message(
+    "start",
+    "Hi {first_name}! 👋\n\n"
+    "Welcome to the Keybox Generator Bot! I can create `keybox.xml` files "
+    "used for Android device attestation.\n\n"
+    "Click the button below to get started, or use /help for more information.",
+)
+replies.add_keyboard("start", [[("Generate Keybox", "generate")]])
+replies.add_message(
+    "help",
+    "This bot generates Android keybox.xml files.\n\n"
+    "**Commands:**\n\n"
+    "/start - Start the bot and see the welcome message.\n"
+    "/generate - Create a new keybox.xml file.\n"
+    "/generate N - (VIP) Create N keyboxes in one zip (add tar.gz for a tarball, or xml for a single keybox.xml).\n"
+    "/verify - Check an uploaded keybox.xml (keys, certificate chains and counts).\n"
+    "/help - Show this help message.\n\n"
+    "Click the button below to view the source code on GitHub.",
+)
+replies.add_keyboard(
+    "help",
+    [[("View Source Code (GitHub)", {"url": "https://github.com/CRZX1337/Keybox-Generator-Telegram-Bot"})]],
+)
+replies.add_message(
+    "limit_global", "⏳ The generator is busy right now.\nPlease try again in: {time_remaining}"
+)
+replies.add_message(
+    "limit_user",
+    "❌ You have reached your limit of {limit} keyboxes per {hours} hours.\n"
+    "Time remaining until your next keybox: {time_remaining}",
+)
+replies.add_message(
+    "busy", "⏳ Too many keyboxes are being generated right now. Please try again in a minute."
+)
+replies.add_message("generating", "Generating keybox.xml...\n{limit_message}", escape=None)
+replies.add_message(
+    "success", "✅ Keybox generated successfully!\n{limit_message}\nWhat would you like to do next?"
+)
+replies.add_keyboard(
+    "success", [[("Generate Another Keybox", "generate")], [("Show Help", "help")]]
+)
 
 # --- Telegram Bot Handlers ---
 
 async def start(update: Update, context: CallbackContext) -> None:
     """Send a message when the command /start is issued."""
     user = update.effective_user
-    keyboard = [
-        [InlineKeyboardButton("Generate Keybox", callback_data="generate")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    message = (
-        f"Hi {user.first_name}! 👋\n\n"
-        "Welcome to the Keybox Generator Bot! I can create `keybox.xml` files "
-        "used for Android device attestation.\n\n"
-        "Click the button below to get started, or use /help for more information."
-    )
-
     await update.message.reply_text(
-        escape_markdown_v2(message), reply_markup=reply_markup, parse_mode="MarkdownV2"
+        replies.render("start", first_name=user.first_name),
+        reply_markup=replies.markup("start"),
+        parse_mode="MarkdownV2",
     )
 
 
 async def generate_keybox_command(update: Update, context: CallbackContext) -> None:
     """Generates the keybox and sends it, checking limits."""
+    import keyboxGenerator
     query = update.callback_query
     user_id = update.effective_user.id
 
-    # Load data, get user, check/reset limit, check vip
-    data = load_data()
-    user_data = get_user_data(user_id, data)
-    limit_reset = check_and_reset_limit(user_data)
-
-
-    if user_data["vip"]:
-      limit_message = "👑 You are a VIP user.  Unlimited keybox generation!"
+    if not query and context.args:
+        await generate_batch_command(update, context)
+        return
 
-    elif user_data["count"] >= DAILY_LIMIT:
-       # Calculate remaining time
-        current_time = int(time.time())
-        last_reset_time = user_data["last_reset"]
-        time_remaining_seconds = LIMIT_DURATION_HOURS * 3600 - (current_time - last_reset_time)
-        time_remaining = timedelta(seconds = time_remaining_seconds)
+    # Get user, check/reset limit, check vip
+    user_data = await run_blocking(get_user_data, user_id)
+    reset_from = user_data["last_reset"]
+    limit_reset = check_and_reset_limit(user_data)
+    tier = TIER_VIP if user_data["vip"] else TIER_REGULAR
+    limit = rate_limiter.limit(tier)
+    ledger = get_quota_ledger()
+    decision, reservation = await run_blocking(
+        ledger.reserve, user_id, tier, 1, user_data["count"], user_data["last_reset"]
+    )
 
-        limit_message = (
-            f"❌ You have reached your daily limit of {DAILY_LIMIT} keyboxes.\n"
-            f"Time remaining until reset: {time_remaining}"
-        )
+    if not decision.allowed:
+        quota_rejections.inc(1, decision.scope)
+        time_remaining = timedelta(seconds=math.ceil(decision.retry_after))
+        if decision.scope == rateLimiter.SCOPE_GLOBAL:
+            limit_message = replies.render("limit_global", time_remaining=time_remaining)
+        else:
+            limit_message = replies.render(
+                "limit_user", limit=limit, hours=LIMIT_DURATION_HOURS, time_remaining=time_remaining
+            )
         if query:
             await query.answer()
-            await query.edit_message_text(escape_markdown_v2(limit_message))
+            await query.edit_message_text(limit_message, parse_mode="MarkdownV2")
         else:
-            await update.message.reply_text(escape_markdown_v2(limit_message))
+            await update.message.reply_text(limit_message, parse_mode="MarkdownV2")
         return  # Stop here if the limit is reached
 
+    if decision.remaining is None:
+      limit_message = (
+          "👑 You are a VIP user.  Unlimited keybox generation!"
+          if user_data["vip"]
+          else "♾️ Unlimited keybox generation!"
+      )
     else:
-
-      limit_message = f"🔑 Keyboxes generated today: {user_data['count']}/{DAILY_LIMIT}"
+      used = limit - decision.remaining
+      limit_message = f"🔑 Keyboxes generated today: {used}/{limit}"
+      if user_data["vip"]:
+          limit_message = f"👑 {limit_message}"
       if(limit_reset):
           limit_message = f"✅ Your daily Keybox limit has been reset\n{limit_message}"
     # Proceed with keybox generation
+    job = await get_generation_queue().submit(
+        user_id,
+        generationQueue.PRIORITY_VIP if user_data["vip"] else generationQueue.PRIORITY_REGULAR,
+        keyboxGenerator.generate_keybox_isolated,
+    )
+    if job is None:
+        queue_rejections.inc()
+        await run_blocking(ledger.release, reservation)
+        busy_message = replies.render("busy")
+        if query:
+            await query.answer()
+            await query.edit_message_text(busy_message, parse_mode="MarkdownV2")
+        else:
+            await update.message.reply_text(busy_message, parse_mode="MarkdownV2")
+        return
+
+    generating_message = replies.render("generating", limit_message=limit_message)
     if query:
         await query.answer()  # Always answer!
-        await query.edit_message_text(text=f"Generating keybox.xml...\n{limit_message}")
+        status_message = await query.edit_message_text(text=generating_message)
     else:
-        await update.message.reply_text(f"Generating keybox.xml...\n{limit_message}")
-
-    result = keyboxGenerator.main()
-
-    if result.startswith("Successfully"):
-        user_data["count"] += 1  # Increment count
-        save_data(data)  # Save the updated count *before* sending
-        with open("keybox.xml", "rb") as f:
-            if query:
-                await query.message.reply_document(document=f, filename="keybox.xml")
-            else:
-                await update.message.reply_document(document=f, filename="keybox.xml")
-
-        # Success message with options
-        keyboard = [
-            [InlineKeyboardButton("Generate Another Keybox", callback_data="generate")],
-            [InlineKeyboardButton("Show Help", callback_data="help")],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        success_message = f"✅ Keybox generated successfully!\n{limit_message}\nWhat would you like to do next?"
+        status_message = await update.message.reply_text(generating_message)
 
-        if query:
-            await query.message.reply_text(
-                escape_markdown_v2(success_message), reply_markup=reply_markup
-            )
-        else:
-            await update.message.reply_text(
-                escape_markdown_v2(success_message), reply_markup=reply_markup
+    try:
+        result = await wait_for_job(job, status_message, limit_message)
+    except BaseException:
+        ledger.release(reservation)  # directly: the task may be being cancelled
+        raise
+    message = query.message if query else update.message
+
+    if not result.startswith("Error"):
+        # count it *before* sending; the commit fsyncs the journal, so not on the event loop
+        await run_blocking(record_generations, user_id, user_data, reset_from if limit_reset else None, reservation)
+        document = BytesIO(result.encode("utf-8"))  # per-request buffer, no shared keybox.xml
+        # One call: the document carries the success message and its options
+        with keyboxGenerator.stageSeconds.time(STAGE_UPLOAD):
+            await message.reply_document(
+                document=document,
+                filename="keybox.xml",
+                caption=replies.render("success", limit_message=limit_message),
+                reply_markup=replies.markup("success"),
+                parse_mode="MarkdownV2",
             )
-    elif "keybox" in result.lower() and "</" in result.lower():
-         user_data["count"] += 1  # Increment count
-         save_data(data)
-         if query:
-             await query.message.reply_text(f"Generated keybox (sent as text):\n{limit_message}")
-             await query.message.reply_text(
-                f"Generated Keybox:\n```{escape_markdown_v2(result)}```", parse_mode="MarkdownV2"
-             )
-         else:
-
-             await update.message.reply_text(f"Generated keybox (sent as text):\n{limit_message}")
-             await update.message.reply_text(
-               f"Generated Keybox:\n```{escape_markdown_v2(result)}```", parse_mode="MarkdownV2"
-           )
-
-         # Success message with options
-         keyboard = [
-            [InlineKeyboardButton("Generate Another Keybox", callback_data="generate")],
-            [InlineKeyboardButton("Show Help", callback_data="help")],
-        ]
-         reply_markup = InlineKeyboardMarkup(keyboard)
-         success_message = "✅ Keybox generated successfully! What would you like to do next?"
+        keyboxes_sent.inc()
+    else:
+        await run_blocking(ledger.release, reservation)  # a failed generation does not count
+        await message.reply_text(result)
 
-         if query:
+async def generate_batch_command(update: Update, context: CallbackContext) -> None:
+    """Generates N keyboxes in parallel and sends them as one archive (VIP/admin only).
 
-            await query.message.reply_text(escape_markdown_v2(success_message), reply_markup=reply_markup)
-         else:
-             await update.message.reply_text(escape_markdown_v2(success_message), reply_markup=reply_markup)
-    else:
-        if query:
-            await query.message.reply_text(escape_markdown_v2(result))  # Escape error
+    Usage: /generate N [zip|tar.gz|xml]; xml puts all N keyboxes into one keybox.xml.
+    """
+    import keyboxGenerator
+    user_id = update.effective_user.id
+    user_data = await run_blocking(get_user_data, user_id)
+    if not user_data["vip"] and user_id != ADMIN_USER_ID:
+        await update.message.reply_text("Batch generation is only available to VIP users.")
+        return
+
+    try:
+        count = int(context.args[0])
+    except ValueError:
+        count = 0
+    archive_format = context.args[1].lower() if len(context.args) > 1 else keyboxGenerator.ARCHIVE_ZIP
+    if not 1 <= count <= BATCH_MAX_KEYBOXES or archive_format not in BATCH_FORMATS:
+        await update.message.reply_text(
+            f"Usage: /generate N [zip|tar.gz|xml] with N between 1 and {BATCH_MAX_KEYBOXES}."
+        )
+        return
+
+    reset_from = user_data["last_reset"]
+    limit_reset = check_and_reset_limit(user_data)
+    tier = TIER_VIP if user_data["vip"] or user_id == ADMIN_USER_ID else TIER_REGULAR
+    ledger = get_quota_ledger()
+    decision, reservation = await run_blocking(
+        ledger.reserve, user_id, tier, count, user_data["count"], user_data["last_reset"]
+    )
+    if not decision.allowed:
+        quota_rejections.inc(1, decision.scope)
+        time_remaining = timedelta(seconds=math.ceil(decision.retry_after))
+        await update.message.reply_text(
+            f"❌ Not enough quota for {count} keyboxes. Please try again in: {time_remaining}"
+        )
+        return
+
+    queue = get_generation_queue()
+    if queue.depth() + count > queue.maxDepth:
+        queue_rejections.inc()
+        await run_blocking(ledger.release, reservation)
+        await update.message.reply_text(
+            "⏳ Too many keyboxes are being generated right now. Please try again in a minute."
+        )
+        return
+    single_document = archive_format == BATCH_XML
+    generate = (
+        keyboxGenerator.generate_keybox_material_isolated
+        if single_document
+        else keyboxGenerator.generate_keybox_isolated
+    )
+    jobs = []
+    for _ in range(count):
+        job = await queue.submit(user_id, generationQueue.PRIORITY_VIP, generate)
+        if job is not None:
+            jobs.append(job)
+    status_message = await update.message.reply_text(f"Generating {len(jobs)} keyboxes...")
+
+    # Write each result into the document as soon as its job finishes; past
+    # BATCH_SPOOL_BYTES the document moves to a temporary file
+    errors = []
+    with tempfile.SpooledTemporaryFile(max_size=BATCH_SPOOL_BYTES) as output:
+        writer = (
+            keyboxGenerator.KeyboxXmlWriter(output, None)  # declares the count once it is known
+            if single_document
+            else keyboxGenerator.KeyboxArchiveWriter(output, archive_format)
+        )
+        with writer:
+            for finished in asyncio.as_completed([job.future for job in jobs]):
+                try:
+                    result = await finished
+                except Exception as e:
+                    result = f"Error: {e}"
+                if isinstance(result, str) and result.startswith("Error"):
+                    errors.append(result)
+                elif single_document:
+                    writer.add(*result)
+                else:
+                    writer.add(result)
+        written = writer.count
+
+        if written:
+            # one commit for the whole batch
+            await run_blocking(record_generations, user_id, user_data, reset_from if limit_reset else None, reservation, written)
+            output.seek(0)
+            with keyboxGenerator.stageSeconds.time(STAGE_UPLOAD):
+                await update.message.reply_document(
+                    document=output.read(),  # read whole for the upload either way; a spool has no name
+                    filename="keybox.xml" if single_document else f"keyboxes.{archive_format}",
+                )
+            keyboxes_sent.inc(written)
         else:
-            await update.message.reply_text(escape_markdown_v2(result))
+            await run_blocking(ledger.release, reservation)
+    summary = f"✅ Generated {written}/{count} keyboxes."
+    if errors:
+        summary += f"\n❌ {len(errors)} failed: {errors[0]}"
+    try:
+        await status_message.edit_text(summary)
+    except TelegramError:
+        await update.message.reply_text(summary)
+
 
 async def help_command(update: Update, context: CallbackContext) -> None:
     """Shows the help message."""
-    keyboard = [
-        [
-            InlineKeyboardButton(
-                "View Source Code (GitHub)",
-                url="https://github.com/CRZX1337/Keybox-Generator-Telegram-Bot",
-            )
-        ],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    message = (
-        "This bot generates Android keybox.xml files.\n\n"
-        "**Commands:**\n\n"
-        "/start - Start the bot and see the welcome message.\n"
-        "/generate - Create a new keybox.xml file.\n"
-        "/help - Show this help message.\n\n"
-        "Click the button below to view the source code on GitHub."
-    )
+    message = replies.render("help")
+    reply_markup = replies.markup("help")
 
     query = update.callback_query
     if query:
          await query.answer()
-         await query.edit_message_text(
-            escape_markdown_v2(message), reply_markup=reply_markup, parse_mode="MarkdownV2"
-        )
+         await query.edit_message_text(message, reply_markup=reply_markup, parse_mode="MarkdownV2")
     else:
-        await update.message.reply_text(
-            escape_markdown_v2(message), reply_markup=reply_markup, parse_mode="MarkdownV2"
-        )
+        await update.message.reply_text(message, reply_markup=reply_markup, parse_mode="MarkdownV2")
 
 
 
@@ -255,6 +768,96 @@ async def button(update: Update, context: CallbackContext) -> None:
 
 # --- Admin Commands ---
 
+# --- Keybox Verification ---
+
+VERIFY_STATE = "verify"
+
+
+def describe_validation(result: dict, cached: bool) -> str:
+    """Formats a ``keyboxGenerator.validate_keybox`` result as a plain-text reply."""
+    if result["valid"]:
+        lines = [f"✅ The keybox is valid{' (cached)' if cached else ''}."]
+    else:
+        lines = [f"❌ The keybox is not valid{' (cached)' if cached else ''}."]
+    lines.append(f"Keyboxes: {result['keyboxes']}, certificates: {result['certificates']}")
+    for title, problems, count in (
+        ("Errors", result["errors"], result["error_count"]),
+        ("Warnings", result["warnings"], result["warning_count"]),
+    ):
+        if not count:
+            continue
+        lines.append(f"\n{title} ({count}):")
+        lines.extend(f"-{problem}" for problem in problems[:VERIFY_LISTED_PROBLEMS])
+        if count > VERIFY_LISTED_PROBLEMS:
+            lines.append(f"...and {count - VERIFY_LISTED_PROBLEMS} more")
+    return "\n".join(lines)
+
+
+async def verify_keybox_document(update: Update) -> None:
+    """Checks an uploaded keybox.xml; results are cached by the file's SHA-256."""
+    import keyboxGenerator
+    document = update.message.document
+    if document.file_size and document.file_size > VERIFY_MAX_BYTES:
+        await update.message.reply_text(
+            f"The file is too large ({VERIFY_MAX_BYTES // (1024 * 1024)} MB at most)."
+        )
+        return
+
+    telegram_file = await document.get_file()
+    data = bytes(await telegram_file.download_as_bytearray())
+    digest = keyboxGenerator.keybox_digest(data)
+    result = keyboxGenerator.validationCache.get(digest)
+    cached = result is not None
+    if not cached:
+        # Key loading and signature checks are CPU-bound: they take quota and wait their
+        # turn in the generation queue like a keybox
+        user_id = update.effective_user.id
+        quota_key = verify_quota_key(user_id)
+        decision = await run_blocking(rate_limiter.acquire, quota_key, TIER_VERIFY)
+        if not decision.allowed:
+            quota_rejections.inc(1, decision.scope)
+            await update.message.reply_text(
+                f"❌ Too many checks. Please try again in: {timedelta(seconds=math.ceil(decision.retry_after))}"
+            )
+            return
+        job = await get_generation_queue().submit(
+            user_id, generationQueue.PRIORITY_REGULAR, keyboxGenerator.validate_keybox, data
+        )
+        if job is None:
+            queue_rejections.inc()
+            await run_blocking(rate_limiter.refund, quota_key, TIER_VERIFY)
+            await update.message.reply_text(replies.render("busy"), parse_mode="MarkdownV2")
+            return
+        try:
+            result = await job.future
+        except asyncio.CancelledError:
+            rate_limiter.refund(quota_key, TIER_VERIFY)  # directly: the task is being cancelled
+            raise
+        except Exception:
+            # the check ran, so it keeps its charge; a refund would let the same file be retried forever
+            logger.exception("Keybox validation failed")
+            await update.message.reply_text("❌ The file could not be checked.")
+            return
+        keyboxGenerator.validationCache.put(digest, result)
+    keyboxes_verified.inc(1, "valid" if result["valid"] else "invalid")
+    await update.message.reply_text(describe_validation(result, cached))
+
+
+def verify_quota_key(user_id) -> str:
+    """The rate-limit key for a user's /verify checks, apart from their keybox quota."""
+    return f"verify:{user_id}"
+
+
+async def verify_command(update: Update, context: CallbackContext) -> None:
+    """/verify: asks for a keybox.xml to check."""
+    await run_blocking(get_conversation_state().set, update.effective_user.id, VERIFY_STATE)
+    await update.message.reply_text(
+        "Upload the keybox.xml to check. I will verify that each private key matches its "
+        "certificate, that the certificate chains are in order and not expired, and that "
+        "the declared counts match."
+    )
+
+
 async def admin_panel(update: Update, context: CallbackContext) -> None:
     """Displays the admin panel."""
     user_id = update.effective_user.id
@@ -264,35 +867,137 @@ async def admin_panel(update: Update, context: CallbackContext) -> None:
 
     keyboard = [
         [InlineKeyboardButton("List Users", callback_data="admin_list")],
+        [InlineKeyboardButton("Find User", callback_data="admin_find_user")],
         [InlineKeyboardButton("Add VIP", callback_data="admin_add_vip")],
         [InlineKeyboardButton("Remove VIP", callback_data="admin_remove_vip")],
-        [InlineKeyboardButton("Show Limit", callback_data="admin_show_limit")]
+        [
+            InlineKeyboardButton("Bulk VIP", callback_data="admin_bulk_vip"),
+            InlineKeyboardButton("Bulk Un-VIP", callback_data="admin_bulk_unvip"),
+            InlineKeyboardButton("Bulk Reset", callback_data="admin_bulk_reset"),
+        ],
+        [InlineKeyboardButton("Export Users", callback_data="admin_export")],
+        [InlineKeyboardButton("Show Limit", callback_data="admin_show_limit")],
+        [InlineKeyboardButton("Rotate CA", callback_data="admin_rotate_ca")],
+        [InlineKeyboardButton("Store Compaction", callback_data="admin_compaction")],
+        [InlineKeyboardButton("Metrics", callback_data="admin_metrics")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text("Admin Panel:", reply_markup=reply_markup)
 
 
+LIST_FILTER_ALL = "all"
+LIST_FILTER_VIP = "vip"
+LIST_FILTER_OVER_QUOTA = "over"
+LIST_FILTER_ACTIVE = "a"  # followed by the number of hours, e.g. "a24"
+
+
+def list_filters(name: str) -> dict:
+    """Maps a list filter name to ``list_users`` keyword arguments."""
+    now = int(time.time())
+    if name == LIST_FILTER_VIP:
+        return {"vipOnly": True}
+    if name == LIST_FILTER_OVER_QUOTA:
+        return {"quota": (DAILY_LIMIT, now - LIMIT_DURATION_HOURS * 3600)}
+    if name.startswith(LIST_FILTER_ACTIVE) and name[1:].isdigit():
+        return {"activeSince": now - int(name[1:]) * 3600}
+    return {}
+
+
+def describe_user(user_id, user_data: dict) -> str:
+    last_active = user_data.get("last_active") or 0
+    return (
+        f"ID: {user_id}, Count: {user_data['count']}, "
+        f"Last Reset: {datetime.fromtimestamp(user_data['last_reset'])}, VIP: {user_data['vip']}, "
+        f"Last Active: {datetime.fromtimestamp(last_active) if last_active else 'never'}"
+    )
+
+
+def user_list_page(filter_name: str = LIST_FILTER_ALL, direction: str = "n", cursor=None):
+    """Builds one page of the admin user list and its navigation keyboard.
+
+    Pages are keyed by user ID (``after``/``before`` the cursor), so every page
+    is an index range scan whatever its position in the list.
+    """
+    filters = list_filters(filter_name)
+    store = get_store()
+    if direction == "p":
+        rows = store.list_users(before=cursor, limit=ADMIN_PAGE_SIZE + 1, **filters)
+        has_prev, has_next = len(rows) > ADMIN_PAGE_SIZE, True
+        rows = rows[-ADMIN_PAGE_SIZE:]
+    else:
+        rows = store.list_users(after=cursor, limit=ADMIN_PAGE_SIZE + 1, **filters)
+        has_prev, has_next = cursor is not None, len(rows) > ADMIN_PAGE_SIZE
+        rows = rows[:ADMIN_PAGE_SIZE]
+
+    if rows:
+        lines = [f"Users ({filter_name}):"]
+        lines.extend(describe_user(user_id, user_data) for user_id, user_data in rows)
+    else:
+        lines = [f"No users found ({filter_name})."]
+        has_prev, has_next = cursor is not None, False
+
+    navigation = []
+    if has_prev and rows:
+        navigation.append(InlineKeyboardButton("« Prev", callback_data=f"admin_list:{filter_name}:p:{rows[0][0]}"))
+    if has_next and rows:
+        navigation.append(InlineKeyboardButton("Next »", callback_data=f"admin_list:{filter_name}:n:{rows[-1][0]}"))
+    active = f"{LIST_FILTER_ACTIVE}{ADMIN_ACTIVE_HOURS}"
+    keyboard = [
+        [
+            InlineKeyboardButton("All", callback_data=f"admin_list:{LIST_FILTER_ALL}"),
+            InlineKeyboardButton("VIP", callback_data=f"admin_list:{LIST_FILTER_VIP}"),
+            InlineKeyboardButton("Over quota", callback_data=f"admin_list:{LIST_FILTER_OVER_QUOTA}"),
+            InlineKeyboardButton(f"Active {ADMIN_ACTIVE_HOURS}h", callback_data=f"admin_list:{active}"),
+        ]
+    ]
+    if navigation:
+        keyboard.insert(0, navigation)
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+
 async def admin_list_users(update: Update, context: CallbackContext) -> None:
-     """Lists all users and their data (admin only)."""
+     """Lists users one page at a time (admin only).
+
+     The callback data is ``admin_list[:filter[:direction:cursor]]``.
+     """
      query = update.callback_query
      await query.answer()
 
      if query.from_user.id != ADMIN_USER_ID:
          await query.edit_message_text("Unauthorized.")
          return
-     data = load_data()
+     parts = query.data.split(":")
+     filter_name = parts[1] if len(parts) > 1 else LIST_FILTER_ALL
+     direction, cursor = (parts[2], int(parts[3])) if len(parts) > 3 else ("n", None)
+     text, reply_markup = await run_blocking(user_list_page, filter_name, direction, cursor)
+     await query.edit_message_text(text, reply_markup=reply_markup)
+
+async def users_command(update: Update, context: CallbackContext) -> None:
+    """/users [all|vip|over|active HOURS]: the paginated user list (admin only)."""
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("Unauthorized.")
+        return
+    args = [arg.lower() for arg in context.args or []]
+    filter_name = args[0] if args else LIST_FILTER_ALL
+    if filter_name == "active":
+        hours = args[1] if len(args) > 1 and args[1].isdigit() else str(ADMIN_ACTIVE_HOURS)
+        filter_name = f"{LIST_FILTER_ACTIVE}{hours}"
+    elif filter_name not in (LIST_FILTER_ALL, LIST_FILTER_VIP, LIST_FILTER_OVER_QUOTA):
+        await update.message.reply_text("Usage: /users [all|vip|over|active HOURS]")
+        return
+    text, reply_markup = await run_blocking(user_list_page, filter_name)
+    await update.message.reply_text(text, reply_markup=reply_markup)
 
-     if not data:
-          await query.edit_message_text("No user data found.")
-          return
-     user_list = ""
+async def admin_find_user(update: Update, context: CallbackContext) -> None:
+    """Looks up one user by ID (admin only)."""
+    query = update.callback_query
+    await query.answer()
 
-     for user_id, user_data in data.items():
-        user_list += (
-             f"ID: {user_id}, Count: {user_data['count']}, "
-             f"Last Reset: {datetime.fromtimestamp(user_data['last_reset'])}, VIP: {user_data['vip']}\n"
-        )
-     await query.edit_message_text(f"User List:\n{user_list}")
+    if query.from_user.id != ADMIN_USER_ID:
+         await query.edit_message_text("Unauthorized.")
+         return
+    await query.edit_message_text("Enter the User ID to look up:")
+    await run_blocking(get_conversation_state().set, query.from_user.id, "find_user")
 
 async def admin_add_vip(update: Update, context: CallbackContext) -> None:
     """Adds a VIP user (admin only)."""
@@ -304,7 +1009,7 @@ async def admin_add_vip(update: Update, context: CallbackContext) -> None:
          return
 
     await query.edit_message_text("Enter the User ID to add as VIP:")
-    context.user_data["admin_action"] = "add_vip"
+    await run_blocking(get_conversation_state().set, query.from_user.id, "add_vip")
 
 
 async def admin_remove_vip(update: Update, context: CallbackContext) -> None:
@@ -316,7 +1021,119 @@ async def admin_remove_vip(update: Update, context: CallbackContext) -> None:
          await query.edit_message_text("Unauthorized.")
          return
     await query.edit_message_text("Enter the User ID to remove from VIP:")
-    context.user_data["admin_action"] = "remove_vip"
+    await run_blocking(get_conversation_state().set, query.from_user.id, "remove_vip")
+
+# pending action -> (description, storage.update_users arguments)
+BULK_ACTIONS = {
+    "bulk_vip": ("grant VIP to", {"vip": True}),
+    "bulk_unvip": ("revoke VIP from", {"vip": False}),
+    "bulk_reset": ("reset the quota of", {"resetQuota": True}),
+}
+
+async def admin_bulk(update: Update, context: CallbackContext) -> None:
+    """Asks for a file of user IDs for a bulk VIP grant/revoke or quota reset (admin only)."""
+    query = update.callback_query
+    await query.answer()
+
+    if query.from_user.id != ADMIN_USER_ID:
+         await query.edit_message_text("Unauthorized.")
+         return
+    action = query.data[len("admin_"):]
+    description, _ = BULK_ACTIONS[action]
+    await query.edit_message_text(
+        f"Upload a CSV or JSON file with the user IDs to {description}.\n"
+        "CSV: one ID per line, or a user_id column. JSON: a list of IDs, or an export/user_data.json."
+    )
+    await run_blocking(get_conversation_state().set, query.from_user.id, action)
+
+async def handle_admin_document(update: Update, action) -> None:
+    """Applies a bulk action to the user IDs in an uploaded file, in one transaction."""
+    import storage
+    if action not in BULK_ACTIONS:
+        await update.message.reply_text("Choose a bulk action in /admin before uploading a file.")
+        return
+    description, changes = BULK_ACTIONS[action]
+    document = update.message.document
+    if document.file_size and document.file_size > BULK_MAX_BYTES:
+        await update.message.reply_text("The file is too large (20 MB at most).")
+        return
+
+    telegram_file = await document.get_file()
+    data = bytes(await telegram_file.download_as_bytearray())
+    try:
+        user_ids, skipped = storage.read_user_ids(data)
+    except UnicodeDecodeError:
+        await update.message.reply_text("The file is not UTF-8 text.")
+        return
+    if not user_ids:
+        await update.message.reply_text("No user IDs found in the file.")
+        return
+
+    changed = await run_blocking(get_store().update_users, user_ids, **changes)
+    if changes.get("resetQuota"):
+        await run_blocking(rate_limiter.reset, user_ids)
+    message = f"Updated {changed} of {len(user_ids)} users."
+    if changed < len(user_ids):
+        message += f"\n{len(user_ids) - changed} IDs have no record and were left alone."
+    if skipped:
+        message += f"\n{skipped} entries were not user IDs and were skipped."
+    await update.message.reply_text(message)
+
+async def handle_document(update: Update, context: CallbackContext) -> None:
+    """Routes an uploaded file: a keybox to check for /verify, or user IDs for an admin bulk action."""
+    user_id = update.effective_user.id
+    caption = (update.message.caption or "").split()
+    if caption and caption[0].split("@")[0] == "/verify":
+        await run_blocking(get_conversation_state().pop, user_id)
+        await verify_keybox_document(update)
+        return
+
+    action = await run_blocking(get_conversation_state().pop, user_id)
+    if action == VERIFY_STATE:
+        await verify_keybox_document(update)
+    elif user_id == ADMIN_USER_ID:
+        await handle_admin_document(update, action)
+    else:
+        await update.message.reply_text("Send /verify first to check a keybox.xml file.")
+
+def write_user_export():
+    """Streams every user into a gzip-compressed CSV temporary file; returns ``(file, users)``."""
+    import storage
+    export = tempfile.TemporaryFile()
+    try:
+        users = storage.export_users(get_store(), export)
+    except BaseException:
+        export.close()
+        raise
+    export.seek(0)
+    return export, users
+
+async def send_user_export(message) -> None:
+    loop = asyncio.get_running_loop()
+    export, users = await loop.run_in_executor(None, write_user_export)
+    with export:
+        await message.reply_document(
+            document=export,
+            filename=f"users-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}.csv.gz",
+            caption=f"{users} users",
+        )
+
+async def admin_export(update: Update, context: CallbackContext) -> None:
+    """Sends the whole user table as a compressed CSV (admin only)."""
+    query = update.callback_query
+    await query.answer()
+
+    if query.from_user.id != ADMIN_USER_ID:
+         await query.edit_message_text("Unauthorized.")
+         return
+    await send_user_export(query.message)
+
+async def export_command(update: Update, context: CallbackContext) -> None:
+    """/export: the whole user table as a compressed CSV (admin only)."""
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("Unauthorized.")
+        return
+    await send_user_export(update.message)
 
 async def admin_show_limit(update: Update, context: CallbackContext) -> None:
     """Removes a VIP user (admin only)."""
@@ -326,9 +1143,132 @@ async def admin_show_limit(update: Update, context: CallbackContext) -> None:
     if query.from_user.id != ADMIN_USER_ID:
          await query.edit_message_text("Unauthorized.")
          return
-    message = f"The current limits are:\n-Limit: {DAILY_LIMIT}\n-Duration: {LIMIT_DURATION_HOURS} hours"
+    message = (
+        f"The current limits are:\n-Limit: {DAILY_LIMIT}\n"
+        f"-VIP Limit: {VIP_DAILY_LIMIT or 'unlimited'}\n"
+        f"-Duration: {LIMIT_DURATION_HOURS} hours\n"
+        f"-Global Limit: {GLOBAL_LIMIT_PER_MINUTE or 'off'} per minute\n"
+        f"-Strategy: {rate_limiter.strategy}"
+    )
     await query.edit_message_text(message)
 
+async def admin_rotate_ca(update: Update, context: CallbackContext) -> None:
+    """Replaces the intermediate CA that signs new certificates (admin only)."""
+    import keyboxGenerator
+    query = update.callback_query
+    await query.answer()
+
+    if query.from_user.id != ADMIN_USER_ID:
+         await query.edit_message_text("Unauthorized.")
+         return
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(None, keyboxGenerator.rotate_certificate_authority):
+        await query.edit_message_text("The certificate authority is disabled.")
+        return
+    stats = keyboxGenerator.certificateAuthority.stats()
+    await query.edit_message_text(
+        f"Rotated the intermediate CA.\n-Serial: {stats['intermediate_serial']:x}\n"
+        f"-Expires: {stats['intermediate_expires']}"
+    )
+
+async def rotate_expiring_certificate_authority(context: CallbackContext) -> None:
+    """Replaces the intermediate CA once it expires within CA_ROTATE_BEFORE_DAYS (job queue).
+
+    Leaves never outlive the intermediate, so an ageing one shortens them;
+    worker processes pick the new one up on their next reload check.
+    """
+    import keyboxGenerator
+
+    loop = asyncio.get_running_loop()
+    if await loop.run_in_executor(
+        None, keyboxGenerator.rotate_certificate_authority_if_expiring, CA_ROTATE_BEFORE_DAYS
+    ):
+        stats = keyboxGenerator.certificateAuthority.stats()
+        logger.info(
+            "Rotated the intermediate CA ahead of its expiry; the new one expires %s",
+            stats["intermediate_expires"],
+        )
+
+async def admin_show_metrics(update: Update, context: CallbackContext) -> None:
+    """Shows live p50/p95/p99 latencies and the main counters (admin only)."""
+    import keyboxGenerator
+    query = update.callback_query
+    await query.answer()
+
+    if query.from_user.id != ADMIN_USER_ID:
+         await query.edit_message_text("Unauthorized.")
+         return
+    lines = []
+    for title, histogram in (
+        ("Generation stages", keyboxGenerator.stageSeconds),
+        ("Generation per backend", keyboxGenerator.generationSeconds),
+        ("Handlers", handler_seconds),
+    ):
+        lines.append(f"{title} (p50/p95/p99 ms):")
+        for labels, (count, values) in histogram.percentiles().items():
+            p50, p95, p99 = (value * 1000 for value in values)
+            lines.append(f"-{labels[0]}: {p50:.1f}/{p95:.1f}/{p99:.1f} (n={count})")
+    queue = get_generation_queue().stats()
+    lines.append(
+        f"Queue: {queue['waiting']} waiting, {queue['running']} running, {queue['rejected']} rejected\n"
+        f"Quota rejections: {int(quota_rejections.value(rateLimiter.SCOPE_USER))} user, "
+        f"{int(quota_rejections.value(rateLimiter.SCOPE_GLOBAL))} global\n"
+        f"Keyboxes sent: {int(keyboxes_sent.value())}"
+    )
+    await query.edit_message_text("\n".join(lines))
+
+def format_bytes(size: int) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+def describe_compaction(report: dict | None) -> str:
+    if report is None:
+        return (
+            "The store has not been compacted since the bot started."
+            + (f" It runs every {STORE_RETENTION_HOURS:g} hours." if STORE_RETENTION_HOURS > 0 else "")
+        )
+    lines = [
+        f"Store compaction ({datetime.fromtimestamp(report['finished'])}, {report['seconds']:.1f}s):",
+        f"-Removed: {report['removed']} expired users ({report['remaining']} left)",
+    ]
+    if report["archive"]:
+        lines.append(f"-Archive: {os.path.basename(report['archive'])}")
+    if report["bytes_before"] is not None:
+        lines.append(
+            f"-Size: {format_bytes(report['bytes_before'])} -> {format_bytes(report['bytes_after'])} "
+            f"({format_bytes(max(0, report['bytes_before'] - report['bytes_after']))} reclaimed)"
+        )
+    before, after = report["load_seconds_before"] * 1000, report["load_seconds_after"] * 1000
+    lines.append(
+        f"-Load time: {before:.1f} -> {after:.1f} ms"
+        + (f" ({(before - after) / before:.0%} faster)" if report["removed"] and 0 < after < before else "")
+    )
+    return "\n".join(lines)
+
+async def admin_compaction(update: Update, context: CallbackContext) -> None:
+    """Shows the last store compaction, or runs one for ``admin_compaction_run`` (admin only)."""
+    query = update.callback_query
+    await query.answer()
+
+    if query.from_user.id != ADMIN_USER_ID:
+         await query.edit_message_text("Unauthorized.")
+         return
+    report = last_compaction
+    if query.data == "admin_compaction_run":
+        await query.edit_message_text("Compacting the store...")
+        report = await compact_user_store()
+        if report is None:
+            await query.edit_message_text("A compaction is already running.")
+            return
+    reply_markup = InlineKeyboardMarkup(
+        [[InlineKeyboardButton("Compact Now", callback_data="admin_compaction_run")]]
+    )
+    await query.edit_message_text(describe_compaction(report), reply_markup=reply_markup)
+
 async def handle_admin_input(update: Update, context: CallbackContext) -> None:
     """Handles input for admin commands (e.g., adding/removing VIPs)."""
     user_id = update.effective_user.id
@@ -336,21 +1276,20 @@ async def handle_admin_input(update: Update, context: CallbackContext) -> None:
         await update.message.reply_text("Unauthorized.")
         return
 
-    if "admin_action" not in context.user_data:
+    admin_action = await run_blocking(get_conversation_state().pop, user_id) # Remove after use (shared across instances)
+    if admin_action is None:
         # Not in an admin action flow, just ignore.
         return
 
 
     text = update.message.text
-    admin_action = context.user_data.pop("admin_action") # Remove after use
 
     if admin_action == "add_vip":
         try:
              vip_user_id = int(text)
-             data = load_data()
-             user_data = get_user_data(vip_user_id,data) # creates if doesn exist
+             user_data = await run_blocking(get_user_data, vip_user_id) # creates if doesn exist
              user_data["vip"] = True
-             save_data(data)
+             await run_blocking(save_user_data, vip_user_id, user_data)
              await update.message.reply_text(f"User {vip_user_id} added to VIPs.")
 
         except ValueError:
@@ -359,17 +1298,29 @@ async def handle_admin_input(update: Update, context: CallbackContext) -> None:
     elif admin_action == "remove_vip":
         try:
            vip_user_id = int(text)
-           data = load_data()
-           if str(vip_user_id) not in data:
+           if not await run_blocking(get_store().has_user, vip_user_id):
                 await update.message.reply_text("User Id not found")
                 return
-           data[str(vip_user_id)]["vip"] = False
-           save_data(data)
+           user_data = await run_blocking(get_user_data, vip_user_id)
+           user_data["vip"] = False
+           await run_blocking(save_user_data, vip_user_id, user_data)
            await update.message.reply_text(f"User {vip_user_id} removed from VIPs.")
 
         except ValueError:
             await update.message.reply_text("Invalid User ID format.")
 
+    elif admin_action == "find_user":
+        try:
+            found_user_id = int(text)
+        except ValueError:
+            await update.message.reply_text("Invalid User ID format.")
+            return
+        if not await run_blocking(get_store().has_user, found_user_id):
+            await update.message.reply_text("User Id not found")
+            return
+        found = await run_blocking(get_store().get_user, found_user_id)
+        await update.message.reply_text(describe_user(found_user_id, found))
+
 
 
 async def admin_button(update: Update, context: CallbackContext) -> None:
@@ -380,31 +1331,226 @@ async def admin_button(update: Update, context: CallbackContext) -> None:
         await query.edit_message_text("Unauthorized.")
         return
 
-    if query.data == "admin_list":
+    if query.data == "admin_list" or query.data.startswith("admin_list:"):
         await admin_list_users(update, context)
+    elif query.data == "admin_find_user":
+        await admin_find_user(update, context)
+    elif query.data[len("admin_"):] in BULK_ACTIONS:
+        await admin_bulk(update, context)
+    elif query.data == "admin_export":
+        await admin_export(update, context)
     elif query.data == "admin_add_vip":
         await admin_add_vip(update, context)
     elif query.data == "admin_remove_vip":
        await admin_remove_vip(update, context)
     elif query.data == "admin_show_limit":
         await admin_show_limit(update, context)
+    elif query.data == "admin_rotate_ca":
+        await admin_rotate_ca(update, context)
+    elif query.data in ("admin_compaction", "admin_compaction_run"):
+        await admin_compaction(update, context)
+    elif query.data == "admin_metrics":
+        await admin_show_metrics(update, context)
     else:
       await query.edit_message_text(text=f"Selected option: {query.data}")
 
+def register_handlers(application: Application) -> None:
+    """Registers the bot's command and callback handlers."""
+    application.add_handler(CommandHandler("start", instrumented("start", start)))
+    application.add_handler(CommandHandler("help", instrumented("help", help_command)))
+    application.add_handler(CommandHandler("generate", instrumented("generate", generate_keybox_command)))
+    application.add_handler(CommandHandler("admin", instrumented("admin", admin_panel))) # admin panel
+    application.add_handler(CommandHandler("users", instrumented("users", users_command))) # paginated user list
+    application.add_handler(CommandHandler("export", instrumented("export", export_command))) # user table as csv.gz
+    application.add_handler(CallbackQueryHandler(instrumented("button", button), pattern='^(?!admin_)')) # Handles buttons except "admin_"
+    application.add_handler(CallbackQueryHandler(instrumented("admin_button", admin_button), pattern='^admin_')) # Handle admin panel buttons
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented("admin_input", handle_admin_input))) # get input
+    application.add_handler(CommandHandler("verify", instrumented("verify", verify_command))) # check an uploaded keybox.xml
+    application.add_handler(MessageHandler(filters.Document.ALL, instrumented("document", handle_document))) # /verify and bulk uploads
+
+
+def check_environment() -> int:
+    """``--check``: validates the configuration without starting the bot; returns the exit code."""
+    import keyboxGenerator
+    import storage
+
+    failures = 0
+
+    def report(ok, name, detail):
+        nonlocal failures
+        failures += not ok
+        print(f"[{'ok' if ok else 'FAIL'}] {name}: {detail}")
+
+    report(bool(TELEGRAM_BOT_TOKEN), "token", "set" if TELEGRAM_BOT_TOKEN else "TELEGRAM_BOT_TOKEN is not set")
+    if TELEGRAM_BOT_TOKEN:
+        async def get_me():
+            bot_kwargs = {"base_url": TELEGRAM_API_URL} if TELEGRAM_API_URL else {}
+            async with Bot(TELEGRAM_BOT_TOKEN, **bot_kwargs) as bot:
+                return await bot.get_me(read_timeout=10, connect_timeout=10)
+
+        try:
+            me = asyncio.run(get_me())
+            report(True, "telegram", f"@{me.username}")
+        except Exception as e:
+            report(False, "telegram", f"getMe failed: {e}")
+    report(
+        BOT_MODE == MODE_POLLING or (BOT_MODE == MODE_WEBHOOK and bool(WEBHOOK_URL)),
+        "mode",
+        BOT_MODE if not (BOT_MODE == MODE_WEBHOOK and not WEBHOOK_URL) else "webhook needs WEBHOOK_URL",
+    )
+
+    capabilities = keyboxGenerator.probe_capabilities()
+    backend = keyboxGenerator.resolve_backend()
+    usable = backend == keyboxGenerator.BACKEND_CRYPTOGRAPHY or bool(capabilities["openssl"])
+    report(
+        usable,
+        "backend",
+        f"{backend} (cryptography: {'yes' if capabilities['cryptography'] else 'no'}, "
+        f"openssl: {capabilities['openssl'] or 'not found'})",
+    )
+
+    try:
+        # open the store directly: a check must not create the database or migrate user_data.json
+        if STORE_BACKEND == storage.STORE_REDIS:
+            import sharedState
+
+            checked = storage.RedisUserStore(sharedState.RespClient.from_url(REDIS_URL or "redis://127.0.0.1:6379/0"))
+        elif STORE_BACKEND == storage.STORE_SQLITE:
+            checked = storage.SQLiteUserStore(DATABASE_FILE) if os.path.exists(DATABASE_FILE) else None
+        else:
+            checked = storage.JSONUserStore(DATA_FILE)
+        if checked is None:
+            report(True, "store", f"{STORE_BACKEND}, {DATABASE_FILE} will be created")
+        else:
+            report(True, "store", f"{STORE_BACKEND}, {checked.count()} users")
+            checked.close()
+    except Exception as e:
+        report(False, "store", f"{STORE_BACKEND}: {e}")
+    if shared_state is not None:
+        try:
+            shared_state.execute("PING")
+            report(True, "redis", REDIS_URL)
+        except Exception as e:
+            report(False, "redis", f"{REDIS_URL}: {e}")
+
+    if CERTIFICATE_AUTHORITY and capabilities["cryptography"]:
+        from certificateAuthority import ROOT_CERTIFICATE_FILE, CertificateAuthority
+
+        if not os.path.exists(os.path.join(CA_DIRECTORY, ROOT_CERTIFICATE_FILE)):
+            report(True, "certificate authority", f"will be created in {CA_DIRECTORY}")
+        else:
+            try:
+                authority = CertificateAuthority(CA_DIRECTORY)
+                authority.load_or_create()
+                report(True, "certificate authority", f"intermediate expires {authority.stats()['intermediate_expires']}")
+            except Exception as e:
+                report(False, "certificate authority", f"{CA_DIRECTORY}: {e}")
+    return 1 if failures else 0
+
+
 def main() -> None:
     """Start the bot."""
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    if BOT_MODE == MODE_WEBHOOK and not WEBHOOK_URL:
+        # PTB would register http://WEBHOOK_LISTEN:WEBHOOK_PORT/... with Telegram instead
+        logger.error("BOT_MODE=webhook needs WEBHOOK_URL, the public URL Telegram posts updates to.")
+        sys.exit(1)
+    startup_phases.append(("imports", time.perf_counter() - STARTED))
+    startup_seconds.set(startup_phases[0][1], "imports")
+    threading.Thread(target=log_capabilities, name="capability-probe", daemon=True).start()
+    with startup_phase("handlers"):
+        request, get_updates_request = telegramRequest.build_requests(
+            TELEGRAM_POOL_SIZE, TELEGRAM_TIMEOUT, TELEGRAM_POOL_TIMEOUT, TELEGRAM_MAX_RETRIES, TELEGRAM_MAX_RETRY_AFTER
+        )
+        builder = (
+            Application.builder()
+            .token(TELEGRAM_BOT_TOKEN)
+            .request(request)
+            .get_updates_request(get_updates_request)
+            .concurrent_updates(CONCURRENT_UPDATES)  # a running generation must not stall other updates
+            .post_init(log_startup_profile)
+        )
+        if TELEGRAM_API_URL:
+            builder = builder.base_url(TELEGRAM_API_URL)
+        application = builder.build()
+        register_handlers(application)
+        application.job_queue.run_repeating(
+            sweep_rate_limiter, interval=RATE_LIMIT_SWEEP_SECONDS, name="rate_limiter_sweep"
+        )
+        if CERTIFICATE_AUTHORITY and CA_ROTATE_BEFORE_DAYS > 0:
+            application.job_queue.run_repeating(
+                rotate_expiring_certificate_authority,
+                interval=CA_ROTATION_CHECK_SECONDS,
+                first=CA_ROTATION_CHECK_SECONDS,  # startup has just checked
+                name="ca_rotation",
+            )
+        if STORE_RETENTION_HOURS > 0:
+            application.job_queue.run_repeating(
+                compact_user_store,
+                interval=STORE_RETENTION_HOURS * 3600,
+                first=STORE_RETENTION_FIRST_RUN,
+                name="store_compaction",
+            )
 
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("generate", generate_keybox_command))
-    application.add_handler(CommandHandler("admin", admin_panel)) # admin panel
-    application.add_handler(CallbackQueryHandler(button, pattern='^(?!admin_)')) # Handles buttons except "admin_"
-    application.add_handler(CallbackQueryHandler(admin_button, pattern='^admin_')) # Handle admin panel buttons
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_admin_input)) # get input
+    if CERTIFICATE_AUTHORITY:
+        # create the CA here first so that the workers only ever load it
+        with startup_phase("certificate_authority"):
+            import keyboxGenerator
 
-    application.run_polling()
+            keyboxGenerator.enable_certificate_authority(
+                CA_DIRECTORY, CA_ROOT_VALIDITY_DAYS, CA_INTERMEDIATE_VALIDITY_DAYS, CA_ROTATE_BEFORE_DAYS
+            )
+    if GENERATION_PROCESSES > 0:
+        with startup_phase("workers"):
+            # the workers warm up (and fill their key pools) while the bot starts;
+            # a generation that arrives first waits for a ready worker
+            get_worker_pool().start(wait=False)
+    else:
+        with startup_phase("key_pools"):
+            import keyboxGenerator
+
+            keyboxGenerator.enable_key_pools(
+                KEY_POOL_RSA_SIZE, KEY_POOL_EC_SIZE, KEY_POOL_LOW_WATER_RATIO, KEY_POOL_REFILL_WORKERS
+            )
+    with startup_phase("store"):
+        get_store()  # open the store (and migrate user_data.json) before the first update
+        get_quota_ledger()  # apply commits a crash kept from reaching the store
+    if METRICS_PORT > 0:
+        metrics.start_http_server(METRICS_PORT, METRICS_LISTEN)
+    try:
+        if BOT_MODE == MODE_WEBHOOK:
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET_TOKEN,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+        else:
+            application.run_polling()
+    finally:
+        if GENERATION_PROCESSES <= 0:
+            import keyboxGenerator
+
+            keyboxGenerator.disable_key_pools()
+        if quota_ledger is not None:
+            quota_ledger.close()
+        get_store().close()
+        if shared_state is not None:
+            shared_state.close()
+        if generation_executor is not None:
+            generation_executor.shutdown(wait=False, cancel_futures=True)
+        if blocking_executor is not None:
+            blocking_executor.shutdown(wait=False, cancel_futures=True)
+        if worker_pool is not None:
+            worker_pool.shutdown()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keybox Generator Telegram bot")
+    parser.add_argument(
+        "--check", action="store_true", help="validate the configuration and environment, then exit"
+    )
+    if parser.parse_args().check:
+        sys.exit(check_environment())
     main()
\ No newline at end of file
@@ -0,0 +1,227 @@
+"""Prometheus-style metrics for the bot and the generation pipeline.
+
+Counters, gauges and histograms live in one registry, are rendered in the
+Prometheus text format by ``render`` and served at ``/metrics`` by
+``start_http_server``. Histograms also keep the most recent observations so
+that live percentiles can be shown without a Prometheus server.
+
+Generation runs in worker processes, which have registries of their own. A
+worker calls ``enable_forwarding`` once; its updates are then also recorded
+as events that ``drain`` hands back with each result, and the bot replays
+them into its registry with ``merge``.
+"""
+
+import bisect
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+RECENT_SAMPLES = 1024
+
+_lock = threading.Lock()
+_registry = {}
+_forwarding = False
+_events = []
+
+
+def _format_labels(labelNames: tuple, labelValues: tuple, extra: str = "") -> str:
+    pairs = [
+        '{0}="{1}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in zip(labelNames, labelValues)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelNames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelNames = tuple(labelNames)
+        self._values = {}
+
+    def _forward(self, method: str, value: float, labelValues: tuple) -> None:
+        if _forwarding:
+            _events.append((self.name, method, value, labelValues))
+
+    def _samples(self) -> list:
+        return [
+            (self.name, _format_labels(self.labelNames, labels), value)
+            for labels, value in sorted(self._values.items())
+        ]
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with _lock:
+            samples = self._samples()
+        lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in samples)
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, *labelValues) -> None:
+        with _lock:
+            self._values[labelValues] = self._values.get(labelValues, 0) + amount
+            self._forward("inc", amount, labelValues)
+
+    def value(self, *labelValues) -> float:
+        with _lock:
+            return self._values.get(labelValues, 0)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelNames: tuple = ()):
+        super().__init__(name, documentation, labelNames)
+        self._function = None
+
+    def set(self, value: float, *labelValues) -> None:
+        with _lock:
+            self._values[labelValues] = value
+
+    def set_function(self, function) -> None:
+        """Reads the value from ``function()`` at render time."""
+        self._function = function
+
+    def _samples(self) -> list:
+        if self._function is not None:
+            return [(self.name, "", self._function())]
+        return super()._samples()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelNames: tuple = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelNames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, *labelValues) -> None:
+        with _lock:
+            state = self._values.get(labelValues)
+            if state is None:
+                state = self._values[labelValues] = {
+                    "counts": [0] * len(self.buckets),
+                    "sum": 0.0,
+                    "count": 0,
+                    "recent": deque(maxlen=RECENT_SAMPLES),
+                }
+            state["counts"][bisect.bisect_left(self.buckets, value)] += 1
+            state["sum"] += value
+            state["count"] += 1
+            state["recent"].append(value)
+            self._forward("observe", value, labelValues)
+
+    @contextmanager
+    def time(self, *labelValues):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelValues)
+
+    def percentiles(self, fractions=(0.5, 0.95, 0.99)) -> dict:
+        """Returns ``{labelValues: (count, [percentile, ...])}`` over the recent observations."""
+        with _lock:
+            recent = {labels: (state["count"], sorted(state["recent"])) for labels, state in self._values.items()}
+        return {
+            labels: (count, [ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] for fraction in fractions])
+            for labels, (count, ordered) in sorted(recent.items())
+            if ordered
+        }
+
+    def _samples(self) -> list:
+        samples = []
+        for labels, state in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, state["counts"]):
+                cumulative += count
+                le = 'le="{0}"'.format(_format_value(bound))
+                samples.append((f"{self.name}_bucket", _format_labels(self.labelNames, labels, le), cumulative))
+            samples.append((f"{self.name}_sum", _format_labels(self.labelNames, labels), state["sum"]))
+            samples.append((f"{self.name}_count", _format_labels(self.labelNames, labels), state["count"]))
+        return samples
+
+
+def _register(metric: _Metric) -> _Metric:
+    with _lock:
+        return _registry.setdefault(metric.name, metric)
+
+
+def counter(name: str, documentation: str, labelNames: tuple = ()) -> Counter:
+    return _register(Counter(name, documentation, labelNames))
+
+
+def gauge(name: str, documentation: str, labelNames: tuple = ()) -> Gauge:
+    return _register(Gauge(name, documentation, labelNames))
+
+
+def histogram(name: str, documentation: str, labelNames: tuple = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram(name, documentation, labelNames, buckets))
+
+
+def render() -> str:
+    with _lock:
+        metrics = list(_registry.values())
+    return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+def enable_forwarding() -> None:
+    """Records updates in this (worker) process so that ``drain`` can hand them over."""
+    global _forwarding
+    _forwarding = True
+
+
+def drain() -> list:
+    with _lock:
+        events = _events[:]
+        del _events[:]
+    return events
+
+
+def merge(events: list) -> None:
+    """Replays events drained in another process into this registry."""
+    for name, method, value, labelValues in events:
+        metric = _registry.get(name)
+        if metric is not None:
+            getattr(metric, method)(value, *labelValues)
+
+
+def start_http_server(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """Serves ``render()`` at ``/metrics`` on a daemon thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            payload = render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
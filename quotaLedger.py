@@ -0,0 +1,171 @@
+"""Crash-safe quota accounting: reserve, then commit or release, around a generation.
+
+``reserve`` takes quota from the rate limiter before a generation starts, so
+concurrent requests from one user can never all pass the limit check.
+``commit`` counts the generated keyboxes in the user store (giving back any
+part of the reservation that was not used) and ``release`` gives the whole
+reservation back when generation fails.
+
+Every step is appended to a journal, one JSON object per line:
+
+    {"op": "reserve", "id": 17, "user": 42, "tier": "regular", "count": 1}
+    {"op": "commit", "id": 17, "count": 1}
+    {"op": "applied", "id": 17}
+
+A commit is flushed (and fsync'd) before the store is touched, and marked
+``applied`` afterwards. On startup ``replay`` applies commits that never
+reached the store and drops reservations that were still in flight: their
+keyboxes were never sent, because a keybox is only sent after its commit. A
+crash between the store write and the ``applied`` mark counts that keybox
+twice, never zero times. The journal is compacted to the entries that are
+still open whenever it grows past ``compactBytes``.
+"""
+
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+OP_RESERVE = "reserve"
+OP_COMMIT = "commit"
+OP_RELEASE = "release"
+OP_APPLIED = "applied"
+COMPACT_BYTES = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+Reservation = namedtuple("Reservation", ["id", "user", "tier", "count"])
+
+
+class QuotaLedger:
+    """Reserve/commit/release on top of a ``rateLimiter`` limiter and a user store."""
+
+    def __init__(self, limiter, store, path: str, sync: bool = True, compactBytes: int = COMPACT_BYTES):
+        self.limiter = limiter
+        self.store = store
+        self.path = path
+        self.sync = sync
+        self.compactBytes = compactBytes
+        self._lock = threading.Lock()  # guards the journal file only, never a quota check
+        self._open = {}  # id -> the journal entries of a reservation that is not settled yet
+        self._ids = itertools.count(time.time_ns())  # unique across restarts without reading the journal
+        self._file = None
+        self.stats = {"reserved": 0, "committed": 0, "released": 0, "replayed": 0, "dropped": 0}
+
+    # --- Journal ---
+
+    def _append(self, entry: dict, settled: bool = False, durable: bool = False) -> None:
+        """Writes ``entry``; ``settled`` closes its reservation, so compaction can drop it."""
+        with self._lock:
+            if settled:
+                self._open.pop(entry["id"], None)
+            else:
+                self._open.setdefault(entry["id"], []).append(entry)
+            self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+            self._file.flush()
+            if durable and self.sync:
+                os.fsync(self._file.fileno())
+            if self._file.tell() >= self.compactBytes:
+                self._compact()
+
+    def _compact(self) -> None:
+        """Rewrites the journal with only the open entries (called with the lock held)."""
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            for entries in self._open.values():
+                for entry in entries:
+                    f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(temporary, self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def replay(self) -> dict:
+        """Settles the journal left by the previous run and opens it for appending.
+
+        Commits that did not reach the store are applied; reservations that were
+        in flight are dropped. Returns ``{"replayed": commits, "dropped": reservations}``.
+        """
+        reservations = {}
+        commits = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # a torn last line from the crash
+                    op, entryID = entry.get("op"), entry.get("id")
+                    if op == OP_RESERVE:
+                        reservations[entryID] = entry
+                    elif op == OP_COMMIT:
+                        commits[entryID] = entry
+                    elif op in (OP_RELEASE, OP_APPLIED):
+                        reservations.pop(entryID, None)
+                        commits.pop(entryID, None)
+        replayed = 0
+        for entryID, commit in commits.items():
+            reservation = reservations.pop(entryID, None)
+            if reservation is not None and commit["count"] > 0:
+                self.store.increment_count(reservation["user"], commit["count"])
+                replayed += 1
+        self.stats["replayed"] += replayed
+        self.stats["dropped"] += len(reservations)
+        if replayed or reservations:
+            logger.info(
+                "Quota journal: applied %d unrecorded commits, dropped %d in-flight reservations",
+                replayed,
+                len(reservations),
+            )
+        with self._lock:
+            self._file = open(self.path, "a", encoding="utf-8")
+            self._compact()
+        return {"replayed": replayed, "dropped": len(reservations)}
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    # --- Protocol ---
+
+    def reserve(self, user_id, tier: str, count: int = 1, used: int = 0, since: float = 0.0) -> tuple:
+        """Takes ``count`` from the user's quota; returns ``(decision, reservation or None)``.
+
+        ``used`` and ``since`` seed the limiter from the stored record the first
+        time this process sees the user.
+        """
+        self.limiter.seed(user_id, tier, used, since)
+        decision = self.limiter.acquire_many(user_id, tier, count)
+        if not decision.allowed:
+            return decision, None
+        reservation = Reservation(next(self._ids), user_id, tier, count)
+        self._append({"op": OP_RESERVE, "id": reservation.id, "user": user_id, "tier": tier, "count": count})
+        self.stats["reserved"] += count
+        return decision, reservation
+
+    def commit(self, reservation: Reservation, count: int | None = None) -> int:
+        """Counts ``count`` keyboxes (default: all reserved) and returns the user's new count.
+
+        The unused rest of the reservation goes back to the limiter.
+        """
+        count = reservation.count if count is None else min(count, reservation.count)
+        self._append({"op": OP_COMMIT, "id": reservation.id, "count": count}, durable=True)
+        if count < reservation.count:
+            self.limiter.refund(reservation.user, reservation.tier, reservation.count - count)
+        total = self.store.increment_count(reservation.user, count)
+        self._append({"op": OP_APPLIED, "id": reservation.id}, settled=True)
+        self.stats["committed"] += count
+        self.stats["released"] += reservation.count - count
+        return total
+
+    def release(self, reservation: Reservation) -> None:
+        """Gives the whole reservation back: nothing was generated."""
+        self.limiter.refund(reservation.user, reservation.tier, reservation.count)
+        self._append({"op": OP_RELEASE, "id": reservation.id}, settled=True)
+        self.stats["released"] += reservation.count
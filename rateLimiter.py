@@ -0,0 +1,377 @@
+"""Per-user and global rate limiting for keybox generation.
+
+Two strategies keep O(1) state per user:
+
+* ``SlidingWindowLog`` remembers at most ``limit`` timestamps and never allows
+  more than ``limit`` requests in any ``window`` seconds.
+* ``TokenBucket`` stores two numbers and refills ``limit`` tokens evenly over
+  ``window`` seconds, which smooths bursts instead of resetting them.
+
+A user whose window has expired (or whose bucket is full again) is in the
+same state as one never seen, so ``RateLimiter.sweep`` drops those entries.
+``RateLimiter.acquire`` returns a ``Decision``. ``SharedRateLimiter`` offers the
+same interface with counters on a Redis-compatible server, for several bot
+instances sharing one quota.
+"""
+
+import threading
+import time
+from collections import deque, namedtuple
+
+STRATEGY_SLIDING_WINDOW = "sliding_window"
+STRATEGY_TOKEN_BUCKET = "token_bucket"
+STRATEGIES = (STRATEGY_SLIDING_WINDOW, STRATEGY_TOKEN_BUCKET)
+SCOPE_USER = "user"
+SCOPE_GLOBAL = "global"
+LOCK_STRIPES = 64  # per-user state is locked by stripe, not by one lock for everyone
+
+# ``scope`` names the limit that denied the request (None when allowed);
+# ``remaining`` is None for unlimited tiers.
+Decision = namedtuple("Decision", ["allowed", "retry_after", "remaining", "scope"])
+
+
+class SlidingWindowLog:
+    def __init__(self, limit: int, window: float):
+        self.limit = limit
+        self.window = window
+        self._logs = {}
+
+    def seed(self, key, used: int, since: float) -> None:
+        """Starts ``key`` with ``used`` requests made at ``since`` (e.g. from a stored record)."""
+        if key not in self._logs:
+            self._logs[key] = deque([since] * min(max(0, used), self.limit), maxlen=self.limit)
+
+    def acquire(self, key, now: float) -> tuple:
+        log = self._logs.get(key)
+        if log is None:
+            log = self._logs[key] = deque(maxlen=self.limit)
+        while log and log[0] <= now - self.window:
+            log.popleft()
+        if len(log) < self.limit:
+            log.append(now)
+            return True, 0.0, self.limit - len(log)
+        return False, log[0] + self.window - now, 0
+
+    def refund(self, key) -> None:
+        log = self._logs.get(key)
+        if log:
+            log.pop()
+
+    def reset(self, key) -> None:
+        self._logs.pop(key, None)
+
+    def remaining(self, key, now: float) -> int:
+        log = self._logs.get(key, ())
+        return self.limit - sum(1 for t in log if t > now - self.window)
+
+    def keys(self) -> list:
+        return list(self._logs)
+
+    def discard_idle(self, key, now: float) -> bool:
+        """Drops ``key`` if none of its requests is still inside the window."""
+        log = self._logs.get(key)
+        if log is None or (log and log[-1] > now - self.window):
+            return False
+        del self._logs[key]
+        return True
+
+
+class TokenBucket:
+    def __init__(self, limit: int, window: float):
+        self.limit = limit
+        self.window = window
+        self.rate = limit / window
+        self._buckets = {}  # key -> [tokens, updated]
+
+    def seed(self, key, used: int, since: float) -> None:
+        if key not in self._buckets:
+            self._buckets[key] = [float(max(0, self.limit - used)), since]
+
+    def _refill(self, key, now: float) -> list:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(self.limit), now]
+        bucket[0] = min(float(self.limit), bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        return bucket
+
+    def acquire(self, key, now: float) -> tuple:
+        bucket = self._refill(key, now)
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True, 0.0, int(bucket[0])
+        return False, (1 - bucket[0]) / self.rate, 0
+
+    def refund(self, key) -> None:
+        bucket = self._buckets.get(key)
+        if bucket:
+            bucket[0] = min(float(self.limit), bucket[0] + 1)
+
+    def reset(self, key) -> None:
+        self._buckets.pop(key, None)
+
+    def remaining(self, key, now: float) -> int:
+        if key not in self._buckets:
+            return self.limit
+        return int(self._refill(key, now)[0])
+
+    def keys(self) -> list:
+        return list(self._buckets)
+
+    def discard_idle(self, key, now: float) -> bool:
+        """Drops ``key`` once its bucket has refilled to ``limit``."""
+        if key not in self._buckets or self._refill(key, now)[0] < self.limit:
+            return False
+        del self._buckets[key]
+        return True
+
+
+def make_strategy(strategy: str, limit: int, window: float):
+    if STRATEGY_TOKEN_BUCKET == strategy:
+        return TokenBucket(limit, window)
+    return SlidingWindowLog(limit, window)
+
+
+class RateLimiter:
+    """Applies a per-tier limit to each user plus an optional global limit.
+
+    ``tiers`` maps a tier name to ``(limit, windowSeconds)``; a limit of 0 means
+    unlimited. The global limit applies to all users together and protects the
+    generation backend. Each user's state is guarded by one of ``LOCK_STRIPES``
+    locks picked by key, so checks for different users do not wait for each
+    other; only the global limit has a single lock, taken after the user's.
+    """
+
+    def __init__(self, strategy: str, tiers: dict, globalLimit: int = 0, globalWindow: float = 60):
+        self.strategy = strategy
+        self.tiers = dict(tiers)
+        self._limiters = {
+            tier: make_strategy(strategy, limit, window)
+            for tier, (limit, window) in self.tiers.items()
+            if limit > 0
+        }
+        self._global = (
+            make_strategy(strategy, globalLimit, globalWindow) if globalLimit > 0 else None
+        )
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._globalLock = threading.Lock()
+
+    def _lock(self, key) -> threading.Lock:
+        return self._locks[hash(key) % LOCK_STRIPES]
+
+    def limit(self, tier: str) -> int:
+        return self.tiers.get(tier, (0, 0))[0]
+
+    def seed(self, key, tier: str, used: int, since: float) -> None:
+        limiter = self._limiters.get(tier)
+        if limiter is not None:
+            with self._lock(key):
+                limiter.seed(key, used, since)
+
+    def acquire(self, key, tier: str, now: float | None = None) -> Decision:
+        """Takes one request from ``key``'s quota and the global quota.
+
+        Nothing is taken when the request is denied.
+        """
+        return self.acquire_many(key, tier, 1, now)
+
+    def acquire_many(self, key, tier: str, count: int, now: float | None = None) -> Decision:
+        """Takes ``count`` requests at once, or none of them."""
+        now = time.time() if now is None else now
+        limiter = self._limiters.get(tier)
+        with self._lock(key):
+            remaining = None
+            taken = 0
+            while limiter is not None and taken < count:
+                allowed, retryAfter, remaining = limiter.acquire(key, now)
+                if not allowed:
+                    for _ in range(taken):
+                        limiter.refund(key)
+                    return Decision(False, retryAfter, 0, SCOPE_USER)
+                taken += 1
+            if self._global is None:
+                return Decision(True, 0.0, remaining, None)
+            with self._globalLock:
+                for globalTaken in range(count):
+                    globalAllowed, globalRetryAfter, _ = self._global.acquire(None, now)
+                    if not globalAllowed:
+                        for _ in range(globalTaken):
+                            self._global.refund(None)
+                        for _ in range(taken):
+                            limiter.refund(key)
+                        return Decision(
+                            False, globalRetryAfter, None if remaining is None else remaining + taken, SCOPE_GLOBAL
+                        )
+            return Decision(True, 0.0, remaining, None)
+
+    def refund(self, key, tier: str, count: int = 1) -> None:
+        """Gives back requests that did not produce a keybox."""
+        limiter = self._limiters.get(tier)
+        if limiter is not None:
+            with self._lock(key):
+                for _ in range(count):
+                    limiter.refund(key)
+        if self._global is not None:
+            with self._globalLock:
+                for _ in range(count):
+                    self._global.refund(None)
+
+    def reset(self, keys) -> None:
+        """Forgets the usage of ``keys`` in every tier (an admin quota reset)."""
+        for key in keys:
+            with self._lock(key):
+                for limiter in self._limiters.values():
+                    limiter.reset(key)
+
+    def remaining(self, key, tier: str) -> int | None:
+        limiter = self._limiters.get(tier)
+        if limiter is None:
+            return None
+        with self._lock(key):
+            return limiter.remaining(key, time.time())
+
+    def sweep(self, now: float | None = None) -> int:
+        """Forgets users whose usage has fully expired; returns how many entries went.
+
+        Such a user is treated exactly as before on their next request, so this
+        only bounds memory. Each key is checked under its own stripe lock.
+        """
+        now = time.time() if now is None else now
+        removed = 0
+        for limiter in self._limiters.values():
+            for key in limiter.keys():
+                with self._lock(key):
+                    removed += limiter.discard_idle(key, now)
+        return removed
+
+
+class SharedRateLimiter:
+    """``RateLimiter`` over a Redis-compatible server, shared by several bot instances.
+
+    Uses a sliding window counter: one counter per key and fixed window, with
+    the previous window's count weighted by how much of it still overlaps the
+    sliding window. Each request is an atomic increment followed by a check,
+    and the increment is undone when the check fails, so concurrent instances
+    can never hand out more than the limit.
+    """
+
+    strategy = "sliding_window_counter"
+
+    def __init__(self, client, tiers: dict, globalLimit: int = 0, globalWindow: float = 60, prefix: str = "ratelimit:"):
+        self.client = client
+        self.tiers = dict(tiers)
+        self.globalLimit = globalLimit
+        self.globalWindow = globalWindow
+        self.prefix = prefix
+
+    def limit(self, tier: str) -> int:
+        return self.tiers.get(tier, (0, 0))[0]
+
+    def _key(self, scope: str, key, window: float, now: float, offset: int = 0) -> str:
+        return f"{self.prefix}{scope}:{key}:{int(now // window) + offset}"
+
+    def _take(self, scope: str, key, limit: int, window: float, count: int, now: float) -> tuple:
+        """Atomically adds ``count`` to the current window; returns (allowed, retryAfter, remaining)."""
+        current = self._key(scope, key, window, now)
+        taken, _, previous = self.client.pipeline(
+            [
+                ("INCRBY", current, count),
+                ("PEXPIRE", current, int(window * 2000)),
+                ("GET", self._key(scope, key, window, now, -1)),
+            ],
+            transaction=True,
+        )
+        previous = int(previous or 0)
+        elapsed = now % window
+        estimate = previous * (1 - elapsed / window) + taken
+        if estimate <= limit:
+            return True, 0.0, int(limit - estimate)
+        self.client.execute("DECRBY", current, count)
+        return False, self._retry_after(previous, taken - count, limit - count + 1, window, elapsed), 0
+
+    @staticmethod
+    def _retry_after(previous: int, current: int, room: int, window: float, elapsed: float) -> float:
+        """Seconds until ``previous * weight + current`` drops to at most ``room - 1``."""
+        target = room - 1
+        if target < 0:
+            return window
+        if previous and current <= target:
+            return max(0.0, window * (1 - (target - current) / previous) - elapsed)
+        # wait for the next window, where the current count becomes the weighted one
+        return window - elapsed + (window * (1 - target / current) if current else 0.0)
+
+    def _give_back(self, scope: str, key, window: float, count: int, now: float) -> None:
+        current = self._key(scope, key, window, now)
+        if self.client.execute("DECRBY", current, count) < 0:
+            self.client.execute("SET", current, 0, "PX", int(window * 2000))
+
+    def seed(self, key, tier: str, used: int, since: float) -> None:
+        """Starts ``key``'s counter from a stored record unless another instance already has."""
+        limit, window = self.tiers.get(tier, (0, 0))
+        if limit <= 0 or used <= 0 or since <= time.time() - window:
+            return
+        self.client.execute(
+            "SET", self._key(SCOPE_USER, key, window, since), min(used, limit), "NX", "PX", int(window * 2000)
+        )
+
+    def acquire(self, key, tier: str, now: float | None = None) -> Decision:
+        return self.acquire_many(key, tier, 1, now)
+
+    def acquire_many(self, key, tier: str, count: int, now: float | None = None) -> Decision:
+        """Takes ``count`` requests at once, or none of them."""
+        now = time.time() if now is None else now
+        limit, window = self.tiers.get(tier, (0, 0))
+        remaining = None
+        if limit > 0:
+            allowed, retryAfter, remaining = self._take(SCOPE_USER, key, limit, window, count, now)
+            if not allowed:
+                return Decision(False, retryAfter, 0, SCOPE_USER)
+        if self.globalLimit > 0:
+            allowed, retryAfter, _ = self._take(
+                SCOPE_GLOBAL, "all", self.globalLimit, self.globalWindow, count, now
+            )
+            if not allowed:
+                if limit > 0:
+                    self._give_back(SCOPE_USER, key, window, count, now)
+                    remaining += count
+                return Decision(False, retryAfter, remaining, SCOPE_GLOBAL)
+        return Decision(True, 0.0, remaining, None)
+
+    def refund(self, key, tier: str, count: int = 1) -> None:
+        """Gives back requests that did not produce a keybox."""
+        now = time.time()
+        limit, window = self.tiers.get(tier, (0, 0))
+        if limit > 0:
+            self._give_back(SCOPE_USER, key, window, count, now)
+        if self.globalLimit > 0:
+            self._give_back(SCOPE_GLOBAL, "all", self.globalWindow, count, now)
+
+    def reset(self, keys) -> None:
+        """Deletes the current and previous window counters of ``keys`` in every tier."""
+        now = time.time()
+        commands = [
+            ("DEL", self._key(SCOPE_USER, key, window, now), self._key(SCOPE_USER, key, window, now, -1))
+            for key in keys
+            for limit, window in set(self.tiers.values())
+            if limit > 0
+        ]
+        if commands:
+            self.client.pipeline(commands)
+
+    def sweep(self, now: float | None = None) -> int:
+        """Nothing to do: the server expires the window counters itself."""
+        return 0
+
+    def remaining(self, key, tier: str) -> int | None:
+        limit, window = self.tiers.get(tier, (0, 0))
+        if limit <= 0:
+            return None
+        now = time.time()
+        current, previous = self.client.pipeline(
+            [
+                ("GET", self._key(SCOPE_USER, key, window, now)),
+                ("GET", self._key(SCOPE_USER, key, window, now, -1)),
+            ]
+        )
+        estimate = int(previous or 0) * (1 - (now % window) / window) + int(current or 0)
+        return max(0, int(limit - estimate))
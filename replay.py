@@ -0,0 +1,180 @@
+"""Replays recorded updates against the bot's webhook endpoint and reports updates per second.
+
+By default the bot is started in webhook mode on localhost, replying to the
+fake Telegram Bot API from ``loadtest.py``, so neither a token nor network
+access is needed. With ``--url`` the updates are POSTed to an endpoint that is
+already running instead. Recorded updates are read from a JSON-lines file with
+one Telegram ``Update`` object per line; without ``--updates``, /start and
+/help commands from distinct chats are used.
+
+Usage:
+    python replay.py [--updates FILE] [--count N] [--connections C]
+    python replay.py --url https://host/telegram --secret TOKEN [--updates FILE]
+    python replay.py --record FILE [--count N]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import tempfile
+import time
+
+import httpx
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+
+import main as bot
+from loadtest import FAKE_TOKEN, FakeTelegramAPI, command_update, percentile
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def load_updates(path: str) -> list:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def synthetic_updates(count: int) -> list:
+    return [
+        command_update(5_000_000 + i, "/help" if i % 2 else "/start") for i in range(count)
+    ]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def post_updates(url: str, secret: str | None, updates: list, connections: int) -> dict:
+    """POSTs ``updates`` over ``connections`` keep-alive connections."""
+    headers = {SECRET_HEADER: secret} if secret else {}
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+    latencies = []
+    failures = 0
+    pending = asyncio.Queue()
+    for updateID, update in enumerate(updates, 1):
+        pending.put_nowait(dict(update, update_id=updateID))
+
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+
+        async def sender():
+            nonlocal failures
+            while not pending.empty():
+                update = pending.get_nowait()
+                sent = time.perf_counter()
+                try:
+                    response = await client.post(url, json=update, headers=headers)
+                    ok = response.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                if ok:
+                    latencies.append((time.perf_counter() - sent) * 1000)
+                else:
+                    failures += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(sender() for _ in range(connections)))
+        seconds = time.perf_counter() - start
+    return {
+        "updates": len(updates),
+        "failures": failures,
+        "seconds": seconds,
+        "updates_per_second": len(latencies) / seconds if seconds > 0 else 0.0,
+        "post_p50_ms": percentile(latencies, 0.5),
+        "post_p99_ms": percentile(latencies, 0.99),
+    }
+
+
+async def run_local(updates: list, connections: int) -> dict:
+    """Runs the bot's webhook server on localhost and replays ``updates`` against it."""
+    api = FakeTelegramAPI()
+    api.start()
+    application = (
+        Application.builder()
+        .token(FAKE_TOKEN)
+        .base_url(api.base_url)
+        .concurrent_updates(bot.CONCURRENT_UPDATES)
+        .build()
+    )
+    bot.register_handlers(application)
+
+    handled = []
+
+    async def count_handled(update: Update, context) -> None:
+        handled.append(time.perf_counter())
+
+    application.add_handler(TypeHandler(Update, count_handled), group=99)  # after the bot's handlers
+    secret = bot.WEBHOOK_SECRET_TOKEN or "replay-secret"
+    port = free_port()
+    await application.initialize()
+    await application.start()
+    await application.updater.start_webhook(
+        listen="127.0.0.1",
+        port=port,
+        url_path=bot.WEBHOOK_PATH,
+        secret_token=secret,
+        max_connections=bot.WEBHOOK_MAX_CONNECTIONS,
+    )
+    try:
+        start = time.perf_counter()
+        result = await post_updates(
+            f"http://127.0.0.1:{port}/{bot.WEBHOOK_PATH}", secret, updates, connections
+        )
+        deadline = time.monotonic() + 60
+        while len(handled) < len(updates) - result["failures"] and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        handledSeconds = (max(handled) - start) if handled else float("nan")
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        api.stop()
+        if bot.worker_pool is not None:
+            bot.worker_pool.shutdown()
+    result["handled"] = len(handled)
+    result["handled_per_second"] = len(handled) / handledSeconds if handled else 0.0
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", help="JSON-lines file of recorded updates")
+    parser.add_argument("--count", type=int, default=1000, help="synthetic updates when no file is given")
+    parser.add_argument("--repeat", type=int, default=1, help="replay the updates this many times")
+    parser.add_argument("--connections", type=int, default=16, help="concurrent HTTP connections")
+    parser.add_argument("--url", help="POST to this running endpoint instead of a local bot")
+    parser.add_argument("--secret", default=bot.WEBHOOK_SECRET_TOKEN, help="secret token for --url")
+    parser.add_argument("--record", help="write the synthetic updates to this file and exit")
+    args = parser.parse_args()
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    updates = load_updates(args.updates) if args.updates else synthetic_updates(args.count)
+    if args.record:
+        with open(args.record, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(update) + "\n" for update in updates)
+        print(f"Wrote {len(updates)} updates to {args.record}")
+        return
+    updates = updates * max(1, args.repeat)
+
+    if args.url:
+        result = asyncio.run(post_updates(args.url, args.secret, updates, args.connections))
+    else:
+        with tempfile.TemporaryDirectory() as scratch:
+            bot.DATA_FILE = os.path.join(scratch, "user_data.json")
+            bot.DATABASE_FILE = os.path.join(scratch, "user_data.db")
+            bot.QUOTA_JOURNAL_FILE = os.path.join(scratch, "quota.journal")
+            result = asyncio.run(run_local(updates, args.connections))
+    print(
+        "{updates} updates POSTed in {seconds:.2f}s: {updates_per_second:.0f} updates/s, "
+        "p50 {post_p50_ms:.1f} ms, p99 {post_p99_ms:.1f} ms, {failures} failures".format(**result)
+    )
+    if "handled" in result:
+        print("{handled} updates handled: {handled_per_second:.0f} updates/s".format(**result))
+
+
+if __name__ == "__main__":
+    main()
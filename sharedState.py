@@ -0,0 +1,584 @@
+"""State shared by several bot instances over the Redis protocol (RESP).
+
+``RespClient`` is a small, dependency-free client for a Redis-compatible
+server. Several bot replicas that point at the same server share user records
+(``storage.RedisUserStore``), rate-limit counters
+(``rateLimiter.SharedRateLimiter``) and admin conversation state
+(``SharedConversationState``).
+
+``LocalRespServer`` is an in-process stand-in that speaks the subset of RESP
+these classes use, for development and load tests without a Redis server:
+
+    python sharedState.py --port 6379
+"""
+
+import argparse
+import copy
+import select
+import socket
+import socketserver
+import threading
+import time
+from queue import Empty, LifoQueue
+from urllib.parse import urlparse
+
+DEFAULT_PORT = 6379
+
+
+class RespError(Exception):
+    """An error reply from the server."""
+
+
+class _Unsent(ConnectionError):
+    """The connection failed before any byte of the request was written."""
+
+
+def _encode(args) -> bytes:
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, bytes):
+            data = arg
+        else:
+            data = str(arg).encode("utf-8")
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(parts)
+
+
+def _read_reply(reader):
+    line = reader.readline()
+    if not line:
+        raise ConnectionError("connection closed by the server")
+    kind, payload = line[:1], line[1:-2]
+    if kind == b"+":
+        return payload.decode("utf-8")
+    if kind == b"-":
+        return RespError(payload.decode("utf-8"))
+    if kind == b":":
+        return int(payload)
+    if kind == b"$":
+        length = int(payload)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        return data[:-2].decode("utf-8")
+    if kind == b"*":
+        length = int(payload)
+        if length < 0:
+            return None
+        return [_read_reply(reader) for _ in range(length)]
+    raise ConnectionError(f"unexpected reply {line!r}")
+
+
+class RespClient:
+    """Thread-safe client with a small pool of connections."""
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = DEFAULT_PORT,
+        db: int = 0,
+        password: str | None = None,
+        timeout: float = 5.0,
+        poolSize: int = 16,
+    ):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._pool = LifoQueue(maxsize=poolSize)
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> "RespClient":
+        """Parses ``redis://[:password@]host[:port][/db]``."""
+        parsed = urlparse(url)
+        db = parsed.path.strip("/")
+        return cls(
+            parsed.hostname or "127.0.0.1",
+            parsed.port or DEFAULT_PORT,
+            int(db) if db else 0,
+            parsed.password,
+            **kwargs,
+        )
+
+    def _connect(self) -> tuple:
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = (sock, sock.makefile("rb"))
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        for reply in self._send(connection, setup):
+            if isinstance(reply, RespError):
+                raise reply
+        return connection
+
+    @staticmethod
+    def _send(connection: tuple, commands: list) -> list:
+        sock, reader = connection
+        if commands:
+            data = b"".join(_encode(command) for command in commands)
+            try:
+                sent = sock.send(data)
+            except OSError as e:
+                raise _Unsent(str(e)) from e
+            if sent < len(data):
+                sock.sendall(data[sent:])
+        return [_read_reply(reader) for _ in commands]
+
+    @staticmethod
+    def _stale(connection: tuple) -> bool:
+        """Whether an idle pooled connection became readable: closed by the server (or out of step)."""
+        readable, _, _ = select.select([connection[0]], [], [], 0)
+        return bool(readable)
+
+    @staticmethod
+    def _discard(connection: tuple) -> None:
+        sock, reader = connection
+        reader.close()
+        sock.close()
+
+    def _release(self, connection: tuple) -> None:
+        try:
+            self._pool.put_nowait(connection)
+        except Exception:
+            self._discard(connection)
+
+    def pipeline(self, commands: list, transaction: bool = False) -> list:
+        """Sends several commands in one round trip and returns their replies.
+
+        With ``transaction`` the commands run atomically inside MULTI/EXEC.
+        Error replies are returned as ``RespError`` instances, not raised.
+
+        Commands are only sent again when a pooled connection failed before any
+        of them was written. Once they are on the wire the server may have run
+        them, so a failure (a timeout, a reset) is raised rather than retried:
+        running INCRBY or a quota transaction twice would count twice.
+        """
+        if transaction:
+            commands = [("MULTI",)] + list(commands) + [("EXEC",)]
+        connection, replies = self._checkout(commands)
+        self._release(connection)
+        if transaction:
+            result = replies[-1]
+            if isinstance(result, RespError):
+                raise result
+            if result is None:
+                raise RespError("transaction aborted")
+            return result
+        return replies
+
+    def _checkout(self, commands: list) -> tuple:
+        """Sends ``commands`` on a pooled or new connection; returns ``(connection, replies)``."""
+        while True:
+            try:
+                connection, pooled = self._pool.get_nowait(), True
+            except Empty:
+                connection, pooled = self._connect(), False
+            if pooled and self._stale(connection):
+                self._discard(connection)
+                continue
+            try:
+                return connection, self._send(connection, commands)
+            except _Unsent:
+                self._discard(connection)
+                if pooled:
+                    continue  # nothing reached the server: safe to send on another connection
+                raise
+            except (OSError, ConnectionError):
+                self._discard(connection)
+                raise
+
+    def watch(self, keys: list, reads: list, build) -> list | None:
+        """Runs an optimistic (WATCH) transaction on one connection.
+
+        ``reads`` run after WATCHing ``keys``; ``build(replies)`` returns the
+        commands to run in MULTI/EXEC. Returns their replies, ``[]`` when
+        ``build`` returned nothing, or None when a watched key changed before
+        EXEC, in which case nothing ran and the caller may try again.
+        """
+        connection, replies = self._checkout([("WATCH", *keys)] + list(reads))
+        try:
+            for reply in replies:
+                if isinstance(reply, RespError):
+                    raise reply
+            commands = build(replies[1:])
+            if not commands:
+                self._send(connection, [("UNWATCH",)])
+                result = []
+            else:
+                result = self._send(connection, [("MULTI",)] + list(commands) + [("EXEC",)])[-1]
+        except BaseException:
+            self._discard(connection)  # it may still be watching, or be out of step
+            raise
+        self._release(connection)
+        if isinstance(result, RespError):
+            raise result
+        return result
+
+    def execute(self, *args):
+        reply = self.pipeline([args])[0]
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+    def close(self) -> None:
+        while True:
+            try:
+                connection = self._pool.get_nowait()
+            except Empty:
+                return
+            self._discard(connection)
+
+
+class LocalConversationState:
+    """Per-user admin conversation steps kept in this process."""
+
+    def __init__(self):
+        self._actions = {}
+        self._lock = threading.Lock()
+
+    def set(self, user_id, action: str, ttl: int = 600) -> None:
+        with self._lock:
+            self._actions[user_id] = (action, time.monotonic() + ttl)
+
+    def pop(self, user_id) -> str | None:
+        with self._lock:
+            action, expires = self._actions.pop(user_id, (None, 0))
+        return action if expires > time.monotonic() else None
+
+
+class SharedConversationState:
+    """Per-user admin conversation steps shared by all instances."""
+
+    def __init__(self, client: RespClient, prefix: str = "conversation:"):
+        self.client = client
+        self.prefix = prefix
+
+    def set(self, user_id, action: str, ttl: int = 600) -> None:
+        self.client.execute("SET", f"{self.prefix}{user_id}", action, "EX", ttl)
+
+    def pop(self, user_id) -> str | None:
+        return self.client.execute("GETDEL", f"{self.prefix}{user_id}")
+
+
+# --- Local stand-in server ---
+
+
+class _SortedSet(dict):
+    """member -> score"""
+
+
+def _score_bound(bound: str) -> tuple:
+    """Parses a ZRANGEBYSCORE bound into ``(score, exclusive)``."""
+    exclusive = bound.startswith("(")
+    value = bound[1:] if exclusive else bound
+    return float(value.replace("+inf", "inf")), exclusive
+
+
+class _Store:
+    """The stand-in's keyspace: strings, hashes, sets and sorted sets with optional expiry."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}
+        self.expires = {}
+
+    def get(self, key, kind=None):
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        value = self.data.get(key)
+        if value is not None and kind is not None and type(value) is not kind:
+            raise RespError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def set(self, key, value, ttl=None) -> None:
+        self.data[key] = value
+        if ttl is None:
+            self.expires.pop(key, None)
+        else:
+            self.expires[key] = time.monotonic() + ttl
+
+    def delete(self, key) -> int:
+        self.expires.pop(key, None)
+        return 1 if self.data.pop(key, None) is not None else 0
+
+    def incr(self, key, amount: int) -> int:
+        value = int(self.get(key, str) or 0) + amount
+        self.data[key] = str(value)
+        return value
+
+    def run(self, name: str, args: list):
+        handler = getattr(self, "cmd_" + name.lower(), None)
+        if handler is None:
+            raise RespError(f"ERR unknown command '{name}'")
+        return handler(*args)
+
+    def cmd_ping(self, *args):
+        return args[0] if args else "PONG"
+
+    def cmd_select(self, db):
+        return "OK"
+
+    def cmd_flushall(self):
+        self.data.clear()
+        self.expires.clear()
+        return "OK"
+
+    def cmd_get(self, key):
+        return self.get(key, str)
+
+    def cmd_set(self, key, value, *options):
+        options = [option.upper() for option in options]
+        ttl = None
+        if "EX" in options:
+            ttl = float(options[options.index("EX") + 1])
+        if "PX" in options:
+            ttl = float(options[options.index("PX") + 1]) / 1000
+        if "NX" in options and self.get(key) is not None:
+            return None
+        self.set(key, value, ttl)
+        return "OK"
+
+    def cmd_getdel(self, key):
+        value = self.get(key, str)
+        self.delete(key)
+        return value
+
+    def cmd_del(self, *keys):
+        return sum(self.delete(key) for key in keys)
+
+    def cmd_exists(self, *keys):
+        return sum(1 for key in keys if self.get(key) is not None)
+
+    def cmd_incr(self, key):
+        return self.incr(key, 1)
+
+    def cmd_incrby(self, key, amount):
+        return self.incr(key, int(amount))
+
+    def cmd_decr(self, key):
+        return self.incr(key, -1)
+
+    def cmd_decrby(self, key, amount):
+        return self.incr(key, -int(amount))
+
+    def cmd_pexpire(self, key, milliseconds):
+        if self.get(key) is None:
+            return 0
+        self.expires[key] = time.monotonic() + int(milliseconds) / 1000
+        return 1
+
+    def cmd_expire(self, key, seconds):
+        return self.cmd_pexpire(key, int(seconds) * 1000)
+
+    def cmd_hset(self, key, *pairs):
+        value = self.get(key, dict)
+        if value is None:
+            value = self.data[key] = {}
+        added = 0
+        for field, item in zip(pairs[::2], pairs[1::2]):
+            added += field not in value
+            value[field] = item
+        return added
+
+    def cmd_hsetnx(self, key, field, item):
+        value = self.get(key, dict)
+        if value is not None and field in value:
+            return 0
+        return self.cmd_hset(key, field, item)
+
+    def cmd_hget(self, key, field):
+        return (self.get(key, dict) or {}).get(field)
+
+    def cmd_hgetall(self, key):
+        return [part for pair in (self.get(key, dict) or {}).items() for part in pair]
+
+    def cmd_hincrby(self, key, field, amount):
+        value = self.get(key, dict)
+        if value is None:
+            value = self.data[key] = {}
+        value[field] = str(int(value.get(field, 0)) + int(amount))
+        return int(value[field])
+
+    def cmd_sadd(self, key, *members):
+        value = self.get(key, set)
+        if value is None:
+            value = self.data[key] = set()
+        before = len(value)
+        value.update(members)
+        return len(value) - before
+
+    def cmd_srem(self, key, *members):
+        value = self.get(key, set) or set()
+        before = len(value)
+        value.difference_update(members)
+        return before - len(value)
+
+    def cmd_smembers(self, key):
+        return sorted(self.get(key, set) or ())
+
+    def cmd_scard(self, key):
+        return len(self.get(key, set) or ())
+
+    def cmd_sismember(self, key, member):
+        return int(member in (self.get(key, set) or ()))
+
+    def cmd_zadd(self, key, *pairs):
+        value = self.get(key, _SortedSet)
+        if value is None:
+            value = self.data[key] = _SortedSet()
+        added = 0
+        for score, member in zip(pairs[::2], pairs[1::2]):
+            added += member not in value
+            value[member] = float(score)
+        return added
+
+    def cmd_zrem(self, key, *members):
+        value = self.get(key, _SortedSet) or {}
+        return sum(1 for member in members if value.pop(member, None) is not None)
+
+    def cmd_zcard(self, key):
+        return len(self.get(key, _SortedSet) or ())
+
+    def _range_by_score(self, key, low, high, options, reverse):
+        low, lowExclusive = _score_bound(low)
+        high, highExclusive = _score_bound(high)
+        members = [
+            (score, member)
+            for member, score in (self.get(key, _SortedSet) or {}).items()
+            if (score > low if lowExclusive else score >= low)
+            and (score < high if highExclusive else score <= high)
+        ]
+        members.sort(reverse=reverse)
+        result = [member for _, member in members]
+        if options and options[0].upper() == "LIMIT":
+            offset, count = int(options[1]), int(options[2])
+            result = result[offset:] if count < 0 else result[offset : offset + count]
+        return result
+
+    def cmd_zrangebyscore(self, key, low, high, *options):
+        return self._range_by_score(key, low, high, options, False)
+
+    def cmd_zrevrangebyscore(self, key, high, low, *options):
+        return self._range_by_score(key, low, high, options, True)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        store = self.server.store
+        queued = None  # commands between MULTI and EXEC
+        watched = {}  # key -> its value at WATCH; EXEC aborts if one differs
+        while True:
+            try:
+                request = _read_reply(self.rfile)
+            except (ConnectionError, OSError, ValueError):
+                return
+            if not isinstance(request, list) or not request:
+                return
+            name, args = request[0].upper(), request[1:]
+            if name == "MULTI":
+                queued = []
+                reply = "OK"
+            elif name == "WATCH" and queued is None:
+                with store.lock:
+                    watched.update((key, copy.deepcopy(store.get(key))) for key in args)
+                reply = "OK"
+            elif name == "UNWATCH":
+                watched = {}
+                reply = "OK"
+            elif name == "EXEC":
+                if queued is None:
+                    reply = RespError("ERR EXEC without MULTI")
+                else:
+                    with store.lock:
+                        if any(store.get(key) != value for key, value in watched.items()):
+                            reply = None
+                        else:
+                            reply = [self._run(store, command) for command in queued]
+                    queued = None
+                    watched = {}
+            elif queued is not None:
+                queued.append(request)
+                reply = "QUEUED"
+            else:
+                with store.lock:
+                    reply = self._run(store, request)
+            try:
+                self.wfile.write(self._encode_reply(reply))
+            except OSError:
+                return
+
+    @staticmethod
+    def _run(store: _Store, request: list):
+        try:
+            return store.run(request[0], request[1:])
+        except RespError as e:
+            return e
+        except (TypeError, ValueError) as e:
+            return RespError(f"ERR {e}")
+
+    @classmethod
+    def _encode_reply(cls, reply) -> bytes:
+        if reply is None:
+            return b"$-1\r\n"
+        if isinstance(reply, RespError):
+            return b"-%s\r\n" % str(reply).encode("utf-8")
+        if isinstance(reply, bool) or isinstance(reply, int):
+            return b":%d\r\n" % reply
+        if isinstance(reply, list):
+            return b"*%d\r\n" % len(reply) + b"".join(cls._encode_reply(item) for item in reply)
+        if reply in ("OK", "QUEUED", "PONG"):
+            return b"+%s\r\n" % reply.encode("utf-8")
+        data = str(reply).encode("utf-8")
+        return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+class LocalRespServer(socketserver.ThreadingTCPServer):
+    """A minimal Redis-compatible server; every command runs under one lock."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 256
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), _Handler)
+        self.store = _Store()
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"redis://{host}:{port}/0"
+
+    def start(self) -> "LocalRespServer":
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Runs the local Redis-compatible stand-in server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+    server = LocalRespServer(args.host, args.port)
+    print(f"Serving {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
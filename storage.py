@@ -0,0 +1,1131 @@
+"""User record storage for the bot.
+
+The backends share one interface:
+
+* ``SQLiteUserStore`` keeps one row per user in an SQLite database in WAL
+  mode, so a request reads and writes only its own row.
+* ``JSONUserStore`` keeps the original ``user_data.json`` layout.
+* ``CachedJSONUserStore`` loads ``user_data.json`` once, serves requests from
+  memory and writes changes back in batches.
+* ``RedisUserStore`` keeps one hash per user on a Redis-compatible server, so
+  several bot instances share the same records.
+
+Records are plain dicts with ``count``, ``last_reset``, ``vip`` and
+``last_active`` keys. ``list_users`` pages through users in user ID order with
+a keyset cursor (``after``/``before`` a user ID) and optional filters.
+``reset_window`` starts a new quota window only if nobody has done so since
+the caller read the record, and touches nothing but the count and window.
+``update_users`` applies one admin change to many users in one transaction;
+``read_user_ids`` and ``export_users`` are its import and export formats.
+``purge_expired`` drops the records that no longer hold anything (see
+``is_expired``) and ``compact_store`` runs it, compacts the store and measures
+what that saved.
+"""
+
+import bisect
+import csv
+import gzip
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from sharedState import RespClient
+
+STORE_SQLITE = "sqlite"
+STORE_JSON = "json"
+STORE_JSON_CACHED = "json-cached"
+STORE_REDIS = "redis"
+STORES = (STORE_SQLITE, STORE_JSON, STORE_JSON_CACHED, STORE_REDIS)
+PURGE_BATCH = 1000  # users deleted per transaction, so requests are never held up for long
+PURGE_ATTEMPTS = 3  # WATCH transactions per Redis batch before it waits for the next run
+
+
+def default_record() -> dict:
+    return {"count": 0, "last_reset": int(time.time()), "vip": False, "last_active": 0}
+
+
+def user_filter(vipOnly: bool = False, quota: tuple | None = None, activeSince: int | None = None):
+    """Returns a predicate for ``list_users``.
+
+    ``quota`` is ``(limit, windowStart)`` and selects non-VIP users that used
+    at least ``limit`` keyboxes in a window that started at or after
+    ``windowStart``; ``activeSince`` selects users who generated a keybox at
+    or after that timestamp.
+    """
+
+    def matches(record: dict) -> bool:
+        if vipOnly and not record["vip"]:
+            return False
+        if quota is not None:
+            limit, windowStart = quota
+            if record["vip"] or record["count"] < limit or record["last_reset"] < windowStart:
+                return False
+        if activeSince is not None and record.get("last_active", 0) < activeSince:
+            return False
+        return True
+
+    return matches
+
+
+def is_expired(record: dict, expiredBefore: int) -> bool:
+    """Whether a record holds nothing: not VIP, and its quota window and last keybox both predate ``expiredBefore``.
+
+    A user without a record is treated as a new user, which is what an
+    expired window amounts to anyway.
+    """
+    return (
+        not record["vip"]
+        and record["last_reset"] < expiredBefore
+        and record.get("last_active", 0) < expiredBefore
+    )
+
+
+def _bulk_update(record: dict | None, vip: bool | None, resetQuota: bool, now: int) -> dict | None:
+    """Applies an ``update_users`` change to one record; None leaves the user alone."""
+    if record is None:
+        if not vip:
+            return None  # revoking or resetting a user who never used the bot is a no-op
+        record = default_record()
+    record = dict(record)
+    if vip is not None:
+        record["vip"] = vip
+    if resetQuota:
+        record["count"] = 0
+        record["last_reset"] = now
+    return record
+
+
+def read_user_ids(data: bytes) -> tuple:
+    """Parses an uploaded list of user IDs; returns ``(sorted unique IDs, skipped entries)``.
+
+    JSON may be a list of IDs, a list of objects with a ``user_id`` (or ``id``)
+    key, or an object keyed by user ID such as ``user_data.json`` or an
+    export. Anything else is read as CSV: the ``user_id`` column if there is a
+    header naming it, otherwise the first column.
+    """
+    text = data.decode("utf-8-sig")
+    try:
+        parsed = json.loads(text)
+    except ValueError:
+        parsed = None
+    if isinstance(parsed, dict):
+        values = list(parsed)
+    elif isinstance(parsed, list):
+        values = [
+            (item.get("user_id", item.get("id")) if isinstance(item, dict) else item) for item in parsed
+        ]
+    else:
+        rows = [row for row in csv.reader(io.StringIO(text)) if row and any(cell.strip() for cell in row)]
+        column = 0
+        if rows:
+            header = [cell.strip().lower() for cell in rows[0]]
+            if "user_id" in header:
+                column = header.index("user_id")
+                rows = rows[1:]
+            elif not header[0].lstrip("-").isdigit():
+                rows = rows[1:]  # some other header row
+        values = [row[column] if len(row) > column else None for row in rows]
+
+    userIDs, skipped = set(), 0
+    for value in values:
+        try:
+            userIDs.add(int(str(value).strip()))
+        except ValueError:
+            skipped += 1
+    return sorted(userIDs), skipped
+
+
+EXPORT_COLUMNS = ("user_id", "count", "last_reset", "vip", "last_active")
+
+
+def _export_row(user_id, record: dict) -> tuple:
+    return (user_id, record["count"], record["last_reset"], int(record["vip"]), record.get("last_active", 0))
+
+
+def export_users(store, fileobj, batchSize: int = 1000) -> int:
+    """Writes every user to ``fileobj`` as gzip-compressed CSV; returns the number of users.
+
+    Users are read one ``list_users`` page at a time, so neither the table nor
+    the CSV is ever held in memory as a whole.
+    """
+    written = 0
+    # closing the wrapper closes the gzip stream, which leaves ``fileobj`` open
+    with io.TextIOWrapper(gzip.GzipFile(fileobj=fileobj, mode="wb"), encoding="utf-8", newline="") as text:
+        writer = csv.writer(text)
+        writer.writerow(EXPORT_COLUMNS)
+        after = None
+        while True:
+            page = store.list_users(after=after, limit=batchSize)
+            if not page:
+                break
+            writer.writerows(_export_row(user_id, record) for user_id, record in page)
+            written += len(page)
+            after = page[-1][0]
+    return written
+
+
+def archive_users(rows: list, path: str) -> None:
+    """Writes ``[(user_id, record)]`` to ``path`` in the export format (gzip-compressed CSV) and fsyncs it."""
+    with open(path, "wb") as f:
+        with io.TextIOWrapper(gzip.GzipFile(fileobj=f, mode="wb"), encoding="utf-8", newline="") as text:
+            writer = csv.writer(text)
+            writer.writerow(EXPORT_COLUMNS)
+            writer.writerows(_export_row(user_id, record) for user_id, record in rows)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _load_seconds(store, repeat: int = 2) -> float:
+    """Times reading every record the way a (re)start does, with ``read_all`` (never under the store's lock).
+
+    The best of ``repeat`` reads is taken, so a cold first read does not
+    count as an improvement.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        store.read_all()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def compact_store(store, expiredBefore: int, archiveDirectory: str | None = None) -> dict:
+    """Drops the expired users (archiving them first), compacts the store and measures the gain.
+
+    With ``archiveDirectory`` the dropped users are written there as
+    ``users-<UTC time>.csv.gz`` before they are deleted. Returns
+    ``{"removed", "remaining", "archive", "bytes_before", "bytes_after",
+    "load_seconds_before", "load_seconds_after", "seconds", "finished"}``;
+    the sizes are None for a store without a local file.
+    """
+    start = time.perf_counter()
+    bytesBefore = store.size()
+    loadBefore = _load_seconds(store)
+    archive = None
+
+    def write_archive(rows: list) -> None:
+        nonlocal archive
+        os.makedirs(archiveDirectory, exist_ok=True)
+        archive = os.path.join(archiveDirectory, f"users-{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}.csv.gz")
+        archive_users(rows, archive)
+
+    removed = store.purge_expired(expiredBefore, write_archive if archiveDirectory else None)
+    store.compact()
+    return {
+        "removed": removed,
+        "remaining": store.count(),
+        "archive": archive,
+        "bytes_before": bytesBefore,
+        "bytes_after": store.size(),
+        "load_seconds_before": loadBefore,
+        "load_seconds_after": _load_seconds(store),
+        "seconds": time.perf_counter() - start,
+        "finished": int(time.time()),
+    }
+
+
+def _page(userIDs: list, lookup, after, before, limit: int, matches) -> list:
+    """Keyset page over the sorted ``userIDs``; returns ``[(user_id, record)]`` in ID order."""
+    rows = []
+    if before is not None:
+        index = bisect.bisect_left(userIDs, int(before)) - 1
+        while index >= 0 and len(rows) < limit:
+            record = lookup(userIDs[index])
+            if record is not None and matches(record):
+                rows.append((userIDs[index], record))
+            index -= 1
+        rows.reverse()
+        return rows
+    index = bisect.bisect_right(userIDs, int(after)) if after is not None else 0
+    while index < len(userIDs) and len(rows) < limit:
+        record = lookup(userIDs[index])
+        if record is not None and matches(record):
+            rows.append((userIDs[index], record))
+        index += 1
+    return rows
+
+
+class JSONUserStore:
+    """Stores every user in a single JSON document (the original format).
+
+    Every change reads the whole file and writes it back, so changes hold
+    ``_writeLock`` from the read to the write; otherwise two of them would
+    each save the file without the other's change.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._writeLock = threading.RLock()
+
+    def load_all(self) -> dict:
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save_all(self, data: dict) -> None:
+        """Writes a temporary file and renames it over the old one, so a crash never truncates it."""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with self._writeLock:
+            fd, tmpPath = tempfile.mkstemp(prefix=".user_data-", suffix=".tmp", dir=directory)
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(data, f, indent=4)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmpPath, self.path)
+            except BaseException:
+                try:
+                    os.unlink(tmpPath)
+                except OSError:
+                    pass
+                raise
+
+    def get_user(self, user_id) -> dict:
+        return self.load_all().get(str(user_id)) or default_record()
+
+    def has_user(self, user_id) -> bool:
+        return str(user_id) in self.load_all()
+
+    def save_user(self, user_id, record: dict) -> None:
+        with self._writeLock:
+            data = self.load_all()
+            data[str(user_id)] = record
+            self.save_all(data)
+
+    def increment_count(self, user_id, amount: int = 1) -> int:
+        """Adds ``amount`` to the user's count and returns the new count."""
+        with self._writeLock:
+            data = self.load_all()
+            record = data.get(str(user_id)) or default_record()
+            record["count"] += amount
+            record["last_active"] = int(time.time())
+            data[str(user_id)] = record
+            self.save_all(data)
+        return record["count"]
+
+    def reset_window(self, user_id, expectedReset: int, now: int) -> bool:
+        """Sets count 0 and ``last_reset`` ``now`` if the window still starts at ``expectedReset``; returns whether it did."""
+        with self._writeLock:
+            data = self.load_all()
+            record = data.get(str(user_id))
+            if record is None or record["last_reset"] != expectedReset:
+                return False
+            record["count"] = 0
+            record["last_reset"] = now
+            self.save_all(data)
+        return True
+
+    def count(self) -> int:
+        return len(self.load_all())
+
+    def list_users(self, after=None, before=None, limit: int = 20, **filters) -> list:
+        data = self.load_all()
+        userIDs = sorted(int(user_id) for user_id in data)
+        return _page(
+            userIDs, lambda user_id: data.get(str(user_id)), after, before, limit, user_filter(**filters)
+        )
+
+    def update_users(self, userIDs, vip: bool | None = None, resetQuota: bool = False) -> int:
+        """Sets VIP status and/or resets the quota of ``userIDs`` in one write; returns the users changed.
+
+        ``vip=True`` creates missing users; revoking or resetting skips them.
+        """
+        now = int(time.time())
+        changed = 0
+        with self._writeLock:
+            data = self.load_all()
+            for user_id in userIDs:
+                record = _bulk_update(data.get(str(user_id)), vip, resetQuota, now)
+                if record is not None:
+                    data[str(user_id)] = record
+                    changed += 1
+            if changed:
+                self.save_all(data)
+        return changed
+
+    def purge_expired(self, expiredBefore: int, archive=None) -> int:
+        """Deletes the users ``is_expired`` selects; returns how many.
+
+        ``archive`` is called with their ``[(user_id, record)]`` first, and an
+        exception from it leaves them in place. Users active again since the
+        scan are kept.
+        """
+        rows = sorted(
+            (int(user_id), record)
+            for user_id, record in self.load_all().items()
+            if is_expired(record, expiredBefore)
+        )
+        if not rows:
+            return 0
+        if archive is not None:
+            archive(rows)  # outside the lock: requests go on meanwhile
+        removed = 0
+        with self._writeLock:
+            data = self.load_all()
+            for user_id, _ in rows:
+                record = data.get(str(user_id))
+                if record is not None and is_expired(record, expiredBefore):
+                    del data[str(user_id)]
+                    removed += 1
+            if removed:
+                self.save_all(data)
+        return removed
+
+    def compact(self) -> None:
+        pass  # every save rewrites the whole file
+
+    def read_all(self) -> dict:
+        """Parses the file, as a (re)start does; the cached store's memory is not involved."""
+        return JSONUserStore.load_all(self)
+
+    def size(self) -> int | None:
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def close(self) -> None:
+        pass
+
+
+class CachedJSONUserStore(JSONUserStore):
+    """Serves user records from memory and flushes changes to the JSON file.
+
+    Changes are written when ``flushThreshold`` users are dirty, every
+    ``flushInterval`` seconds, and on ``close()``.
+    """
+
+    def __init__(self, path: str, flushInterval: float = 5.0, flushThreshold: int = 100):
+        super().__init__(path)
+        self.flushInterval = flushInterval
+        self.flushThreshold = max(1, int(flushThreshold))
+        self._lock = threading.Lock()
+        self._flushLock = threading.Lock()
+        self._data = super().load_all()
+        self._ids = sorted(int(user_id) for user_id in self._data)  # index for list_users
+        self._dirty = set()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self._flusher = None
+        if flushInterval > 0:
+            self._flusher = threading.Thread(target=self._flush_periodically, name="store-flush", daemon=True)
+            self._flusher.start()
+
+    def _flush_periodically(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.flushInterval)
+            self._wake.clear()
+            if not self._stop.is_set():
+                self.flush()
+
+    def load_all(self) -> dict:
+        with self._lock:
+            return {user_id: dict(record) for user_id, record in self._data.items()}
+
+    def save_all(self, data: dict) -> None:
+        with self._lock:
+            for user_id, record in data.items():
+                if str(user_id) not in self._data:
+                    bisect.insort(self._ids, int(user_id))
+                self._data[str(user_id)] = dict(record)
+                self._dirty.add(str(user_id))
+            full = len(self._dirty) >= self.flushThreshold
+        if full:
+            self._flush_soon()
+
+    def _flush_soon(self) -> None:
+        if self._flusher is not None:
+            self._wake.set()  # write behind, off the request path
+        else:
+            self.flush()
+
+    def get_user(self, user_id) -> dict:
+        with self._lock:
+            record = self._data.get(str(user_id))
+            if record is None:
+                self.misses += 1
+                return default_record()
+            self.hits += 1
+            return dict(record)
+
+    def has_user(self, user_id) -> bool:
+        with self._lock:
+            return str(user_id) in self._data
+
+    def save_user(self, user_id, record: dict) -> None:
+        self.save_all({str(user_id): record})
+
+    def increment_count(self, user_id, amount: int = 1) -> int:
+        """Adds ``amount`` to the user's count under the lock and returns the new count."""
+        key = str(user_id)
+        with self._lock:
+            record = self._data.get(key)
+            if record is None:
+                record = self._data[key] = default_record()
+                bisect.insort(self._ids, int(user_id))
+            record["count"] += amount
+            record["last_active"] = int(time.time())
+            self._dirty.add(key)
+            count = record["count"]
+            full = len(self._dirty) >= self.flushThreshold
+        if full:
+            self._flush_soon()
+        return count
+
+    def reset_window(self, user_id, expectedReset: int, now: int) -> bool:
+        """Like ``JSONUserStore.reset_window``, under the cache lock."""
+        key = str(user_id)
+        with self._lock:
+            record = self._data.get(key)
+            if record is None or record["last_reset"] != expectedReset:
+                return False
+            record["count"] = 0
+            record["last_reset"] = now
+            self._dirty.add(key)
+            full = len(self._dirty) >= self.flushThreshold
+        if full:
+            self._flush_soon()
+        return True
+
+    def count(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+    def list_users(self, after=None, before=None, limit: int = 20, **filters) -> list:
+        with self._lock:
+            return _page(
+                self._ids,
+                lambda user_id: dict(self._data[str(user_id)]),
+                after,
+                before,
+                limit,
+                user_filter(**filters),
+            )
+
+    def update_users(self, userIDs, vip: bool | None = None, resetQuota: bool = False) -> int:
+        """Like ``JSONUserStore.update_users``; the change is written back at once."""
+        now = int(time.time())
+        changed = 0
+        with self._lock:
+            for user_id in userIDs:
+                key = str(user_id)
+                record = _bulk_update(self._data.get(key), vip, resetQuota, now)
+                if record is None:
+                    continue
+                if key not in self._data:
+                    bisect.insort(self._ids, int(user_id))
+                self._data[key] = record
+                self._dirty.add(key)
+                changed += 1
+        if changed:
+            self.flush()
+        return changed
+
+    def purge_expired(self, expiredBefore: int, archive=None) -> int:
+        """Like ``JSONUserStore.purge_expired``; users active again since the scan are kept."""
+        with self._lock:
+            rows = sorted(
+                (int(user_id), dict(record))
+                for user_id, record in self._data.items()
+                if is_expired(record, expiredBefore)
+            )
+        if not rows:
+            return 0
+        if archive is not None:
+            archive(rows)  # outside the lock: requests go on meanwhile
+        removed = 0
+        with self._lock:
+            for user_id, _ in rows:
+                record = self._data.get(str(user_id))
+                if record is not None and is_expired(record, expiredBefore):
+                    del self._data[str(user_id)]
+                    self._dirty.add(str(user_id))  # makes the next flush write the file without it
+                    removed += 1
+            if removed:
+                self._ids = sorted(int(user_id) for user_id in self._data)
+        return removed
+
+    def compact(self) -> None:
+        self.flush()
+
+    def flush(self) -> bool:
+        """Writes the cached records if any are dirty; returns whether a write happened."""
+        with self._flushLock:
+            with self._lock:
+                if not self._dirty:
+                    return False
+                snapshot = {user_id: dict(record) for user_id, record in self._data.items()}
+                dirty = self._dirty
+                self._dirty = set()
+            try:
+                JSONUserStore.save_all(self, snapshot)
+            except BaseException:
+                with self._lock:
+                    self._dirty |= dirty  # keep them for the next attempt
+                raise
+            with self._lock:
+                self.flushes += 1
+            return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "users": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "flushes": self.flushes,
+                "dirty": len(self._dirty),
+            }
+
+    def close(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+
+
+class SQLiteUserStore:
+    """Stores one row per user, keyed by the Telegram user ID."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "user_id INTEGER PRIMARY KEY, "
+            "count INTEGER NOT NULL DEFAULT 0, "
+            "last_reset INTEGER NOT NULL, "
+            "vip INTEGER NOT NULL DEFAULT 0, "
+            "last_active INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(users)")}
+        if "last_active" not in columns:  # databases created before list_users
+            self._db.execute("ALTER TABLE users ADD COLUMN last_active INTEGER NOT NULL DEFAULT 0")
+        # indexes for the list_users filters
+        self._db.execute("CREATE INDEX IF NOT EXISTS users_vip ON users (vip, user_id)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS users_quota ON users (vip, count, last_reset)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS users_last_active ON users (last_active)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    @staticmethod
+    def _record(row) -> dict:
+        return {"count": row[0], "last_reset": row[1], "vip": bool(row[2]), "last_active": row[3]}
+
+    @staticmethod
+    def _row(user_id, record: dict) -> tuple:
+        return (
+            int(user_id),
+            record["count"],
+            record["last_reset"],
+            int(record["vip"]),
+            record.get("last_active", 0),
+        )
+
+    def load_all(self) -> dict:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT user_id, count, last_reset, vip, last_active FROM users ORDER BY user_id"
+            ).fetchall()
+        return {str(row[0]): self._record(row[1:]) for row in rows}
+
+    def save_all(self, data: dict) -> None:
+        rows = [self._row(user_id, record) for user_id, record in data.items()]
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO users (user_id, count, last_reset, vip, last_active) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    rows,
+                )
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def get_user(self, user_id) -> dict:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT count, last_reset, vip, last_active FROM users WHERE user_id = ?",
+                (int(user_id),),
+            ).fetchone()
+        return self._record(row) if row else default_record()
+
+    def has_user(self, user_id) -> bool:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM users WHERE user_id = ?", (int(user_id),)
+            ).fetchone()
+        return row is not None
+
+    def save_user(self, user_id, record: dict) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO users (user_id, count, last_reset, vip, last_active) "
+                "VALUES (?, ?, ?, ?, ?)",
+                self._row(user_id, record),
+            )
+
+    def increment_count(self, user_id, amount: int = 1) -> int:
+        """Adds ``amount`` to the user's count in one statement and returns the new count."""
+        with self._lock:
+            now = int(time.time())
+            return self._db.execute(
+                "INSERT INTO users (user_id, count, last_reset, vip, last_active) VALUES (?, ?, ?, 0, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET count = count + excluded.count, "
+                "last_active = excluded.last_active "
+                "RETURNING count",
+                (int(user_id), amount, now, now),
+            ).fetchone()[0]
+
+    def reset_window(self, user_id, expectedReset: int, now: int) -> bool:
+        """Sets count 0 and ``last_reset`` ``now`` if the window still starts at ``expectedReset``; returns whether it did."""
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE users SET count = 0, last_reset = ? WHERE user_id = ? AND last_reset = ?",
+                (int(now), int(user_id), int(expectedReset)),
+            )
+        return cursor.rowcount > 0
+
+    def count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def list_users(
+        self,
+        after=None,
+        before=None,
+        limit: int = 20,
+        vipOnly: bool = False,
+        quota: tuple | None = None,
+        activeSince: int | None = None,
+    ) -> list:
+        clauses, params = [], []
+        if after is not None:
+            clauses.append("user_id > ?")
+            params.append(int(after))
+        if before is not None:
+            clauses.append("user_id < ?")
+            params.append(int(before))
+        if vipOnly:
+            clauses.append("vip = 1")
+        if quota is not None:
+            clauses.append("vip = 0 AND count >= ? AND last_reset >= ?")
+            params.extend(quota)
+        if activeSince is not None:
+            clauses.append("last_active >= ?")
+            params.append(int(activeSince))
+        where = f"WHERE {' AND '.join(clauses)} " if clauses else ""
+        order = "DESC" if before is not None else "ASC"
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT user_id, count, last_reset, vip, last_active FROM users "
+                f"{where}ORDER BY user_id {order} LIMIT ?",
+                params + [int(limit)],
+            ).fetchall()
+        if before is not None:
+            rows.reverse()
+        return [(row[0], self._record(row[1:])) for row in rows]
+
+    def update_users(self, userIDs, vip: bool | None = None, resetQuota: bool = False) -> int:
+        """Sets VIP status and/or resets the quota of ``userIDs`` in one transaction; returns the users changed.
+
+        ``vip=True`` creates missing users; revoking or resetting skips them.
+        """
+        now = int(time.time())
+        assignments = []
+        if vip is not None:
+            assignments.append(f"vip = {int(vip)}")
+        if resetQuota:
+            assignments.append(f"count = 0, last_reset = {now}")
+        if not assignments:
+            return 0
+        rows = [(int(user_id),) for user_id in userIDs]
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                if vip:
+                    self._db.executemany(
+                        "INSERT OR IGNORE INTO users (user_id, count, last_reset, vip, last_active) "
+                        f"VALUES (?, 0, {now}, 1, 0)",
+                        rows,
+                    )
+                before = self._db.total_changes
+                self._db.executemany(f"UPDATE users SET {', '.join(assignments)} WHERE user_id = ?", rows)
+                updated = self._db.total_changes - before
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+        return updated
+
+    def _separate_connection(self) -> sqlite3.Connection:
+        """A second connection for full scans and VACUUM, so they never hold ``_lock``.
+
+        WAL mode lets requests read meanwhile; their writes wait for a VACUUM
+        (up to SQLite's busy timeout) instead of every request waiting for it.
+        """
+        return sqlite3.connect(self.path, isolation_level=None, timeout=30)
+
+    def read_all(self) -> dict:
+        db = self._separate_connection()
+        try:
+            rows = db.execute("SELECT user_id, count, last_reset, vip, last_active FROM users ORDER BY user_id").fetchall()
+        finally:
+            db.close()
+        return {str(row[0]): self._record(row[1:]) for row in rows}
+
+    def purge_expired(self, expiredBefore: int, archive=None) -> int:
+        """Deletes the users ``is_expired`` selects, ``PURGE_BATCH`` per transaction; returns how many.
+
+        ``archive`` is called with their ``[(user_id, record)]`` first. The scan
+        runs on a separate connection and each delete checks the condition
+        again, so users active since the scan stay.
+        """
+        expired = "vip = 0 AND last_reset < ? AND last_active < ?"
+        db = self._separate_connection()
+        try:
+            rows = db.execute(
+                f"SELECT user_id, count, last_reset, vip, last_active FROM users WHERE {expired} ORDER BY user_id",
+                (int(expiredBefore), int(expiredBefore)),
+            ).fetchall()
+        finally:
+            db.close()
+        if not rows:
+            return 0
+        if archive is not None:
+            archive([(row[0], self._record(row[1:])) for row in rows])
+        removed = 0
+        for start in range(0, len(rows), PURGE_BATCH):
+            batch = [(row[0], int(expiredBefore), int(expiredBefore)) for row in rows[start : start + PURGE_BATCH]]
+            with self._lock:
+                self._db.execute("BEGIN IMMEDIATE")
+                try:
+                    before = self._db.total_changes
+                    self._db.executemany(f"DELETE FROM users WHERE user_id = ? AND {expired}", batch)
+                    removed += self._db.total_changes - before
+                except BaseException:
+                    self._db.execute("ROLLBACK")
+                    raise
+                self._db.execute("COMMIT")
+        return removed
+
+    def compact(self) -> None:
+        """Truncates the WAL, after rebuilding the database with VACUUM once a tenth of its pages are free.
+
+        Both run on a separate connection, without ``_lock``.
+        """
+        db = self._separate_connection()
+        try:
+            pages = db.execute("PRAGMA page_count").fetchone()[0]
+            free = db.execute("PRAGMA freelist_count").fetchone()[0]
+            if free and free * 10 >= pages:
+                db.execute("VACUUM")
+            db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            db.close()
+
+    def size(self) -> int | None:
+        """Bytes on disk, WAL included."""
+        return sum(os.path.getsize(path) for path in (self.path, self.path + "-wal") if os.path.exists(path))
+
+    def migrate_json(self, jsonPath: str) -> int:
+        """Imports ``jsonPath`` once; returns the number of migrated users."""
+        with self._lock:
+            done = self._db.execute(
+                "SELECT value FROM meta WHERE key = 'migrated_json'"
+            ).fetchone()
+        if done or not os.path.exists(jsonPath):
+            return 0
+        data = JSONUserStore(jsonPath).load_all()
+        if data:
+            self.save_all(data)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_json', ?)",
+                (str(int(time.time())),),
+            )
+        return len(data)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+class RedisUserStore:
+    """Stores one hash per user (``user:<id>``).
+
+    Sorted sets scored by user ID index all users and the VIP users, so
+    ``list_users`` pages with ``ZRANGEBYSCORE`` instead of scanning keys.
+    """
+
+    def __init__(self, client: RespClient, prefix: str = ""):
+        self.client = client
+        self.prefix = prefix
+        self._users = f"{prefix}users:ids"
+        self._vips = f"{prefix}users:vip"
+
+    def _key(self, user_id) -> str:
+        return f"{self.prefix}user:{int(user_id)}"
+
+    @staticmethod
+    def _record(fields: list) -> dict | None:
+        if not fields:
+            return None
+        values = dict(zip(fields[::2], fields[1::2]))
+        return {
+            "count": int(values.get("count", 0)),
+            "last_reset": int(values.get("last_reset", 0)),
+            "vip": values.get("vip") == "1",
+            "last_active": int(values.get("last_active", 0)),
+        }
+
+    def _save_commands(self, user_id, record: dict) -> list:
+        user_id = int(user_id)
+        return [
+            (
+                "HSET",
+                self._key(user_id),
+                "count",
+                record["count"],
+                "last_reset",
+                record["last_reset"],
+                "vip",
+                int(record["vip"]),
+                "last_active",
+                record.get("last_active", 0),
+            ),
+            ("ZADD", self._users, user_id, user_id),
+            ("ZADD", self._vips, user_id, user_id) if record["vip"] else ("ZREM", self._vips, user_id),
+        ]
+
+    def load_all(self) -> dict:
+        userIDs = self.client.execute("ZRANGEBYSCORE", self._users, "-inf", "+inf")
+        replies = self.client.pipeline([("HGETALL", self._key(user_id)) for user_id in userIDs])
+        return {
+            str(user_id): record
+            for user_id, record in zip(userIDs, map(self._record, replies))
+            if record is not None
+        }
+
+    def save_all(self, data: dict) -> None:
+        commands = []
+        for user_id, record in data.items():
+            commands.extend(self._save_commands(user_id, record))
+        if commands:
+            self.client.pipeline(commands, transaction=True)
+
+    def get_user(self, user_id) -> dict:
+        return self._record(self.client.execute("HGETALL", self._key(user_id))) or default_record()
+
+    def has_user(self, user_id) -> bool:
+        return bool(self.client.execute("EXISTS", self._key(user_id)))
+
+    def save_user(self, user_id, record: dict) -> None:
+        self.client.pipeline(self._save_commands(user_id, record), transaction=True)
+
+    def increment_count(self, user_id, amount: int = 1) -> int:
+        """Atomically adds ``amount`` to the user's count; safe across instances."""
+        key = self._key(user_id)
+        count = self.client.pipeline(
+            [
+                ("HINCRBY", key, "count", amount),
+                ("HSETNX", key, "last_reset", int(time.time())),
+                ("HSETNX", key, "vip", 0),
+                ("HSET", key, "last_active", int(time.time())),
+                ("ZADD", self._users, int(user_id), int(user_id)),
+            ],
+            transaction=True,
+        )[0]
+        return count
+
+    def reset_window(self, user_id, expectedReset: int, now: int) -> bool:
+        """Sets count 0 and ``last_reset`` ``now`` if the window still starts at ``expectedReset``; returns whether it did.
+
+        The check and the HSET run in one WATCH transaction, retried when
+        another write to the user lands in between.
+        """
+        key = self._key(user_id)
+
+        def build(replies: list) -> list:
+            if replies[0] != str(int(expectedReset)):
+                return []
+            return [("HSET", key, "count", 0, "last_reset", int(now))]
+
+        while True:
+            result = self.client.watch([key], [("HGET", key, "last_reset")], build)
+            if result is not None:
+                return bool(result)
+
+    def count(self) -> int:
+        return self.client.execute("ZCARD", self._users)
+
+    def list_users(
+        self,
+        after=None,
+        before=None,
+        limit: int = 20,
+        vipOnly: bool = False,
+        quota: tuple | None = None,
+        activeSince: int | None = None,
+    ) -> list:
+        """Pages over the ID index (or the VIP index); other filters are applied per batch."""
+        index = self._vips if vipOnly else self._users
+        matches = user_filter(vipOnly, quota, activeSince)
+        backwards = before is not None
+        cursor = int(before) if backwards else (int(after) if after is not None else None)
+        batch = max(limit, 50)
+        rows = []
+        while len(rows) < limit:
+            if backwards:
+                userIDs = self.client.execute(
+                    "ZREVRANGEBYSCORE", index, f"({cursor}", "-inf", "LIMIT", 0, batch
+                )
+            else:
+                userIDs = self.client.execute(
+                    "ZRANGEBYSCORE", index, f"({cursor}" if cursor is not None else "-inf", "+inf", "LIMIT", 0, batch
+                )
+            if not userIDs:
+                break
+            replies = self.client.pipeline([("HGETALL", self._key(user_id)) for user_id in userIDs])
+            for user_id, record in zip(userIDs, map(self._record, replies)):
+                if record is not None and matches(record):
+                    rows.append((int(user_id), record))
+                    if len(rows) == limit:
+                        break
+            cursor = int(userIDs[-1])
+        if backwards:
+            rows.reverse()
+        return rows
+
+    def update_users(self, userIDs, vip: bool | None = None, resetQuota: bool = False) -> int:
+        """Sets VIP status and/or resets the quota of ``userIDs`` in one MULTI/EXEC; returns the users changed.
+
+        ``vip=True`` creates missing users; revoking or resetting skips them.
+        """
+        userIDs = [int(user_id) for user_id in userIDs]
+        if vip is None and not resetQuota:
+            return 0
+        if not vip:
+            exists = self.client.pipeline([("EXISTS", self._key(user_id)) for user_id in userIDs])
+            userIDs = [user_id for user_id, found in zip(userIDs, exists) if found]
+        now = int(time.time())
+        commands = []
+        for user_id in userIDs:
+            key = self._key(user_id)
+            if vip:
+                commands.extend(
+                    [
+                        ("HSETNX", key, "count", 0),
+                        ("HSETNX", key, "last_reset", now),
+                        ("HSETNX", key, "last_active", 0),
+                        ("ZADD", self._users, user_id, user_id),
+                    ]
+                )
+            if vip is not None:
+                commands.append(("HSET", key, "vip", int(vip)))
+                commands.append(("ZADD", self._vips, user_id, user_id) if vip else ("ZREM", self._vips, user_id))
+            if resetQuota:
+                commands.append(("HSET", key, "count", 0, "last_reset", now))
+        if commands:
+            self.client.pipeline(commands, transaction=True)
+        return len(userIDs)
+
+    def purge_expired(self, expiredBefore: int, archive=None) -> int:
+        """Deletes the users ``is_expired`` selects, ``PURGE_BATCH`` per transaction; returns how many.
+
+        ``archive`` is called with their ``[(user_id, record)]`` first. Each
+        batch is deleted in a WATCH transaction that reads the records again,
+        so a user who came back or got an admin change since the scan stays.
+        A batch that keeps changing under it is left for the next run.
+        """
+        rows, cursor = [], None
+        while True:
+            page = self.list_users(after=cursor, limit=PURGE_BATCH)
+            if not page:
+                break
+            rows.extend((user_id, record) for user_id, record in page if is_expired(record, expiredBefore))
+            cursor = page[-1][0]
+        if not rows:
+            return 0
+        if archive is not None:
+            archive(rows)
+        removed = 0
+        for start in range(0, len(rows), PURGE_BATCH):
+            userIDs = [user_id for user_id, _ in rows[start : start + PURGE_BATCH]]
+            keys = [self._key(user_id) for user_id in userIDs]
+
+            def build(replies: list) -> list:
+                commands = []
+                for user_id, key, record in zip(userIDs, keys, map(self._record, replies)):
+                    if record is not None and is_expired(record, expiredBefore):
+                        commands.extend([("DEL", key), ("ZREM", self._users, user_id)])
+                return commands
+
+            for _ in range(PURGE_ATTEMPTS):
+                result = self.client.watch(keys, [("HGETALL", key) for key in keys], build)
+                if result is not None:
+                    removed += sum(result[::2])
+                    break
+        return removed
+
+    def compact(self) -> None:
+        pass  # the server manages its own memory and persistence
+
+    def read_all(self) -> dict:
+        return self.load_all()  # no lock to avoid: requests use other pooled connections
+
+    def size(self) -> int | None:
+        return None  # not a local file
+
+    def migrate_json(self, jsonPath: str) -> int:
+        """Imports ``jsonPath`` once (by whichever instance gets there first)."""
+        if not os.path.exists(jsonPath):
+            return 0
+        claimed = self.client.execute(
+            "SET", f"{self.prefix}meta:migrated_json", int(time.time()), "NX"
+        )
+        if claimed is None:
+            return 0
+        data = JSONUserStore(jsonPath).load_all()
+        self.save_all(data)
+        return len(data)
+
+    def close(self) -> None:
+        self.client.close()
+
+
+def open_store(
+    backend: str,
+    databasePath: str,
+    jsonPath: str,
+    flushInterval: float = 5.0,
+    flushThreshold: int = 100,
+    redisUrl: str | None = None,
+):
+    """Opens the configured store; the SQLite and Redis stores import ``jsonPath`` on first use."""
+    if STORE_REDIS == backend:
+        store = RedisUserStore(RespClient.from_url(redisUrl or "redis://127.0.0.1:6379/0"))
+        store.migrate_json(jsonPath)
+        return store
+    if STORE_JSON == backend:
+        return JSONUserStore(jsonPath)
+    if STORE_JSON_CACHED == backend:
+        return CachedJSONUserStore(jsonPath, flushInterval, flushThreshold)
+    store = SQLiteUserStore(databasePath)
+    store.migrate_json(jsonPath)
+    return store
@@ -0,0 +1,128 @@
+"""Bot API HTTP client: tuned connection pools and central flood-control handling.
+
+``build_requests`` returns the two ``HTTPXRequest`` objects the application
+needs (one for API calls, one for ``getUpdates``). They share one SSL context,
+which halves the client setup at startup, and keep idle connections alive so
+a burst of replies reuses them instead of reconnecting.
+
+``FloodControlRequest`` handles Telegram's 429 replies in one place: it waits
+out ``retry_after`` and retries the call, and other calls for the same chat
+wait too instead of running into the same limit. While a chat is blocked
+for longer than a call is willing to wait, its calls fail at once.
+"""
+
+import asyncio
+import math
+import time
+import warnings
+from datetime import timedelta
+
+import httpx
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
+from telegram.warnings import PTBDeprecationWarning
+
+import metrics
+
+GLOBAL_CHAT = None  # flood control for calls that are not for a chat
+KEEPALIVE_EXPIRY = 30.0  # seconds an idle pooled connection stays open
+
+floodRetries = metrics.counter(
+    "telegram_flood_retries_total", "Bot API calls retried after a 429 flood-control reply.", ("method",)
+)
+floodFailures = metrics.counter(
+    "telegram_flood_failures_total", "Bot API calls given up on after 429 flood-control replies.", ("method",)
+)
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", PTBDeprecationWarning)  # int today, timedelta in a later release
+        retryAfter = error.retry_after
+    return retryAfter.total_seconds() if isinstance(retryAfter, timedelta) else float(retryAfter)
+
+
+class FloodControlRequest(HTTPXRequest):
+    """``HTTPXRequest`` that waits out 429 ``retry_after`` replies and retries.
+
+    A 429 blocks the chat the call was for (every call, for methods without a
+    chat) until ``retry_after`` has passed. A call is retried at most
+    ``maxRetries`` times and only for waits up to ``maxRetryAfter`` seconds;
+    beyond that ``RetryAfter`` reaches the handler.
+    """
+
+    def __init__(self, maxRetries: int = 3, maxRetryAfter: float = 30.0, **kwargs):
+        super().__init__(**kwargs)
+        self.maxRetries = maxRetries
+        self.maxRetryAfter = maxRetryAfter
+        self._blockedUntil = {}  # chat_id (or GLOBAL_CHAT) -> time.monotonic() deadline
+
+    def _delay(self, chat) -> float:
+        now = time.monotonic()
+        deadline = self._blockedUntil.get(GLOBAL_CHAT, 0.0)
+        if chat is not GLOBAL_CHAT:
+            deadline = max(deadline, self._blockedUntil.get(chat, 0.0))
+        return deadline - now
+
+    def _block(self, chat, seconds: float) -> None:
+        now = time.monotonic()
+        for key in [key for key, deadline in self._blockedUntil.items() if deadline <= now]:
+            del self._blockedUntil[key]
+        self._blockedUntil[chat] = max(self._blockedUntil.get(chat, 0.0), now + seconds)
+
+    async def post(self, url: str, request_data=None, **timeouts):
+        method = url.rsplit("/", 1)[-1]
+        chat = request_data.parameters.get("chat_id", GLOBAL_CHAT) if request_data is not None else GLOBAL_CHAT
+        attempt = 0
+        while True:
+            delay = self._delay(chat)
+            if delay > self.maxRetryAfter:
+                # still blocked for long: fail now rather than hold the handler
+                floodFailures.inc(1, method)
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore", PTBDeprecationWarning)
+                    raise RetryAfter(math.ceil(delay))
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                return await super().post(url, request_data, **timeouts)
+            except RetryAfter as e:
+                seconds = retry_after_seconds(e)
+                self._block(chat, seconds)
+                if attempt >= self.maxRetries or seconds > self.maxRetryAfter:
+                    floodFailures.inc(1, method)
+                    raise
+                attempt += 1
+                floodRetries.inc(1, method)
+
+
+def build_requests(
+    poolSize: int, timeout: float, poolTimeout: float, maxRetries: int, maxRetryAfter: float
+) -> tuple:
+    """Returns ``(request, getUpdatesRequest)`` sharing one SSL context."""
+    sslContext = httpx.create_ssl_context()
+    request = FloodControlRequest(
+        maxRetries,
+        maxRetryAfter,
+        connection_pool_size=poolSize,
+        connect_timeout=timeout,
+        read_timeout=timeout,
+        write_timeout=timeout,
+        pool_timeout=poolTimeout,
+        httpx_kwargs={
+            "verify": sslContext,
+            "limits": httpx.Limits(
+                max_connections=poolSize, max_keepalive_connections=poolSize, keepalive_expiry=KEEPALIVE_EXPIRY
+            ),
+        },
+    )
+    # getUpdates holds its single connection open for the long-poll timeout, which
+    # PTB adds to read_timeout itself
+    getUpdatesRequest = HTTPXRequest(
+        connection_pool_size=1,
+        connect_timeout=timeout,
+        read_timeout=timeout,
+        pool_timeout=poolTimeout,
+        httpx_kwargs={"verify": sslContext},
+    )
+    return request, getUpdatesRequest
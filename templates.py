@@ -0,0 +1,96 @@
+"""Message and keyboard templates for the bot's replies.
+
+Replies are registered once, at startup. A ``Template`` escapes its literal
+text for MarkdownV2 when it is registered, so rendering only escapes the
+per-user fields that are filled in; templates without fields are rendered
+once and the result is reused. Keyboards are built once as well:
+``InlineKeyboardMarkup`` objects are immutable, so every reply can share them.
+"""
+
+from string import Formatter
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+MARKDOWN_V2_SPECIAL = r"_*[]()~`>#+-=|{}.!"
+_MARKDOWN_V2_TABLE = str.maketrans({char: "\\" + char for char in MARKDOWN_V2_SPECIAL})
+_MARKDOWN_V2_PAIRS = tuple((char, "\\" + char) for char in MARKDOWN_V2_SPECIAL)
+
+
+def escape_markdown_v2(text: str) -> str:
+    """Escapes special characters for MarkdownV2."""
+    if text.isascii():
+        return text.translate(_MARKDOWN_V2_TABLE)
+    # str.translate has no fast path for non-ASCII text (emoji, accents); a
+    # replace per special character that occurs is several times faster there
+    for char, escaped in _MARKDOWN_V2_PAIRS:
+        if char in text:
+            text = text.replace(char, escaped)
+    return text
+
+
+def _plain(text: str) -> str:
+    return text
+
+
+class Template:
+    """``text`` with ``str.format`` fields; literals are escaped once, fields on every render."""
+
+    def __init__(self, text: str, escape=escape_markdown_v2):
+        self.text = text
+        self.escape = escape or _plain
+        self._parts = []  # [(escaped literal, field name or None, format spec)]
+        for literal, field, spec, conversion in Formatter().parse(text):
+            if conversion:
+                raise ValueError(f"conversions are not supported: {text!r}")
+            self._parts.append((self.escape(literal), field, spec or ""))
+        self.fields = tuple(field for _, field, _ in self._parts if field is not None)
+        self._static = "".join(literal for literal, _, _ in self._parts) if not self.fields else None
+
+    def render(self, **fields) -> str:
+        if self._static is not None:
+            return self._static
+        escape = self.escape
+        out = []
+        for literal, field, spec in self._parts:
+            out.append(literal)
+            if field is not None:
+                out.append(escape(format(fields[field], spec)))
+        return "".join(out)
+
+
+def keyboard(rows) -> InlineKeyboardMarkup:
+    """Builds a markup from rows of ``(text, callback_data)`` or ``(text, {"url": ...})`` pairs."""
+    return InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton(text, **action) if isinstance(action, dict) else InlineKeyboardButton(text, callback_data=action)
+                for text, action in row
+            ]
+            for row in rows
+        ]
+    )
+
+
+class TemplateRegistry:
+    """Named message templates and keyboards, built once at startup."""
+
+    def __init__(self):
+        self._messages = {}
+        self._keyboards = {}
+
+    def add_message(self, name: str, text: str, escape=escape_markdown_v2) -> Template:
+        template = self._messages[name] = Template(text, escape)
+        return template
+
+    def add_keyboard(self, name: str, rows) -> InlineKeyboardMarkup:
+        markup = self._keyboards[name] = keyboard(rows)
+        return markup
+
+    def render(self, name: str, **fields) -> str:
+        return self._messages[name].render(**fields)
+
+    def markup(self, name: str) -> InlineKeyboardMarkup:
+        return self._keyboards[name]
+
+    def names(self) -> list:
+        return sorted(self._messages)
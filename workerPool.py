@@ -0,0 +1,188 @@
+"""Process pool that runs keybox generation on every CPU core.
+
+RSA prime search and EC key generation are CPU-bound, so running them in the
+bot process ties the bot to a single core. ``GenerationWorkerPool`` runs them
+in worker processes instead. Each worker is warmed up when it starts: the
+generator and its crypto backend are imported and, optionally, the worker
+fills its own key pools. A crashed worker breaks the whole executor, so the
+pool is then rebuilt and the job is retried once. Metrics recorded in a worker
+travel back with each result and are merged into the bot's registry. The
+caller's log trace ID travels with each job, and workers log the way the bot
+does (``logSettings`` are passed to ``logConfig.configure``).
+
+Workers do not re-run the parent's ``__main__`` script, so the functions they
+run must live in importable modules such as ``keyboxGenerator``.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+import logConfig
+import metrics
+
+_spawnLock = threading.Lock()
+
+
+@contextmanager
+def _spawning_without_main():
+    """Hides ``__main__``'s origin while the executor starts its workers.
+
+    A spawned process first re-imports the parent's main script; for the bot
+    that is main.py with all of python-telegram-bot, about half a second of CPU
+    per worker at startup. Only ``GenerationWorkerPool._create`` starts
+    workers, once per executor, so this is the only time the interpreter's
+    ``__main__`` is touched.
+    """
+    main = sys.modules["__main__"]
+    with _spawnLock:
+        saved = {name: main.__dict__[name] for name in ("__file__", "__spec__") if name in main.__dict__}
+        main.__dict__.pop("__file__", None)
+        main.__spec__ = None
+        try:
+            yield
+        finally:
+            main.__dict__.update(saved)
+            if "__spec__" not in saved:
+                del main.__spec__
+
+
+def _warm_up(
+    keyPoolSettings: tuple | None,
+    certificateAuthoritySettings: tuple | None = None,
+    logSettings: tuple | None = None,
+) -> None:
+    """Worker initializer: load the crypto backend before the first job arrives."""
+    if logSettings:
+        logConfig.configure(*logSettings)
+    import keyboxGenerator
+
+    metrics.enable_forwarding()
+    if keyboxGenerator.CRYPTOGRAPHY_AVAILABLE:
+        keyboxGenerator.new_ec_key()
+    if keyPoolSettings:
+        keyboxGenerator.enable_key_pools(*keyPoolSettings)
+    if certificateAuthoritySettings:
+        keyboxGenerator.enable_certificate_authority(*certificateAuthoritySettings)
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def _call(func, args: tuple, traceID: str | None = None) -> tuple:
+    """Runs ``func(*args)`` in a worker; returns the result and the metrics it recorded."""
+    logConfig.traceID.set(traceID)
+    try:
+        return func(*args), metrics.drain()
+    except BaseException:
+        metrics.drain()
+        raise
+
+
+def _unwrap(reply: tuple):
+    result, events = reply
+    metrics.merge(events)
+    return result
+
+
+class GenerationWorkerPool:
+    """``keyPoolSettings`` are passed to ``keyboxGenerator.enable_key_pools`` and
+    ``certificateAuthoritySettings`` to ``keyboxGenerator.enable_certificate_authority``
+    in every worker. The CA needs a directory so that all workers share it.
+    """
+
+    def __init__(
+        self,
+        workers: int | None = None,
+        keyPoolSettings: tuple | None = None,
+        certificateAuthoritySettings: tuple | None = None,
+        logSettings: tuple | None = None,
+    ):
+        self.workers = max(1, int(workers or os.cpu_count() or 1))
+        self.keyPoolSettings = keyPoolSettings
+        self.certificateAuthoritySettings = certificateAuthoritySettings
+        self.logSettings = logSettings
+        self.restarts = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self._warmups = []
+
+    def _create(self) -> ProcessPoolExecutor:
+        """Creates the executor and starts every worker now (called with ``_lock`` held).
+
+        ProcessPoolExecutor starts a worker on each submit while none is idle,
+        so one ping per worker starts them all here and later jobs never start
+        a process.
+        """
+        executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),  # no fork of the bot's threads
+            initializer=_warm_up,
+            initargs=(self.keyPoolSettings, self.certificateAuthoritySettings, self.logSettings),
+        )
+        with _spawning_without_main():
+            self._warmups = [executor.submit(_ping) for _ in range(self.workers)]
+        return executor
+
+    def _current(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = self._create()
+            return self._executor
+
+    def start(self, wait: bool = True) -> None:
+        """Starts and warms up all workers; with ``wait`` blocks until they are ready.
+
+        Without ``wait`` the workers warm up in the background and jobs that
+        arrive first simply queue until a worker is ready.
+        """
+        self._current()
+        with self._lock:
+            warmups = self._warmups
+        if wait:
+            for future in warmups:
+                future.result()
+
+    def _restart(self, broken: ProcessPoolExecutor) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is broken:  # another caller may have restarted it already
+                broken.shutdown(wait=False, cancel_futures=True)
+                self._executor = self._create()
+                self.restarts += 1
+            return self._executor
+
+    def submit(self, func, *args):
+        """Runs ``func(*args)`` in a worker and returns its result (blocking)."""
+        executor = self._current()
+        traceID = logConfig.traceID.get()
+        try:
+            return _unwrap(executor.submit(_call, func, args, traceID).result())
+        except BrokenProcessPool:
+            executor = self._restart(executor)
+            return _unwrap(executor.submit(_call, func, args, traceID).result())
+
+    async def run(self, func, *args):
+        """Runs ``func(*args)`` in a worker without blocking the event loop."""
+        executor = self._current()
+        loop = asyncio.get_running_loop()
+        traceID = logConfig.traceID.get()
+        try:
+            return _unwrap(await loop.run_in_executor(executor, _call, func, args, traceID))
+        except BrokenProcessPool:
+            executor = self._restart(executor)
+            return _unwrap(await loop.run_in_executor(executor, _call, func, args, traceID))
+
+    def stats(self) -> dict:
+        return {"workers": self.workers, "restarts": self.restarts}
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)